@@ -0,0 +1,105 @@
+import logging
+import os
+import threading
+import time
+
+import metrics
+from storage import load_seed, write_seed_file
+
+# How long an unknown user is remembered as unauthorized before storage is asked again
+NEGATIVE_CACHE_SECONDS = 60
+
+
+# In-memory set of allowed user IDs (the `allowedusers` collection), kept current by
+# a snapshot listener. When no listener is active, unknown users are checked against
+# storage once and the "not allowed" answer is cached, so a flood from an
+# unauthorized user costs at most one read per NEGATIVE_CACHE_SECONDS.
+#
+# With a `snapshot_dir`, the list is saved to `<snapshot_dir>/allowedusers.json` on every
+# update. load_snapshot() only lets those users in early after a restart; everyone else
+# is still checked against storage until the live list has been loaded.
+#
+# `on_change(user_ids)`, when set, is called after every list read from storage,
+# possibly on the listener thread; other processes pass it to apply_shared().
+class AllowList:
+    def __init__(self, storage, negative_ttl=NEGATIVE_CACHE_SECONDS, snapshot_dir=None):
+        self._storage = storage
+        self._negative_ttl = negative_ttl
+        self._snapshot_dir = snapshot_dir
+        self._lock = threading.Lock()
+        self._allowed = frozenset()
+        self._denied_until = {}  # user_id -> monotonic time the negative entry expires
+        self._synced = False
+        self._watch = None
+        self.on_change = None
+
+    def load(self):
+        self._replace(self._storage.load_allowed_users())
+
+    def load_snapshot(self):
+        if not self._snapshot_dir or not os.path.exists(os.path.join(self._snapshot_dir, 'allowedusers.json')):
+            return False
+        with self._lock:
+            self._allowed = frozenset(load_seed(self._snapshot_dir)['allowedusers'])
+        logging.info("Allow list loaded from snapshot: %d users", len(self._allowed))
+        return True
+
+    def start_listener(self):
+        self.stop_listener()
+        self._watch = self._storage.watch_allowed_users(self._replace)
+
+    def stop_listener(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
+    # Function to check a user without any I/O; None means the answer is not known yet
+    def check_cached(self, user_id):
+        user_id = str(user_id)
+        if user_id in self._allowed:
+            return True
+        if self._synced and self._watch is not None and self._watch.is_active:
+            return False
+        expires = self._denied_until.get(user_id)
+        if expires is not None and expires > time.monotonic():
+            return False
+        return None
+
+    # Function to look a user up in storage when the cached set cannot answer (blocking)
+    def fetch(self, user_id):
+        user_id = str(user_id)
+        if self._storage.is_allowed_user(user_id):
+            with self._lock:
+                self._allowed = self._allowed | {user_id}
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if len(self._denied_until) > 10000:
+                self._denied_until = {k: v for k, v in self._denied_until.items() if v > now}
+            self._denied_until[user_id] = now + self._negative_ttl
+        return False
+
+    # Function to take a list another process read from storage
+    def apply_shared(self, user_ids):
+        self._replace(user_ids, save=False)
+
+    def record_denied(self):
+        metrics.UNAUTHORIZED_REQUESTS.inc()
+
+    def _replace(self, user_ids, save=True):
+        with self._lock:
+            self._allowed = frozenset(str(user_id) for user_id in user_ids)
+            self._denied_until = {}
+            self._synced = True
+            if save and self._snapshot_dir:
+                self._save_snapshot()
+        logging.info("Allow list updated: %d users", len(self._allowed))
+        if save and self.on_change is not None:
+            self.on_change(sorted(self._allowed))
+
+    # Called with the lock held, from the loading thread or the listener thread
+    def _save_snapshot(self):
+        try:
+            write_seed_file(self._snapshot_dir, 'allowedusers', [{'id': user_id} for user_id in sorted(self._allowed)])
+        except OSError as e:
+            logging.error("Failed to save the allow list snapshot: %s", e)
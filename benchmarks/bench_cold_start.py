@@ -0,0 +1,125 @@
+# Cold start benchmark for bot.py.
+#
+# Starts the bot in fresh processes and measures how long it takes to import and to
+# answer the first /start, with and without the catalog snapshot saved by a previous
+# run (BOT_SNAPSHOT_DIR). The Bot API is stubbed; storage is the in-memory backend with
+# simulated connection and read latency, or the real Firestore with --storage firestore:
+#
+#   python benchmarks/bench_cold_start.py --runs 10 --connect-ms 1500 --read-ms 150
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Runs in the child process: start the bot, answer one /start and report the timings
+def child(connect_delay, read_delay):
+    started = float(os.environ["BENCH_STARTED"])
+    import_started = time.time()
+    sys.path.insert(0, REPO_ROOT)
+    import bot
+    from fake_telegram import FakeBotApiRequest, UpdateFactory
+    imported = time.time()
+
+    # Stand in for the Firestore client construction and network reads
+    def delayed(func, delay):
+        def wrapper(*args, **kwargs):
+            time.sleep(delay)
+            return func(*args, **kwargs)
+        return wrapper
+
+    if connect_delay or read_delay:
+        bot.backend.connect = delayed(bot.backend.connect, connect_delay)
+        for method in ('load_catalog', 'load_allowed_users', 'is_allowed_user'):
+            setattr(bot.backend, method, delayed(getattr(bot.backend, method), read_delay))
+
+    async def first_response():
+        request = FakeBotApiRequest()
+        application = bot.build_application("123456:BENCHMARK", request=request)
+        await application.initialize()
+        await application.post_init(application)
+        await application.process_update(UpdateFactory(application.bot).command("/start"))
+        answered = time.time()
+        # Let a background refresh finish so the next run finds a current snapshot
+        await asyncio.gather(*bot.background_tasks)
+        await application.post_shutdown(application)
+        await application.shutdown()
+        return answered, request.calls.get('sendMessage', 0)
+
+    answered, replies = asyncio.run(first_response())
+    print(json.dumps({
+        'interpreter_ms': (import_started - started) * 1000,
+        'import_ms': (imported - import_started) * 1000,
+        'first_response_ms': (answered - started) * 1000,
+        'replies': replies,
+    }))
+
+
+def run_child(args, snapshot_dir):
+    env = dict(os.environ)
+    env.setdefault("BOT_STORAGE", args.storage)
+    env.setdefault("BOT_STORAGE_SEED_DIR", os.path.join(REPO_ROOT, "functions"))
+    env.update({
+        "BROADCAST_OUTBOX_PATH": ":memory:",
+        "BOT_SNAPSHOT_DIR": snapshot_dir,
+        "METRICS_PORT": str(args.metrics_port),
+        "LOG_LEVEL": "WARNING",
+        "BENCH_STARTED": repr(time.time()),
+    })
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child',
+         '--connect-ms', str(args.connect_ms), '--read-ms', str(args.read_ms)],
+        env=env, cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(label, results):
+    def median(key):
+        return statistics.median(result[key] for result in results)
+    print(f"{label:<6}{median('interpreter_ms'):>14.0f}{median('import_ms'):>12.0f}"
+          f"{median('first_response_ms'):>18.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure bot.py import time and time to first response.")
+    parser.add_argument('--runs', type=int, default=5, help="process starts per mode")
+    parser.add_argument('--storage', default='memory', help="BOT_STORAGE backend (memory, sqlite or firestore)")
+    parser.add_argument('--connect-ms', type=float, default=0.0, help="simulated client construction time")
+    parser.add_argument('--read-ms', type=float, default=0.0, help="simulated latency of each storage read")
+    parser.add_argument('--metrics-port', type=int, default=0, help="METRICS_PORT for the bot (0: off)")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.connect_ms / 1000, args.read_ms / 1000)
+        return
+
+    snapshot_dir = tempfile.mkdtemp(prefix="bot_snapshot_")
+    try:
+        cold, warm = [], []
+        for _ in range(args.runs):
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+            cold.append(run_child(args, snapshot_dir))
+            # The cold run above has just written the snapshot the warm run starts from
+            warm.append(run_child(args, snapshot_dir))
+    finally:
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    if any(result['replies'] != 1 for result in cold + warm):
+        print("warning: some runs did not answer /start", file=sys.stderr)
+    print(f"median of {args.runs} runs, ms since process start")
+    print(f"{'mode':<6}{'interpreter':>14}{'import bot':>12}{'first response':>18}")
+    summarize('cold', cold)
+    summarize('warm', warm)
+
+
+if __name__ == '__main__':
+    main()
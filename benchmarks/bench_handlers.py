@@ -0,0 +1,197 @@
+# Handler latency benchmark for bot.py.
+#
+# Feeds synthetic /start, category, function, back and inline query updates through the real
+# Application (handlers, allow list, catalog cache, keyboards) with a stubbed Bot API
+# transport and the in-memory storage backend, at a configurable concurrency.
+# Reports p50/p95/p99 latency and updates/sec per handler and can save the results
+# as JSON to compare versions:
+#
+#   python benchmarks/bench_handlers.py --updates 20000 --concurrency 32 --output before.json
+#   python benchmarks/bench_handlers.py --updates 20000 --concurrency 32 --compare before.json
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# Local storage and an in-memory outbox, so the benchmark needs no credentials or network
+os.environ.setdefault("BOT_STORAGE", "memory")
+os.environ.setdefault("BOT_STORAGE_SEED_DIR", os.path.join(REPO_ROOT, "functions"))
+os.environ.setdefault("BROADCAST_OUTBOX_PATH", ":memory:")
+os.environ.setdefault("BOT_SNAPSHOT_DIR", "")
+# Every update comes from one user, so the inbound rate limits are off unless set
+for name in ("THROTTLE_USER_RATE", "THROTTLE_CHAT_RATE", "THROTTLE_REPEAT_SECONDS"):
+    os.environ.setdefault(name, "0")
+
+import bot  # noqa: E402
+from fake_telegram import FakeBotApiRequest, UpdateFactory  # noqa: E402
+
+# Share of each kind of update in the replayed traffic
+DEFAULT_MIX = "start=2,menu=3,function=4,back=1,inline=2"
+
+
+INLINE_QUERIES = ["faucet", "mainnet fauc", "ecosytem blurb", "discovery call", "twiter", "explorer", "brand", ""]
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        kind, _, weight = part.partition('=')
+        weights[kind.strip()] = float(weight)
+    return weights
+
+
+# Function to collect the callback tokens currently on the menus
+def menu_tokens():
+    category_tokens = [button.callback_data for row in bot.keyboards.main_menu().inline_keyboard for button in row]
+    function_tokens = []
+    for token in category_tokens:
+        submenu = bot.keyboards.submenu(token)
+        if submenu:
+            function_tokens += [button.callback_data for row in submenu.inline_keyboard for button in row
+                                if button.callback_data != bot.BACK_PREFIX]
+    return category_tokens, function_tokens
+
+
+async def run_benchmark(updates, concurrency, mix, api_latency, seed, warmup):
+    request = FakeBotApiRequest(latency=api_latency)
+    application = bot.build_application("123456:BENCHMARK", request=request)
+    await application.initialize()
+    await application.post_init(application)
+
+    factory = UpdateFactory(application.bot)
+    category_tokens, function_tokens = menu_tokens()
+    builders = {
+        'start': lambda: factory.command("/start"),
+        'menu': lambda: factory.callback(rng.choice(category_tokens)),
+        'function': lambda: factory.callback(rng.choice(function_tokens)),
+        'back': lambda: factory.callback(bot.BACK_PREFIX),
+        # What users type while searching: whole words, prefixes and typos
+        'inline': lambda: factory.inline_query(rng.choice(INLINE_QUERIES)),
+    }
+    rng = random.Random(seed)
+    kinds = list(mix)
+    traffic = [(kind, builders[kind]()) for kind in rng.choices(kinds, weights=[mix[k] for k in kinds], k=updates + warmup)]
+
+    latencies = {kind: [] for kind in kinds}
+    position = 0
+
+    async def worker():
+        nonlocal position
+        while position < len(traffic):
+            index = position
+            position += 1
+            kind, update = traffic[index]
+            started = time.perf_counter()
+            await application.process_update(update)
+            if index >= warmup:
+                latencies[kind].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    await application.post_shutdown(application)
+    await application.shutdown()
+
+    handlers = {}
+    for kind, values in latencies.items():
+        values.sort()
+        handlers[kind] = {
+            'count': len(values),
+            'p50_ms': percentile(values, 50) * 1000,
+            'p95_ms': percentile(values, 95) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'max_ms': (values[-1] if values else 0.0) * 1000,
+            # Time the handler kept a worker busy, as updates per second of handler time
+            'updates_per_sec': len(values) / sum(values) if values else 0.0,
+        }
+    return {
+        'total_updates': updates,
+        'elapsed_sec': elapsed,
+        # Includes the warmup updates, which also ran during the timed period
+        'updates_per_sec': (updates + warmup) / elapsed,
+        'handlers': handlers,
+        'bot_api_calls': request.calls,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    print(f"{results['total_updates']} updates in {results['elapsed_sec']:.2f}s "
+          f"({results['updates_per_sec']:.0f} updates/sec)")
+    print(f"{'handler':<10}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'upd/s':>10}")
+    for kind, stats in results['handlers'].items():
+        line = (f"{kind:<10}{stats['count']:>8}{stats['p50_ms']:>10.3f}{stats['p95_ms']:>10.3f}"
+                f"{stats['p99_ms']:>10.3f}{stats['updates_per_sec']:>10.0f}")
+        old = (baseline or {}).get('handlers', {}).get(kind)
+        if old and old['p95_ms']:
+            line += f"   p95 {100 * (stats['p95_ms'] - old['p95_ms']) / old['p95_ms']:+.1f}% vs baseline"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bot.py handlers with synthetic Telegram updates.")
+    parser.add_argument('--updates', type=int, default=10000, help="updates to replay")
+    parser.add_argument('--concurrency', type=int, default=16, help="updates processed at once")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="traffic mix, e.g. start=2,menu=3,function=4,back=1,inline=2")
+    parser.add_argument('--api-latency-ms', type=float, default=0.0, help="simulated Bot API round trip")
+    parser.add_argument('--warmup', type=int, default=200, help="updates replayed before measuring")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    # Handler logging would dominate the measurement
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = asyncio.run(run_benchmark(args.updates, args.concurrency, parse_mix(args.mix),
+                                        args.api_latency_ms / 1000, args.seed, args.warmup))
+    results['meta'] = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'concurrency': args.concurrency,
+        'mix': args.mix,
+        'api_latency_ms': args.api_latency_ms,
+        'storage': os.environ["BOT_STORAGE"],
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"Results saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+# Bot API connection pool benchmark.
+#
+# Runs interactive traffic (users tapping menu buttons: answerCallbackQuery then
+# editMessageText) while a broadcast is sent, against a local fake Bot API server over
+# real HTTP. It runs once with both kinds of traffic on one connection pool and once on
+# separate interactive and bulk pools (telegram_transport.py) of the same total size,
+# and reports throughput and latency per lane. The server runs in its own process, so
+# its work does not slow the client down:
+#
+#   python benchmarks/bench_lanes.py --latency-ms 200 --interactive-pool 16 --bulk-pool 16 --broadcast 1500
+import argparse
+import asyncio
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from telegram import Bot  # noqa: E402
+from telegram.error import TelegramError  # noqa: E402
+
+from fake_telegram import BENCH_USER, FakeBotApiServer  # noqa: E402
+from telegram_transport import BULK_DEFAULTS, INTERACTIVE_DEFAULTS, TransportSettings  # noqa: E402
+
+TOKEN = "123456:BENCHMARK"
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+# Runs in the server process: serves the fake Bot API until terminated
+def serve(latency, connection):
+    async def run():
+        server = FakeBotApiServer(latency=latency)
+        await server.start()
+        connection.send(server.base_url)
+        await asyncio.Event().wait()
+    asyncio.run(run())
+
+
+class Lane:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+
+    async def timed(self, call):
+        started = time.perf_counter()
+        try:
+            await call
+        except TelegramError:
+            self.errors += 1
+            return
+        self.latencies.append(time.perf_counter() - started)
+
+
+async def run_layout(base_url, layout, args):
+    interactive = TransportSettings(pool_size=args.interactive_pool, **{k: v for k, v in INTERACTIVE_DEFAULTS.items()
+                                                                         if k != 'pool_size'})
+    bulk = TransportSettings(pool_size=args.bulk_pool, **{k: v for k, v in BULK_DEFAULTS.items() if k != 'pool_size'})
+    if layout == "shared":
+        # One pool as large as both lanes together, with the interactive timeouts
+        interactive.pool_size = interactive.keepalive_connections = args.interactive_pool + args.bulk_pool
+        interactive_request = bulk_request = interactive.build()
+    else:
+        interactive_request, bulk_request = interactive.build(), bulk.build()
+    interactive_bot = Bot(TOKEN, base_url=base_url, request=interactive_request, get_updates_request=interactive_request)
+    bulk_bot = Bot(TOKEN, base_url=base_url, request=bulk_request, get_updates_request=bulk_request)
+    await interactive_request.initialize()
+    await bulk_request.initialize()
+
+    taps, sends = Lane(), Lane()
+    broadcast_done = asyncio.Event()
+    chat_ids = itertools.count(-1001000000000, -1)
+    remaining = args.broadcast
+
+    async def broadcaster():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            await sends.timed(bulk_bot.send_message(chat_id=next(chat_ids), text="Announcement"))
+
+    async def user(number):
+        chat_id = BENCH_USER["id"] + number
+        while not broadcast_done.is_set():
+            started = time.perf_counter()
+            try:
+                await interactive_bot.answer_callback_query(str(number))
+                await interactive_bot.edit_message_text("Select a function:", chat_id=chat_id, message_id=1)
+            except TelegramError:
+                taps.errors += 1
+            else:
+                taps.latencies.append(time.perf_counter() - started)
+            await asyncio.sleep(args.think_ms / 1000)
+
+    users = [asyncio.create_task(user(number)) for number in range(args.users)]
+    started = time.perf_counter()
+    await asyncio.gather(*(broadcaster() for _ in range(args.bulk_concurrency)))
+    elapsed = time.perf_counter() - started
+    broadcast_done.set()
+    await asyncio.gather(*users)
+
+    await interactive_request.shutdown()
+    await bulk_request.shutdown()
+    return elapsed, {'taps': taps, 'broadcast': sends}
+
+
+def print_layout(layout, elapsed, lanes):
+    print(f"{layout}: broadcast finished in {elapsed:.2f}s")
+    print(f"  {'lane':<10}{'ok':>8}{'errors':>8}{'per sec':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, lane in lanes.items():
+        values = sorted(lane.latencies)
+        print(f"  {name:<10}{len(values):>8}{lane.errors:>8}{len(values) / elapsed:>10.0f}"
+              f"{percentile(values, 50) * 1000:>10.1f}{percentile(values, 95) * 1000:>10.1f}"
+              f"{percentile(values, 99) * 1000:>10.1f}{(values[-1] if values else 0) * 1000:>10.1f}")
+
+
+async def main_async(args, base_url):
+    # Unmeasured first round: connection setup and first-call costs would favor the later layouts
+    warmup = argparse.Namespace(**{**vars(args), 'broadcast': args.warmup, 'users': 0})
+    await run_layout(base_url, "split", warmup)
+    for layout in args.layouts.split(','):
+        elapsed, lanes = await run_layout(base_url, layout.strip(), args)
+        print_layout(layout.strip(), elapsed, lanes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark interactive and bulk Bot API traffic on shared or "
+                                                 "separate connection pools.")
+    parser.add_argument('--latency-ms', type=float, default=200.0, help="simulated Bot API round trip")
+    parser.add_argument('--interactive-pool', type=int, default=16, help="connections for replies to users")
+    parser.add_argument('--bulk-pool', type=int, default=16, help="connections for the broadcast")
+    parser.add_argument('--broadcast', type=int, default=1500, help="messages in the broadcast")
+    parser.add_argument('--bulk-concurrency', type=int, default=30, help="broadcast sends in flight")
+    parser.add_argument('--users', type=int, default=20, help="users tapping buttons during the broadcast")
+    parser.add_argument('--think-ms', type=float, default=100.0, help="pause between one user's taps")
+    parser.add_argument('--warmup', type=int, default=300, help="unmeasured messages sent first")
+    parser.add_argument('--layouts', default="shared,split", help="pool layouts to run, in order")
+    args = parser.parse_args()
+
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    server = multiprocessing.Process(target=serve, args=(args.latency_ms / 1000, sender), daemon=True)
+    server.start()
+    try:
+        asyncio.run(main_async(args, receiver.recv()))
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import asyncio
+import itertools
+import json
+import time
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 1000000001, "is_bot": True, "first_name": "BizDevBot", "username": "bizdev_bench_bot"}
+# A user listed in functions/allowedusers.json, so updates pass the allow list
+BENCH_USER = {"id": 1914418080, "is_bot": False, "first_name": "Bench"}
+
+
+# Bot API transport that answers every method locally instead of calling Telegram.
+# `latency` adds a fixed delay per call to stand in for the network round trip.
+class FakeBotApiRequest(BaseRequest):
+    def __init__(self, latency=0.0):
+        self._latency = latency
+        self._message_ids = itertools.count(1)
+        self.calls = {}
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        params = request_data.parameters if request_data else {}
+        return 200, json.dumps({"ok": True, "result": self._result(api_method, params)}).encode()
+
+    def _result(self, api_method, params):
+        if api_method == "getMe":
+            return BOT_USER
+        if api_method in ("sendMessage", "editMessageText", "sendPhoto", "sendDocument", "sendVideo"):
+            message_id = next(self._message_ids)
+            chat_id = params.get("chat_id", BENCH_USER["id"])
+            message = message_dict(message_id, chat_id, params.get("text", ""), sender=BOT_USER)
+            # Media comes back with the file_id Telegram assigned to the upload
+            file = {"file_id": f"file-{message_id}", "file_unique_id": f"unique-{message_id}"}
+            if api_method == "sendPhoto":
+                message["photo"] = [{**file, "width": 90, "height": 90}, {**file, "width": 1280, "height": 1280}]
+            elif api_method == "sendDocument":
+                message["document"] = file
+            elif api_method == "sendVideo":
+                message["video"] = {**file, "width": 1280, "height": 720, "duration": 10}
+            return message
+        return True
+
+
+# Local HTTP server answering Bot API calls like FakeBotApiRequest, for benchmarks that
+# go through the real HTTP transport (connection pools, keep-alive, timeouts).
+# Bots reach it with base_url=server.base_url.
+class FakeBotApiServer:
+    def __init__(self, latency=0.0, host="127.0.0.1", port=0):
+        self._api = FakeBotApiRequest()
+        self._latency = latency
+        self._host = host
+        self._port = port
+        self._runner = None
+        self.base_url = None
+
+    @property
+    def calls(self):
+        return self._api.calls
+
+    async def start(self):
+        from aiohttp import web
+
+        async def handle(request):
+            api_method = request.match_info["method"]
+            self._api.calls[api_method] = self._api.calls.get(api_method, 0) + 1
+            # Parameters arrive form-encoded; chat IDs are the only non-text ones read back
+            params = dict(await request.post())
+            if params.get("chat_id", "").lstrip("-").isdigit():
+                params["chat_id"] = int(params["chat_id"])
+            if self._latency:
+                await asyncio.sleep(self._latency)
+            return web.json_response({"ok": True, "result": self._api._result(api_method, params)})
+
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self._host, self._port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{self._host}:{port}/bot"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def message_dict(message_id, chat_id, text, sender=BENCH_USER, chat_type="private"):
+    message = {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": chat_type},
+        "from": sender,
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return message
+
+
+# Builders for realistic updates, numbered like Telegram's update_id
+class UpdateFactory:
+    def __init__(self, bot, user=BENCH_USER):
+        self._bot = bot
+        self._user = user
+        self._update_ids = itertools.count(1)
+
+    def command(self, text, chat_id=None):
+        chat_id = chat_id or self._user["id"]
+        update_id = next(self._update_ids)
+        data = {"update_id": update_id, "message": message_dict(update_id, chat_id, text, sender=self._user)}
+        return Update.de_json(data, self._bot)
+
+    def callback(self, callback_data, chat_id=None):
+        chat_id = chat_id or self._user["id"]
+        update_id = next(self._update_ids)
+        data = {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": self._user,
+                "chat_instance": str(chat_id),
+                "data": callback_data,
+                "message": message_dict(update_id, chat_id, "Please choose a category:", sender=BOT_USER),
+            },
+        }
+        return Update.de_json(data, self._bot)
+
+    def inline_query(self, query):
+        update_id = next(self._update_ids)
+        data = {
+            "update_id": update_id,
+            "inline_query": {"id": str(update_id), "from": self._user, "query": query, "offset": ""},
+        }
+        return Update.de_json(data, self._bot)
@@ -1,82 +1,359 @@
-import firebase_admin
-from firebase_admin import credentials, firestore
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram import Bot, ChatMember, InlineQueryResultArticle, InputTextMessageContent, Update
+from telegram.constants import ChatType
+from telegram.ext import (Application, ApplicationHandlerStop, ChatMemberHandler, CommandHandler,
+                          CallbackQueryHandler, ContextTypes, InlineQueryHandler, MessageHandler, TypeHandler,
+                          filters)
 from dotenv import load_dotenv
+from access_control import AllowList, NEGATIVE_CACHE_SECONDS
+from catalog_cache import CatalogCache, DEFAULT_TTL_SECONDS
+from db_executor import run_blocking
+from menu_keyboards import MenuKeyboards, BACK_PREFIX, CATEGORY_PREFIX, FUNCTION_PREFIX
+from catalog_search import CatalogSearchIndex
+from user_state import UserStateStore, DEFAULT_STATE_TTL_SECONDS
+from group_registry import GroupRegistry
+from write_behind import DEFAULT_FLUSH_SECONDS
+from inbound_throttle import (InboundThrottle, DEFAULT_CHAT_BURST, DEFAULT_CHAT_RATE, DEFAULT_INLINE_BURST,
+                              DEFAULT_INLINE_RATE, DEFAULT_REPEAT_WINDOW_SECONDS, DEFAULT_USER_BURST,
+                              DEFAULT_USER_RATE)
+from media_responses import DEFAULT_MEDIA_DIR, MediaSender, is_media, parse_mode_of
+from usage_stats import (UsageStats, DEFAULT_COUNTER_SHARDS, DEFAULT_FLUSH_SECONDS as DEFAULT_USAGE_FLUSH_SECONDS,
+                         DEFAULT_HALF_LIFE_DAYS, DEFAULT_RELOAD_SECONDS)
+import db_executor
+from broadcast import (BroadcastEngine, MESSAGE_FREQUENCY_WINDOW_MS, get_last_broadcast_time,
+                       set_last_broadcast_time)
+from broadcast_outbox import BroadcastOutbox, FirestoreOutboxMirror, run_job
+from broadcast_schedule import (BroadcastScheduler, DEFAULT_COALESCE_SECONDS, DEFAULT_MISFIRE_GRACE_SECONDS,
+                                DEFAULT_SPREAD_SECONDS, DEFAULT_TIMEZONE, distinct_messages, parse_schedule)
+from telegram_transport import BULK_DEFAULTS, BULK_PREFIX, INTERACTIVE_DEFAULTS, INTERACTIVE_PREFIX, TransportSettings
+from webhook_server import DEFAULT_DEDUP_SIZE, serve_webhook
+from worker_pool import DEFAULT_BROKER_URL, SYNC_TOPIC, Broker, Dispatcher, run_worker
+from storage import FirestoreStorage, open_storage
+from metrics import InstrumentedRequest, InstrumentedStorage, MetricsServer, instrument_handler, measure_update
+from log_pipeline import setup_logging
 import os
+import asyncio
 import logging
-
-# Set up logging
-logging.basicConfig(level=logging.INFO)
+import socket
+import sys
+import time
+from datetime import datetime
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Get the Telegram API token and Firebase key path from the environment
+# Set up logging: JSON records written by a background thread, sampled and rate-capped
+# per event type (see log_pipeline.py and the LOG_* variables)
+setup_logging()
+
+# Get the Telegram API token from the environment. The storage backend is picked by
+# BOT_STORAGE (firestore, sqlite or memory); Firestore uses FIREBASE_KEY_PATH.
 TELEGRAM_API_TOKEN = os.getenv("TELEGRAM_API_TOKEN")
-FIREBASE_KEY_PATH = os.getenv("FIREBASE_KEY_PATH")
+CATALOG_TTL_SECONDS = int(os.getenv("CATALOG_TTL_SECONDS", DEFAULT_TTL_SECONDS))
+AUTH_NEGATIVE_CACHE_SECONDS = int(os.getenv("AUTH_NEGATIVE_CACHE_SECONDS", NEGATIVE_CACHE_SECONDS))
+
+# Catalog and allow list saved by the last run, used to answer the first updates after a
+# restart while storage is read in the background; empty turns warm starts off
+SNAPSHOT_DIR = os.getenv("BOT_SNAPSHOT_DIR", "bot_snapshot") or None
+
+# Conversation state kept in memory: idle time before eviction and write-behind interval
+USER_STATE_TTL_SECONDS = int(os.getenv("USER_STATE_TTL_SECONDS", DEFAULT_STATE_TTL_SECONDS))
+USER_STATE_FLUSH_SECONDS = float(os.getenv("USER_STATE_FLUSH_SECONDS", DEFAULT_FLUSH_SECONDS))
+# How often group membership changes are written to storage in one batch
+GROUPS_FLUSH_SECONDS = float(os.getenv("GROUPS_FLUSH_SECONDS", DEFAULT_FLUSH_SECONDS))
+
+# Directory holding the files named by the `media` field of catalog entries
+MEDIA_DIR = os.getenv("BOT_MEDIA_DIR", DEFAULT_MEDIA_DIR)
+
+# Usage statistics: taps are counted in memory and added to storage every
+# USAGE_FLUSH_SECONDS, spread over USAGE_COUNTER_SHARDS documents per menu entry.
+# MENU_ORDER=popular orders menu buttons by taps decayed with a half-life of
+# USAGE_HALF_LIFE_DAYS, re-read from storage every USAGE_RELOAD_SECONDS.
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", DEFAULT_USAGE_FLUSH_SECONDS))
+USAGE_COUNTER_SHARDS = int(os.getenv("USAGE_COUNTER_SHARDS", DEFAULT_COUNTER_SHARDS))
+USAGE_HALF_LIFE_DAYS = float(os.getenv("USAGE_HALF_LIFE_DAYS", DEFAULT_HALF_LIFE_DAYS))
+USAGE_RELOAD_SECONDS = float(os.getenv("USAGE_RELOAD_SECONDS", DEFAULT_RELOAD_SECONDS))
+POPULAR_MENU_ORDER = os.getenv("MENU_ORDER", "catalog").strip().lower() == "popular"
+
+# How long Telegram may cache the results of an inline query
+INLINE_CACHE_SECONDS = int(os.getenv("INLINE_CACHE_SECONDS", "300"))
+
+# Inbound rate limits: tokens per second and burst size per user, for inline queries per
+# user and per group chat, and the window in which repeated taps on one button count
+# once (0 turns each off)
+THROTTLE_USER_RATE = float(os.getenv("THROTTLE_USER_RATE", DEFAULT_USER_RATE))
+THROTTLE_USER_BURST = int(os.getenv("THROTTLE_USER_BURST", DEFAULT_USER_BURST))
+THROTTLE_INLINE_RATE = float(os.getenv("THROTTLE_INLINE_RATE", DEFAULT_INLINE_RATE))
+THROTTLE_INLINE_BURST = int(os.getenv("THROTTLE_INLINE_BURST", DEFAULT_INLINE_BURST))
+THROTTLE_CHAT_RATE = float(os.getenv("THROTTLE_CHAT_RATE", DEFAULT_CHAT_RATE))
+THROTTLE_CHAT_BURST = int(os.getenv("THROTTLE_CHAT_BURST", DEFAULT_CHAT_BURST))
+THROTTLE_REPEAT_SECONDS = float(os.getenv("THROTTLE_REPEAT_SECONDS", DEFAULT_REPEAT_WINDOW_SECONDS))
+
+# Connection pools to the Bot API: one for replies to users and one for broadcasts, each
+# configured by TELEGRAM_* and TELEGRAM_BULK_* (pool size, keep-alive, HTTP/2, timeouts)
+INTERACTIVE_TRANSPORT = TransportSettings.from_env(INTERACTIVE_PREFIX, INTERACTIVE_DEFAULTS)
+BULK_TRANSPORT = TransportSettings.from_env(BULK_PREFIX, BULK_DEFAULTS)
+
+# Process updates concurrently: "true" uses python-telegram-bot's default limit,
+# a number sets the maximum, anything else keeps updates sequential
+CONCURRENT_UPDATES = os.getenv("CONCURRENT_UPDATES", "false").strip().lower()
+
+# "polling" (default) or "webhook" to receive updates through the embedded HTTP server
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_DEDUP_SIZE = int(os.getenv("WEBHOOK_DEDUP_SIZE", DEFAULT_DEDUP_SIZE))
+
+# Multi-worker mode: with BOT_WORKERS above 1 this process is a dispatcher that receives
+# the updates and hands each chat to one of BOT_WORKERS worker processes through the
+# broker at BOT_BROKER_URL. The first BOT_LOCAL_WORKERS of them (default all) are started
+# here; the others run elsewhere with BOT_WORKER_SHARD set to their number.
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+BOT_LOCAL_WORKERS = int(os.getenv("BOT_LOCAL_WORKERS", BOT_WORKERS))
+WORKER_SHARD = int(os.getenv("BOT_WORKER_SHARD", "-1"))
+BROKER_URL = os.getenv("BOT_BROKER_URL", DEFAULT_BROKER_URL)
+BROKER_TOKEN = os.getenv("BOT_BROKER_TOKEN") or None
+# The single process, or worker 0, runs the storage listeners and the scheduled broadcasts
+IS_PRIMARY = WORKER_SHARD <= 0
+
+# Broadcast journal used to resume interrupted broadcasts, optionally mirrored to Firestore
+BROADCAST_OUTBOX_PATH = os.getenv("BROADCAST_OUTBOX_PATH", "broadcast_outbox.db")
+BROADCAST_OUTBOX_FIRESTORE = os.getenv("BROADCAST_OUTBOX_FIRESTORE", "false").strip().lower() == "true"
+
+# Scheduled broadcasts: time zone of their dates and cron expressions, how close together
+# jobs must fall to go out in one pass, how long a pass's sends are spread over, and how
+# late a missed recurring run may still be sent
+SCHEDULE_TIMEZONE = os.getenv("SCHEDULE_TIMEZONE", DEFAULT_TIMEZONE)
+SCHEDULE_COALESCE_SECONDS = float(os.getenv("SCHEDULE_COALESCE_SECONDS", DEFAULT_COALESCE_SECONDS))
+SCHEDULE_SPREAD_SECONDS = float(os.getenv("SCHEDULE_SPREAD_SECONDS", DEFAULT_SPREAD_SECONDS))
+SCHEDULE_MISFIRE_GRACE_SECONDS = float(os.getenv("SCHEDULE_MISFIRE_GRACE_SECONDS", DEFAULT_MISFIRE_GRACE_SECONDS))
+
+# Prometheus metrics are served on METRICS_HOST:METRICS_PORT/metrics; port 0 turns them off
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+
+# Open the storage backend selected by BOT_STORAGE, timing calls and counting document reads
+backend = open_storage()
+storage = InstrumentedStorage(backend)
+
+# The menu catalog is loaded once at startup and kept current through snapshot listeners;
+# workers other than the primary are kept current by the catalogs it shares instead
+catalog = CatalogCache(storage, ttl=CATALOG_TTL_SECONDS, snapshot_dir=SNAPSHOT_DIR, shared=not IS_PRIMARY)
+
+# Taps on categories and functions, counted in memory and flushed to storage in batches
+usage = UsageStats(storage, flush_interval=USAGE_FLUSH_SECONDS, shards=USAGE_COUNTER_SHARDS,
+                   half_life_days=USAGE_HALF_LIFE_DAYS,
+                   reload_interval=USAGE_RELOAD_SECONDS if POPULAR_MENU_ORDER else None)
+keyboards = MenuKeyboards(catalog, popularity=usage if POPULAR_MENU_ORDER else None)
+
+# Search index over the catalog for inline queries, following catalog changes
+search_index = CatalogSearchIndex(catalog)
+
+# Per-user conversation state (waitingForBroadcastMessage), written back to storage in batches
+user_states = UserStateStore(storage, ttl=USER_STATE_TTL_SECONDS, flush_interval=USER_STATE_FLUSH_SECONDS)
+
+# Groups the bot is in, tracked from my_chat_member updates and used as broadcast targets
+group_registry = GroupRegistry(storage, flush_interval=GROUPS_FLUSH_SECONDS)
+
+# Photo, document and video responses, each file uploaded once and then sent by file_id
+media = MediaSender(storage, MEDIA_DIR)
 
-# Initialize Firebase using the path from the environment variable
-cred = credentials.Certificate(FIREBASE_KEY_PATH)
-firebase_admin.initialize_app(cred)
-db = firestore.client()
+# Users allowed to use the bot, kept in memory and current through a snapshot listener
+allow_list = AllowList(storage, negative_ttl=AUTH_NEGATIVE_CACHE_SECONDS, snapshot_dir=SNAPSHOT_DIR)
 
-# Function to test Firestore connection
+# Per-user and per-chat token buckets applied before authorization and any storage read
+inbound_throttle = InboundThrottle(THROTTLE_USER_RATE, THROTTLE_USER_BURST, THROTTLE_CHAT_RATE, THROTTLE_CHAT_BURST,
+                                   THROTTLE_REPEAT_SECONDS, THROTTLE_INLINE_RATE, THROTTLE_INLINE_BURST)
+
+# The journal can only be mirrored when the bot itself runs on Firestore
+outbox_mirror = None
+if BROADCAST_OUTBOX_FIRESTORE and isinstance(backend, FirestoreStorage):
+    outbox_mirror = FirestoreOutboxMirror(backend)
+# Jobs are leased to the process running them; any worker resumes those whose owner stopped
+outbox = BroadcastOutbox(BROADCAST_OUTBOX_PATH, outbox_mirror,
+                         owner=f"{max(WORKER_SHARD, 0)}@{socket.gethostname()}:{os.getpid()}")
+
+# Scheduled broadcasts, kept by every worker and run by the primary through its JobQueue
+scheduler = BroadcastScheduler(storage, lambda context, jobs: run_scheduled_broadcasts(context.application, jobs),
+                               tz=SCHEDULE_TIMEZONE, coalesce_window=SCHEDULE_COALESCE_SECONDS,
+                               misfire_grace=SCHEDULE_MISFIRE_GRACE_SECONDS,
+                               min_interval=MESSAGE_FREQUENCY_WINDOW_MS / 1000)
+
+# Tasks started before the Application is running, kept referenced until they finish
+background_tasks = set()
+
+metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT)
+
+# Function to run a coroutine in the background from startup, before the Application runs
+def start_background_task(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+# Function to connect to storage, load the catalog and allow list and start their listeners
+async def load_live_data():
+    await run_blocking(storage.connect)
+    await run_blocking(catalog.load)
+    await run_blocking(catalog.start_listeners)
+    await run_blocking(allow_list.load)
+    if IS_PRIMARY:
+        await run_blocking(allow_list.start_listener)
+    await group_registry.load()
+    await scheduler.load()
+    await run_blocking(media.load)
+    if POPULAR_MENU_ORDER:
+        await usage.load()
+
+# Delays between attempts to load live data after a warm start, doubling up to the maximum
+LIVE_DATA_RETRY_SECONDS = 5.0
+MAX_LIVE_DATA_RETRY_SECONDS = 300.0
+
+# Function to finish a warm start; until it succeeds the snapshot is served. A failed
+# load is retried with backoff, so the listeners and scheduled broadcasts still start.
+async def refresh_in_background():
+    delay = LIVE_DATA_RETRY_SECONDS
+    while True:
+        try:
+            await load_live_data()
+            return
+        except Exception as e:
+            logging.error("Failed to load live data after a warm start, retrying in %.0fs: %s", delay, e)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, MAX_LIVE_DATA_RETRY_SECONDS)
+
+# Function to prepare the bot before polling starts. With a snapshot from the last run
+# the first updates are answered from it and storage is read in the background;
+# otherwise the catalog is loaded off the event loop first.
+async def on_startup(application: Application):
+    if METRICS_PORT:
+        await metrics_server.start()
+
+    # Small local JSON files, read directly while nothing else is running yet
+    if catalog.load_snapshot():
+        allow_list.load_snapshot()
+        start_background_task(refresh_in_background())
+    else:
+        await load_live_data()
+
+    user_states.start()
+    group_registry.start()
+    usage.start()
+
+    # One broadcast engine per bot, so its rate-limit buckets persist across broadcasts.
+    # It sends through the bulk connection pool, leaving the interactive one to replies.
+    # Only its transport is opened: Bot.initialize() would add a getMe call to startup.
+    bulk_bot = application.bot_data['bulk_bot']
+    await bulk_bot.request.initialize()
+    application.bot_data['broadcaster'] = BroadcastEngine(bulk_bot)
+
+    # Resume broadcasts interrupted by a crash or redeploy, now and whenever a job's
+    # owner stops renewing its lease
+    application.bot_data['resume_task'] = asyncio.create_task(resume_broadcasts(application))
+    if IS_PRIMARY:
+        scheduler.start(application.job_queue)
+
+async def on_shutdown(application: Application):
+    for task in list(background_tasks):
+        task.cancel()
+    scheduler.stop()
+    resume_task = application.bot_data.get('resume_task')
+    if resume_task is not None:
+        resume_task.cancel()
+    await metrics_server.stop()
+    await application.bot_data['bulk_bot'].request.shutdown()
+    await user_states.stop()
+    await group_registry.stop()
+    await usage.stop()
+    catalog.stop_listeners()
+    allow_list.stop_listener()
+    outbox.close()
+    storage.close()
+    db_executor.shutdown()
+
+# Function to turn CONCURRENT_UPDATES into the value expected by the Application builder
+def concurrent_updates_setting(value):
+    if value in ("true", "yes", "on"):
+        return True
+    if value.isdigit() and int(value) > 1:
+        return int(value)
+    return False
+
+# Function to drop updates over the sender's or chat's rate and repeated button taps.
+# Dropped taps and inline queries still get an answer, so the client stops showing its
+# loading spinner; the empty inline answer is not cached, so the next query is asked again.
+async def throttle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    reason = inbound_throttle.check(update)
+    if reason is None:
+        return
+    logging.info("Update throttled: %s", reason,
+                 extra={'event': 'throttled', 'reason': reason, 'user_id': update.effective_user.id})
+    if update.callback_query:
+        await update.callback_query.answer(None if reason == 'repeat' else "Too many requests, please slow down.")
+    elif update.inline_query:
+        await update.inline_query.answer([], cache_time=0)
+    raise ApplicationHandlerStop
+
+# Function to stop updates from users who are not in `allowedusers` before any handler runs
+async def authorize(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    # Membership updates and group service messages come from whoever adds or removes the
+    # bot or renames the group, and must always pass
+    if user is None or update.my_chat_member or update.chat_member:
+        return
+    if update.message and (update.message.new_chat_title or update.message.migrate_to_chat_id):
+        return
+
+    allowed = allow_list.check_cached(user.id)
+    if allowed is None:
+        allowed = await run_blocking(allow_list.fetch, user.id)
+    if allowed:
+        return
+
+    allow_list.record_denied()
+    logging.info("User ID: %s is not authorized.", user.id, extra={'event': 'unauthorized', 'user_id': user.id})
+    if update.callback_query:
+        await update.callback_query.answer("You are not authorized to use this bot.")
+    raise ApplicationHandlerStop
+
+# Function to test the storage connection
 async def test_firestore_connection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        collections = db.collections()
-        collection_names = [collection.id for collection in collections]
-        await update.message.reply_text(f"Connected to Firestore! Collections: {', '.join(collection_names)}")
+        await update.message.reply_text(await run_blocking(storage.describe))
     except Exception as e:
-        await update.message.reply_text(f"Error connecting to Firestore: {e}")
+        await update.message.reply_text(f"Error connecting to {storage.name} storage: {e}")
+
+# Function to send the prebuilt main menu as a reply to a message
+async def send_main_menu(message):
+    await catalog.ensure_fresh()
+    reply_markup = keyboards.main_menu()
+    if reply_markup:
+        await message.reply_text('Please choose a category:', reply_markup=reply_markup)
+    else:
+        await message.reply_text('No categories found.')
 
 # Function to display the main menu
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logging.info("Received /start command")
-    logging.info("Fetching categories from Firestore...")
-    
-    # Fetch categories from Firestore
-    categories_ref = db.collection('categories')
-    categories = [cat.id for cat in categories_ref.stream()]
-    
-    logging.info(f"Fetched categories: {categories}")
-    
-    if categories:
-        keyboard = []
-        for i in range(0, len(categories), 2):  # Create rows with 2 buttons each
-            row = [InlineKeyboardButton(categories[i], callback_data=categories[i])]
-            if i + 1 < len(categories):
-                row.append(InlineKeyboardButton(categories[i + 1], callback_data=categories[i + 1]))
-            keyboard.append(row)
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text('Please choose a category:', reply_markup=reply_markup)
-    else:
-        await update.message.reply_text('No categories found.')
+    logging.info("Received /start command", extra={'event': 'start'})
+    await send_main_menu(update.message)
 
 # Function to handle category selection and show submenu
 async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    logging.info(f"Fetching functions for category: {query.data}")
-
-    # Fetch the selected category's functions
-    category_ref = db.collection('categories').document(query.data)
-    functions_ref = category_ref.collection('functions')
-    functions = [func.id for func in functions_ref.stream()]
-
-    logging.info(f"Functions fetched for category {query.data}: {functions}")
-
-    # Show the submenu
-    if functions:
-        keyboard = []
-        for i in range(0, len(functions), 2):  # Create rows with 2 buttons each
-            row = [InlineKeyboardButton(functions[i], callback_data=query.data + '|' + functions[i])]
-            if i + 1 < len(functions):
-                row.append(InlineKeyboardButton(functions[i + 1], callback_data=query.data + '|' + functions[i + 1]))
-            keyboard.append(row)
-        keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    # Show the prebuilt submenu for the selected category
+    await catalog.ensure_fresh()
+    category = keyboards.resolve(query.data)
+    if category is None:
+        await query.edit_message_text(text="This menu is out of date. Please use /start again.")
+        return
+
+    logging.info("Showing functions for category: %s", category, extra={'event': 'menu', 'category': category})
+    usage.record(category)
+    reply_markup = keyboards.submenu(query.data)
+    if reply_markup:
         await query.edit_message_text(text="Select a function:", reply_markup=reply_markup)
     else:
         await query.edit_message_text(text="No functions found for this category.")
@@ -85,7 +362,7 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def back_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await start(query, context)  # Pass the query instead of update to maintain context
+    await send_main_menu(query.message)
 
 # Function to handle function selection and respond with preconfigured answer
 async def function_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -93,41 +370,361 @@ async def function_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
 
     try:
-        logging.info(f"Callback data: {query.data}")
-
-        # Split the callback data into category and function
-        category, function = query.data.split('|')
-        logging.info(f"Category: {category}, Function: {function}")
-
-        # Fetch the document from Firestore
-        function_ref = db.collection('categories').document(category).collection('functions').document(function)
-        function_doc = function_ref.get()
+        # Resolve the callback token to the cached function document
+        await catalog.ensure_fresh()
+        entry = keyboards.resolve(query.data)
 
         # Check if the document exists and has the response field
-        if function_doc.exists:
-            response = function_doc.to_dict().get('response')
-            if response:
-                logging.info(f"Response found: {response}")
-                await query.edit_message_text(text=response)
+        if entry is not None:
+            category, function, function_data = entry
+            usage.record(category, function)
+            response = function_data.get('response')
+            if is_media(function_data):
+                # Media can't replace the menu message, so it is sent below it with the response as caption
+                logging.info("Media response for %s/%s", category, function,
+                             extra={'event': 'function_response', 'category': category, 'function': function,
+                                    'type': function_data['type'], 'media': function_data['media']})
+                await media.send(context.bot, query.message.chat_id, function_data)
+            elif response:
+                # The response itself is only written truncated with a hash, see log_pipeline.shorten
+                logging.info("Response found for %s/%s", category, function,
+                             extra={'event': 'function_response', 'category': category, 'function': function,
+                                    'response': response})
+                await query.edit_message_text(text=response, parse_mode=parse_mode_of(function_data))
             else:
-                logging.error("No response field found.")
+                logging.error("No response field found.",
+                              extra={'event': 'function_missing', 'category': category, 'function': function})
                 await query.edit_message_text(text="No response field found.")
         else:
-            logging.error("Function document not found.")
+            logging.error("Function document not found.", extra={'event': 'function_missing', 'token': query.data})
             await query.edit_message_text(text="Function document not found.")
 
     except Exception as e:
-        logging.error(f"An error occurred: {e}")
+        logging.error("An error occurred: %s", e, extra={'event': 'function_error'})
         await query.edit_message_text(text=f"An error occurred: {e}")
 
-# Register the handlers
-application = Application.builder().token(TELEGRAM_API_TOKEN).build()
+# Function to record the bot being added to, promoted in or removed from a group
+async def my_chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    if chat.type == ChatType.PRIVATE:
+        return
+    member = update.my_chat_member.new_chat_member
+    is_admin = member.status in (ChatMember.ADMINISTRATOR, ChatMember.OWNER)
+    is_member = is_admin or member.status == ChatMember.MEMBER or (
+        member.status == ChatMember.RESTRICTED and member.is_member)
+    group_registry.set_membership(chat.id, chat.title, is_member, is_admin)
+    logging.info("Bot %s group: %s", "added to" if is_member else "removed from", chat.id,
+                 extra={'event': 'group_membership', 'chat_id': chat.id, 'status': member.status})
+
+# Function to follow group renames and upgrades to supergroups
+async def group_update_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    if message.migrate_to_chat_id:
+        group_registry.migrate(message.chat.id, message.migrate_to_chat_id)
+    elif message.new_chat_title:
+        group_registry.rename(message.chat.id, message.new_chat_title)
+
+# Function to answer inline queries (@bot faucet) with the matching canned responses
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.inline_query
+    await catalog.ensure_fresh()
+    results = []
+    for match in search_index.search(query.query, limit=20):
+        response = match.data.get('response')
+        if not response:
+            continue
+        results.append(InlineQueryResultArticle(
+            id=match.id,
+            title=match.function,
+            description=f"{match.category}: {' '.join(response.split())[:100]}",
+            input_message_content=InputTextMessageContent(response, parse_mode=parse_mode_of(match.data)),
+        ))
+    # Cached per user, so Telegram never shows the results to users the allow list rejects
+    await query.answer(results, cache_time=INLINE_CACHE_SECONDS, is_personal=True)
+
+# Function to broadcast a message to every group where the bot is an admin.
+# Usage (private chat only): /broadcast <message>, or /broadcast and then the message
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.type != "private":
+        await update.message.reply_text("Broadcast messages can only be sent in direct messages.")
+        return
+
+    message = update.message.text.partition(' ')[2].strip()
+    if not message:
+        user_states.update(update.effective_user.id, waitingForBroadcastMessage=True)
+        await update.message.reply_text("Please type the message you want to broadcast:")
+        return
+    await start_broadcast(update, context, message)
+
+# Function to handle plain text in private chats: the message a user was asked to broadcast
+async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    state = await user_states.get(user_id)
+    if not state.get('waitingForBroadcastMessage'):
+        await update.message.reply_text("Use /start to see the main menu or /broadcast to send a message.")
+        return
+    user_states.update(user_id, waitingForBroadcastMessage=False)
+    await start_broadcast(update, context, update.message.text)
+
+# Function to check the frequency limit and start a journaled broadcast of `message`
+async def start_broadcast(update, context, message):
+    last_broadcast_time = await run_blocking(get_last_broadcast_time, storage)
+    if time.time() * 1000 - last_broadcast_time < MESSAGE_FREQUENCY_WINDOW_MS:
+        await update.message.reply_text("Broadcast message blocked: Message frequency limit exceeded. Try again later.")
+        return
+
+    await group_registry.ensure_loaded()
+    group_ids = group_registry.admin_group_ids()
+    if not group_ids:
+        await update.message.reply_text("No groups found where the bot is an admin.")
+        return
+
+    await run_blocking(set_last_broadcast_time, storage, int(time.time() * 1000))
+    job_id = await run_blocking(outbox.create_job, message, group_ids, update.effective_chat.id)
+    await update.message.reply_text(f"Broadcasting to {len(group_ids)} groups...")
+    # Send in the background so other updates are not held up while the broadcast runs
+    context.application.create_task(run_broadcast(context.application, job_id))
+
+# Function to take over the broadcasts whose lease ran out, once per lease period. The
+# outbox is local SQLite, so this costs no storage reads.
+async def resume_broadcasts(application):
+    while True:
+        try:
+            for job_id in await run_blocking(outbox.take_expired_jobs):
+                logging.info("Resuming broadcast %s", job_id, extra={'event': 'broadcast_resumed', 'job_id': job_id})
+                start_background_task(run_broadcast(application, job_id))
+        except Exception as e:
+            logging.error("Failed to check for interrupted broadcasts: %s", e)
+        await asyncio.sleep(outbox.lease_seconds)
+
+# Function to run a journaled broadcast and report the result to whoever requested it
+async def run_broadcast(application, job_id):
+    job = await run_blocking(outbox.get_job, job_id)
+    try:
+        report = await run_job(application.bot_data['broadcaster'], outbox, job_id)
+        if report is None:
+            return  # taken over by another process, which reports instead
+        text = report.summary()
+    except Exception as e:
+        logging.error("Error in broadcast operation: %s", e, extra={'event': 'broadcast_error', 'job_id': job_id})
+        text = "An error occurred during the broadcast operation."
+    if job['requester_chat_id']:
+        await application.bot.send_message(chat_id=job['requester_chat_id'], text=text)
+
+# Function to schedule a broadcast to the admin groups, once or on a cron schedule.
+# Usage (private chat only): /schedule 2026-11-02T09:00 <message>,
+# /schedule cron 0 9 * * 1 <message> or /schedule @daily <message>
+async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.type != "private":
+        await update.message.reply_text("Broadcasts can only be scheduled in direct messages.")
+        return
+
+    try:
+        cron, next_run, message = parse_schedule(update.message.text.partition(' ')[2], scheduler.tz)
+    except ValueError as e:
+        await update.message.reply_text(
+            f"Could not schedule the broadcast: {e}\n"
+            "Usage: /schedule 2026-11-02T09:00 <message>, /schedule cron 0 9 * * 1 <message> "
+            "or /schedule @daily <message>")
+        return
+    job_id = await scheduler.add(message, next_run, cron=cron, requester_chat_id=update.effective_chat.id)
+    logging.info("Broadcast %s scheduled", job_id, extra={'event': 'broadcast_scheduled', 'job_id': job_id,
+                                                         'cron': cron})
+    await update.message.reply_text(f"Broadcast {job_id} scheduled{f' ({cron})' if cron else ''}, "
+                                    f"next run {format_schedule_time(next_run)}.")
+
+# Function to list the scheduled broadcasts, the next to run first
+async def schedules_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    jobs = scheduler.jobs()
+    if not jobs:
+        await update.message.reply_text("No broadcasts are scheduled.")
+        return
+    lines = [f"{job_id}  {format_schedule_time(fields['next_run'])}  {fields.get('cron') or 'once'}\n"
+             f"{fields['text'][:80]}" for job_id, fields in jobs]
+    await update.message.reply_text("Scheduled broadcasts:\n\n" + "\n\n".join(lines))
+
+# Function to cancel a scheduled broadcast. Usage: /unschedule <id>
+async def unschedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    job_id = update.message.text.partition(' ')[2].strip()
+    if job_id and await scheduler.remove(job_id):
+        await update.message.reply_text(f"Broadcast {job_id} unscheduled.")
+    else:
+        await update.message.reply_text("No scheduled broadcast with that ID. Use /schedules to list them.")
+
+def format_schedule_time(timestamp):
+    return datetime.fromtimestamp(timestamp, scheduler.tz).strftime("%Y-%m-%d %H:%M %Z")
+
+# Function to send the scheduled broadcasts that fell due together: one message per group
+# for each distinct text, with the sends spread over SCHEDULE_SPREAD_SECONDS. Every requester
+# gets the report.
+async def run_scheduled_broadcasts(application, jobs):
+    requesters = {job['requester_chat_id'] for job in jobs if job.get('requester_chat_id')}
+    await group_registry.ensure_loaded()
+    group_ids = group_registry.admin_group_ids()
+    reports = []
+    if group_ids:
+        for text in distinct_messages([job['text'] for job in jobs]):
+            job_id = await run_blocking(outbox.create_job, text, group_ids)
+            try:
+                report = await run_job(application.bot_data['broadcaster'], outbox, job_id,
+                                       spread=SCHEDULE_SPREAD_SECONDS)
+                if report is not None:
+                    reports.append(report.summary())
+            except Exception as e:
+                logging.error("Error in scheduled broadcast: %s", e,
+                              extra={'event': 'broadcast_error', 'job_id': job_id})
+                reports.append("An error occurred during the broadcast operation.")
+    else:
+        reports.append("No groups found where the bot is an admin.")
+    for chat_id in requesters:
+        await application.bot.send_message(chat_id=chat_id, text="Scheduled broadcast:\n" + "\n\n".join(reports))
+
+# Callback data starts with a one-byte prefix naming the handler it belongs to
+CALLBACK_ROUTES = {
+    BACK_PREFIX: instrument_handler('back', back_handler),
+    CATEGORY_PREFIX: instrument_handler('menu', menu_handler),
+    FUNCTION_PREFIX: instrument_handler('function', function_handler),
+}
+
+# Function to dispatch a button press on its callback prefix
+async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    handler = CALLBACK_ROUTES.get((query.data or '')[:1])
+    if handler is None:
+        await query.answer("This menu is out of date. Please use /start again.")
+        return
+    await handler(update, context)
+
+# Application that records the latency and storage reads of every update it processes
+class MeasuredApplication(Application):
+    async def process_update(self, update):
+        return await measure_update(super().process_update, update)
+
+# Function to build the Application and register the handlers. `request` and `bulk_request`
+# replace the HTTP transports to the Bot API, e.g. with stubs in benchmarks; a `request`
+# given alone is used for both.
+def build_application(token=TELEGRAM_API_TOKEN, request=None, bulk_request=None):
+    bulk_request = bulk_request or request or BULK_TRANSPORT.build()
+    request = InstrumentedRequest(request or INTERACTIVE_TRANSPORT.build())
+    application = (
+        Application.builder()
+        .application_class(MeasuredApplication)
+        .token(token)
+        .request(request)
+        .concurrent_updates(concurrent_updates_setting(CONCURRENT_UPDATES))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+
+    application.bot_data['bulk_bot'] = Bot(token, request=InstrumentedRequest(bulk_request, lane='bulk'),
+                                           get_updates_request=bulk_request)
+
+    # Run before every other handler: first the rate limits, then the allow list
+    application.add_handler(TypeHandler(Update, instrument_handler('throttle', throttle)), group=-2)
+    application.add_handler(TypeHandler(Update, instrument_handler('authorize', authorize)), group=-1)
+    application.add_handler(CommandHandler('start', instrument_handler('start', start)))
+    application.add_handler(CommandHandler('testdb', instrument_handler('testdb', test_firestore_connection)))
+    application.add_handler(CommandHandler('broadcast', instrument_handler('broadcast', broadcast_command)))
+    application.add_handler(CommandHandler('schedule', instrument_handler('schedule', schedule_command)))
+    application.add_handler(CommandHandler('schedules', instrument_handler('schedules', schedules_command)))
+    application.add_handler(CommandHandler('unschedule', instrument_handler('unschedule', unschedule_command)))
+    application.add_handler(CallbackQueryHandler(callback_router))  # Handles all menu buttons
+    application.add_handler(InlineQueryHandler(instrument_handler('inline', inline_query_handler)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE,
+                                           instrument_handler('text', text_message_handler)))
+    application.add_handler(ChatMemberHandler(instrument_handler('my_chat_member', my_chat_member_handler),
+                                              ChatMemberHandler.MY_CHAT_MEMBER))
+    application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_TITLE | filters.StatusUpdate.MIGRATE,
+                                           instrument_handler('group_update', group_update_handler)))
+    return application
 
-application.add_handler(CommandHandler('start', start))
-application.add_handler(CommandHandler('testdb', test_firestore_connection))
-application.add_handler(CallbackQueryHandler(back_handler, pattern="^back$"))  # Handles "Back" button
-application.add_handler(CallbackQueryHandler(menu_handler, pattern="^[^|]+$"))  # Handles category selection
-application.add_handler(CallbackQueryHandler(function_handler, pattern="^[^|]+\|.+$"))  # Handles function selection
+# Function to build the dispatcher of the multi-worker mode, which only forwards updates
+def build_dispatcher(token=TELEGRAM_API_TOKEN, request=None):
+    broker = Broker(BROKER_URL, BROKER_TOKEN)
+    dispatcher = Dispatcher(broker, BOT_WORKERS, range(min(BOT_LOCAL_WORKERS, BOT_WORKERS)),
+                            [sys.executable, os.path.abspath(__file__)], worker_env)
+
+    async def start_dispatcher(application):
+        await dispatcher.start()
+        if METRICS_PORT:
+            await metrics_server.start()
+
+    async def stop_dispatcher(application):
+        await metrics_server.stop()
+        await dispatcher.stop()
+
+    request = InstrumentedRequest(request or INTERACTIVE_TRANSPORT.build())
+    application = (
+        Application.builder()
+        .token(token)
+        .request(request)
+        .post_init(start_dispatcher)
+        .post_shutdown(stop_dispatcher)
+        .build()
+    )
+    application.add_handler(TypeHandler(Update, dispatcher.forward))
+    return application
+
+# Function to get the environment of a worker process started by the dispatcher
+def worker_env(shard):
+    return {
+        "BOT_WORKER_SHARD": str(shard),
+        "BOT_WORKERS": str(BOT_WORKERS),
+        # Each worker serves its own metrics, on the ports after the dispatcher's
+        "METRICS_PORT": str(METRICS_PORT + 1 + shard if METRICS_PORT else 0),
+    }
+
+# Function to publish changes to the shared in-memory data to the other workers. Only
+# the primary reads the catalog and allow list from listeners; every worker tracks the
+# groups it sees.
+def share_changes(client):
+    def publish(change):
+        client.publish(SYNC_TOPIC, change)
+
+    if IS_PRIMARY:
+        catalog.on_change = lambda categories, functions: publish(
+            {'kind': 'catalog', 'categories': categories, 'functions': functions})
+        allow_list.on_change = lambda user_ids: publish({'kind': 'allowed_users', 'user_ids': user_ids})
+    group_registry.on_change = lambda group_id, fields: publish({'kind': 'group', 'id': group_id, 'fields': fields})
+    scheduler.on_change = lambda job_id, fields: publish({'kind': 'schedule', 'id': job_id, 'fields': fields})
+
+# Function to apply a change published by another worker
+def apply_shared_change(change):
+    kind = change.get('kind')
+    if kind == 'catalog':
+        catalog.apply_shared(change['categories'], change['functions'])
+    elif kind == 'allowed_users':
+        allow_list.apply_shared(change['user_ids'])
+    elif kind == 'group':
+        group_registry.apply_shared(change['id'], change['fields'])
+    elif kind == 'schedule':
+        scheduler.apply_shared(change['id'], change['fields'])
+
+# Function to receive updates by polling or through the webhook server
+def serve(application):
+    if BOT_MODE == "webhook":
+        serve_webhook(
+            application,
+            host=WEBHOOK_HOST,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            dedup_size=WEBHOOK_DEDUP_SIZE,
+        )
+    else:
+        application.run_polling()
+
+# Function to start the bot
+def main():
+    if WORKER_SHARD >= 0:
+        asyncio.run(run_worker(build_application(), WORKER_SHARD, BROKER_URL, BROKER_TOKEN,
+                               on_sync=apply_shared_change, on_connect=share_changes))
+    elif BOT_WORKERS > 1:
+        serve(build_dispatcher())
+    else:
+        serve(build_application())
 
-# Start the bot
-application.run_polling()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import BadRequest, ChatMigrated, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
+
+# Telegram allows about 30 messages per second overall and 20 per minute in one group
+GLOBAL_RATE = 30
+PER_CHAT_RATE = 20 / 60
+# Sends allowed in flight at once; the token buckets decide how fast they start
+MAX_CONCURRENT_SENDS = 30
+# Attempts per chat for 429s and network errors before the chat is reported as failed
+MAX_ATTEMPTS = 3
+# Minimum time between two broadcasts, as enforced by broadcastMessageToGroups
+MESSAGE_FREQUENCY_WINDOW_MS = 5 * 60 * 1000
+
+
+# Token bucket for asyncio. Callers reserve a token up front and sleep until it is
+# due, so concurrent callers are served in order without a lock.
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    # Function to take a token; returns how many seconds until it may be used
+    def reserve(self):
+        self._refill()
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    # Function to make the next token due in `seconds` at the earliest, e.g. after a 429
+    def pause(self, seconds):
+        self._refill()
+        self._tokens = min(self._tokens, 1 - seconds * self.rate)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+# Outcome of one broadcast, reported back to the requester like broadcastMessageToGroups
+class BroadcastReport:
+    def __init__(self, total):
+        self.total = total
+        self.successful = 0
+        self.failed = []  # [(chat_id, reason)]
+
+    def summary(self):
+        if not self.failed:
+            return f"Broadcast successfully sent to all {self.successful} groups."
+        failed_message = "\n".join(f"Group {chat_id}: {reason}" for chat_id, reason in self.failed)
+        return (f"Broadcast completed.\nSuccessful: {self.successful}\nFailed: {len(self.failed)}"
+                f"\n\nFailed groups:\n{failed_message}")
+
+
+# Sends messages to many chats concurrently, within Telegram's global and per-chat
+# rate limits; broadcast_outbox.run_job drives it one chat at a time. A 429 reschedules
+# only the affected chat after the exact retry_after Telegram returned. Keep one engine
+# per bot so the buckets persist across broadcasts.
+class BroadcastEngine:
+    def __init__(self, bot, global_rate=GLOBAL_RATE, per_chat_rate=PER_CHAT_RATE,
+                 max_concurrent=MAX_CONCURRENT_SENDS, max_attempts=MAX_ATTEMPTS):
+        self._bot = bot
+        self._global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self._per_chat_rate = per_chat_rate
+        self._chat_buckets = {}
+        self.max_concurrent = max_concurrent
+        self._max_attempts = max_attempts
+
+    # Function to send one message with rate limiting and retries; returns None on
+    # success or the failure reason
+    async def send(self, chat_id, text, semaphore=None):
+        chat_bucket = self._chat_bucket(chat_id)
+        for attempt in range(1, self._max_attempts + 1):
+            await chat_bucket.acquire()
+            await self._global_bucket.acquire()
+            try:
+                if semaphore is None:
+                    await self._bot.send_message(chat_id=chat_id, text=text)
+                else:
+                    async with semaphore:
+                        await self._bot.send_message(chat_id=chat_id, text=text)
+                return None
+            except RetryAfter as e:
+                delay = _seconds(e.retry_after)
+                logging.warning("Rate limit hit for chat %s, retrying in %ss", chat_id, delay,
+                                extra={'event': 'broadcast_rate_limited', 'chat_id': chat_id})
+                chat_bucket.pause(delay)
+                reason = str(e)
+            except (BadRequest, Forbidden, ChatMigrated) as e:
+                # Permanent for this chat (not found, no rights, kicked, upgraded): retrying cannot help.
+                # BadRequest subclasses NetworkError, so it must be caught first.
+                logging.error("Failed to send message to chat %s: %s", chat_id, e,
+                              extra={'event': 'broadcast_failed', 'chat_id': chat_id})
+                return e.message
+            except (TimedOut, NetworkError) as e:
+                logging.warning("Network error sending to chat %s (attempt %d): %s", chat_id, attempt, e,
+                                extra={'event': 'broadcast_network_error', 'chat_id': chat_id})
+                await asyncio.sleep(2 ** attempt)
+                reason = str(e)
+            except TelegramError as e:
+                logging.error("Failed to send message to chat %s: %s", chat_id, e,
+                              extra={'event': 'broadcast_failed', 'chat_id': chat_id})
+                return e.message
+        return reason
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self._per_chat_rate)
+        return bucket
+
+
+def _seconds(retry_after):
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+# Function to read and write the last broadcast time shared with the Node bot
+def get_last_broadcast_time(storage):
+    return (storage.get_bot_state('broadcastState') or {}).get('lastBroadcastTime', 0)
+
+
+def set_last_broadcast_time(storage, timestamp_ms):
+    storage.set_bot_state('broadcastState', {'lastBroadcastTime': timestamp_ms})
@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from broadcast import BroadcastReport, TokenBucket
+from db_executor import run_blocking
+
+# Number of deliveries claimed and checkpointed together
+CHECKPOINT_BATCH_SIZE = 50
+# A job belongs to the process that runs it for this many seconds, renewed while it
+# runs; another process may resume it only once the lease has run out
+DEFAULT_LEASE_SECONDS = 60.0
+# How long a write waits for another process holding the database lock
+BUSY_TIMEOUT_SECONDS = 30.0
+
+# Reason recorded for deliveries that were claimed but never confirmed before a crash.
+# They are not re-sent on resume, because the message may already have been posted.
+UNCONFIRMED_REASON = "Delivery unconfirmed: the bot stopped while sending"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    text TEXT NOT NULL,
+    requester_chat_id INTEGER,
+    created_at REAL NOT NULL,
+    status TEXT NOT NULL,
+    owner TEXT,
+    lease_until REAL
+);
+CREATE TABLE IF NOT EXISTS deliveries (
+    job_id TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    error TEXT,
+    PRIMARY KEY (job_id, chat_id)
+);
+CREATE INDEX IF NOT EXISTS deliveries_state ON deliveries (job_id, state);
+"""
+
+
+# Raised when another process has taken over a job whose lease ran out
+class LeaseLost(Exception):
+    pass
+
+
+# Journal of broadcast jobs in a SQLite (WAL) database, which several processes on one
+# host may share. Each job stores its target list and per-group delivery state
+# (pending -> claimed -> sent/failed). Deliveries are claimed and confirmed one batch
+# per transaction, so a restart resumes with the remaining pending groups and never
+# posts twice to a group. A job is owned by the process running it (`owner`) under a
+# lease it renews; only jobs whose lease ran out are resumed, by whichever process
+# takes them first.
+class BroadcastOutbox:
+    def __init__(self, path, mirror=None, owner=None, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self._conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        # Journals written before leases existed: their running jobs count as expired
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        with self._conn:
+            for column, kind in (('owner', 'TEXT'), ('lease_until', 'REAL')):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+        self._lock = threading.Lock()
+        self._mirror = mirror
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+
+    def create_job(self, text, chat_ids, requester_chat_id=None):
+        job_id = uuid.uuid4().hex
+        created_at = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("INSERT INTO jobs VALUES (?, ?, ?, ?, 'running', ?, ?)",
+                               (job_id, text, requester_chat_id, created_at, self.owner,
+                                created_at + self.lease_seconds))
+            self._conn.executemany("INSERT INTO deliveries VALUES (?, ?, 'pending', NULL)",
+                                   [(job_id, str(chat_id)) for chat_id in chat_ids])
+        if self._mirror:
+            self._mirror.job_created(job_id, text, requester_chat_id, created_at, chat_ids)
+        return job_id
+
+    def get_job(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT text, requester_chat_id FROM jobs WHERE job_id = ?",
+                                     (job_id,)).fetchone()
+        return None if row is None else {'text': row[0], 'requester_chat_id': row[1]}
+
+    # Function to take over the unfinished jobs whose owner stopped renewing their lease.
+    # One statement takes them, so two processes never resume the same job.
+    def take_expired_jobs(self):
+        now = time.time()
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                "UPDATE jobs SET owner = ?, lease_until = ? WHERE status = 'running' "
+                "AND (lease_until IS NULL OR lease_until < ?) RETURNING job_id, created_at",
+                (self.owner, now + self.lease_seconds, now)).fetchall()
+        return [job_id for job_id, _ in sorted(rows, key=lambda row: row[1])]
+
+    # Function to extend the lease on a job; False when it is no longer ours
+    def renew_lease(self, job_id):
+        with self._lock, self._conn:
+            return self._renew(job_id)
+
+    def _renew(self, job_id):
+        return self._conn.execute("UPDATE jobs SET lease_until = ? WHERE job_id = ? AND owner = ?",
+                                  (time.time() + self.lease_seconds, job_id, self.owner)).rowcount > 0
+
+    # Function to mark deliveries left claimed by a previous owner as failed, since
+    # there is no way to tell whether Telegram received them
+    def expire_claims(self, job_id):
+        with self._lock, self._conn:
+            if not self._renew(job_id):
+                raise LeaseLost(job_id)
+            chat_ids = [row[0] for row in self._conn.execute(
+                "SELECT chat_id FROM deliveries WHERE job_id = ? AND state = 'claimed'", (job_id,))]
+            self._conn.execute("UPDATE deliveries SET state = 'failed', error = ? "
+                               "WHERE job_id = ? AND state = 'claimed'", (UNCONFIRMED_REASON, job_id))
+        if chat_ids and self._mirror:
+            self._mirror.checkpoint(job_id, [(chat_id, UNCONFIRMED_REASON) for chat_id in chat_ids])
+        return chat_ids
+
+    def pending_count(self, job_id):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM deliveries WHERE job_id = ? AND state = 'pending'",
+                                      (job_id,)).fetchone()[0]
+
+    # Function to claim the next batch of pending deliveries, renewing the lease, in one
+    # write transaction: the lease update takes the database's write lock first, so no
+    # other process can claim the same deliveries or take the job in between
+    def claim_batch(self, job_id, size=CHECKPOINT_BATCH_SIZE):
+        with self._lock, self._conn:
+            if not self._renew(job_id):
+                raise LeaseLost(job_id)
+            rows = self._conn.execute(
+                "UPDATE deliveries SET state = 'claimed' WHERE job_id = ? AND state = 'pending' AND chat_id IN "
+                "(SELECT chat_id FROM deliveries WHERE job_id = ? AND state = 'pending' LIMIT ?) RETURNING chat_id",
+                (job_id, job_id, size)).fetchall()
+        return [row[0] for row in rows]
+
+    # Function to checkpoint a batch of results, given as (chat_id, error or None), in one transaction
+    def record_batch(self, job_id, results):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE deliveries SET state = ?, error = ? WHERE job_id = ? AND chat_id = ?",
+                [('sent' if error is None else 'failed', error, job_id, chat_id) for chat_id, error in results])
+        if self._mirror:
+            self._mirror.checkpoint(job_id, results)
+
+    def finish(self, job_id):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE jobs SET status = 'done', lease_until = NULL WHERE job_id = ? AND owner = ?",
+                               (job_id, self.owner))
+        if self._mirror:
+            self._mirror.job_finished(job_id)
+
+    def report(self, job_id):
+        with self._lock:
+            rows = self._conn.execute("SELECT chat_id, state, error FROM deliveries WHERE job_id = ?",
+                                      (job_id,)).fetchall()
+        report = BroadcastReport(len(rows))
+        for chat_id, state, error in rows:
+            if state == 'sent':
+                report.successful += 1
+            elif state == 'failed':
+                report.failed.append((chat_id, error))
+        return report
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Copy of the outbox in Firestore: broadcastJobs/{job_id} with one document per
+# group under deliveries/, written with one batch per checkpoint
+class FirestoreOutboxMirror:
+    def __init__(self, storage):
+        self._storage = storage
+
+    # Taken from the FirestoreStorage on first use, which connects it if needed
+    @property
+    def _db(self):
+        return self._storage.db
+
+    def job_created(self, job_id, text, requester_chat_id, created_at, chat_ids):
+        job_ref = self._db.collection('broadcastJobs').document(job_id)
+        job_ref.set({'text': text, 'requesterChatId': requester_chat_id,
+                     'createdAt': created_at, 'status': 'running', 'total': len(chat_ids)})
+
+    def checkpoint(self, job_id, results):
+        deliveries_ref = self._db.collection('broadcastJobs').document(job_id).collection('deliveries')
+        # A Firestore batch holds at most 500 writes
+        for start in range(0, len(results), 500):
+            batch = self._db.batch()
+            for chat_id, error in results[start:start + 500]:
+                batch.set(deliveries_ref.document(str(chat_id)),
+                          {'state': 'sent' if error is None else 'failed', 'error': error})
+            batch.commit()
+
+    def job_finished(self, job_id):
+        self._db.collection('broadcastJobs').document(job_id).update({'status': 'done'})
+
+
+# Function to run (or resume) a journaled broadcast job this process owns and return its
+# report, or None when another process took the job over. With `spread`, the sends start
+# evenly over that many seconds instead of as fast as the rate limits allow. The lease is
+# renewed in the background while sends are slow. SQLite and Firestore checkpoint writes
+# run on the Firestore executor.
+async def run_job(engine, outbox, job_id, batch_size=CHECKPOINT_BATCH_SIZE, spread=None):
+    heartbeat = asyncio.create_task(_renew_lease(outbox, job_id))
+    try:
+        return await _run_job(engine, outbox, job_id, batch_size, spread)
+    except LeaseLost:
+        logging.warning("Broadcast %s was taken over by another process", job_id,
+                        extra={'event': 'broadcast_lease_lost', 'job_id': job_id})
+        return None
+    finally:
+        heartbeat.cancel()
+
+
+async def _renew_lease(outbox, job_id):
+    while True:
+        await asyncio.sleep(outbox.lease_seconds / 3)
+        try:
+            if not await run_blocking(outbox.renew_lease, job_id):
+                return
+        except Exception as e:
+            logging.error("Failed to renew the lease on broadcast %s: %s", job_id, e)
+
+
+async def _run_job(engine, outbox, job_id, batch_size, spread):
+    job = await run_blocking(outbox.get_job, job_id)
+    expired = await run_blocking(outbox.expire_claims, job_id)
+    if expired:
+        logging.warning("Broadcast %s: %d deliveries were unconfirmed and will not be re-sent", job_id, len(expired))
+
+    pace = None
+    if spread:
+        pending = await run_blocking(outbox.pending_count, job_id)
+        pace = TokenBucket(max(pending, 1) / spread)
+
+    async def send(chat_id):
+        if pace is not None:
+            await pace.acquire()
+        return await engine.send(chat_id, job['text'], semaphore)
+
+    semaphore = asyncio.Semaphore(engine.max_concurrent)
+    while True:
+        chat_ids = await run_blocking(outbox.claim_batch, job_id, batch_size)
+        if not chat_ids:
+            break
+        errors = await asyncio.gather(*(send(chat_id) for chat_id in chat_ids))
+        await run_blocking(outbox.record_batch, job_id, list(zip(chat_ids, errors)))
+
+    await run_blocking(outbox.finish, job_id)
+    report = await run_blocking(outbox.report, job_id)
+    logging.info("Broadcast %s finished: %d sent, %d failed", job_id, report.successful, len(report.failed))
+    return report
@@ -0,0 +1,318 @@
+import heapq
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import metrics
+from broadcast import get_last_broadcast_time, set_last_broadcast_time
+from db_executor import run_blocking
+
+# Time zone of cron expressions and of dates given without an offset
+DEFAULT_TIMEZONE = "UTC"
+# Jobs due within this many seconds of the first one are sent in the same pass
+DEFAULT_COALESCE_SECONDS = 60.0
+# A pass's sends start evenly over this many seconds instead of in one burst
+DEFAULT_SPREAD_SECONDS = 60.0
+# A recurring run missed by more than this (the bot was down) is skipped, not sent late
+DEFAULT_MISFIRE_GRACE_SECONDS = 3600.0
+
+# Name of the single JobQueue job that waits for the earliest scheduled broadcast
+TIMER_NAME = "scheduled_broadcasts"
+
+SCHEDULED_RUNS = metrics.REGISTRY.counter(
+    'bot_scheduled_broadcast_runs_total', 'Scheduled broadcast runs, by whether they were sent or skipped.',
+    ['outcome'])
+
+
+# A five-field cron expression (minute hour day-of-month month day-of-week) with
+# `*`, lists, ranges and `/step`, or one of the @hourly/@daily/@weekly/@monthly
+# aliases. Day of week 0 and 7 are Sunday. As in cron, a day matches either of the
+# day fields when both are restricted.
+class CronSchedule:
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+    ALIASES = {'@hourly': "0 * * * *", '@daily': "0 0 * * *", '@weekly': "0 0 * * 0", '@monthly': "0 0 1 * *"}
+    # Years searched for the next run before an expression is deemed never to match, e.g.
+    # "0 0 30 2 *" (February 30); five reach the next February 29 until 2096
+    SEARCH_YEARS = 5
+
+    def __init__(self, expression):
+        self.expression = expression.strip()
+        fields = self.ALIASES.get(self.expression, self.expression).split()
+        if len(fields) != 5:
+            raise ValueError(f"A cron expression has 5 fields, got {len(fields)}: {expression}")
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            _parse_field(field, low, high) for field, (low, high) in zip(fields, self.FIELDS))
+        self.weekdays = {day % 7 for day in weekdays}
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    # Function to get the first run strictly after `timestamp` in `tz`, or None when there is none
+    def next_after(self, timestamp, tz):
+        moment = datetime.fromtimestamp(timestamp, tz).replace(tzinfo=None, second=0, microsecond=0)
+        moment += timedelta(minutes=1)
+        limit = moment.replace(year=moment.year + self.SEARCH_YEARS, month=1, day=1)
+        # Wall-clock arithmetic on naive local times, skipping a whole month, day or hour when it cannot match
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self._day_matches(moment):
+                moment = (moment + timedelta(days=1)).replace(hour=0, minute=0)
+            elif moment.hour not in self.hours:
+                moment = (moment + timedelta(hours=1)).replace(minute=0)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment.replace(tzinfo=tz).timestamp()
+        return None
+
+    def _day_matches(self, moment):
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+
+def _parse_field(field, low, high):
+    values = set()
+    for part in field.split(','):
+        value_range, _, step = part.partition('/')
+        if value_range == '*':
+            start, end = low, high
+        elif '-' in value_range:
+            start, end = (int(value) for value in value_range.split('-', 1))
+        else:
+            # As in cron, `5/10` runs from 5 to the end of the range
+            start = int(value_range)
+            end = high if step else start
+        if not low <= start <= end <= high:
+            raise ValueError(f"Cron field out of range {low}-{high}: {field}")
+        values.update(range(start, end + 1, int(step) if step else 1))
+    return values
+
+
+# Function to parse the arguments of /schedule: a date and time (ISO 8601, in `tz`
+# unless it has an offset) for a one-off broadcast, or `cron` and five fields (or an
+# @alias) for a recurring one, followed by the message. Returns (cron expression or
+# None, first run timestamp, message); raises ValueError.
+def parse_schedule(args, tz, now=None):
+    now = time.time() if now is None else now
+    words = args.split()
+    if not words:
+        raise ValueError("Missing schedule")
+    if words[0] in CronSchedule.ALIASES:
+        expression, count = words[0], 1
+    elif words[0].lower() == 'cron':
+        expression, count = ' '.join(words[1:6]), 6
+    else:
+        expression, count = None, 1
+    message = args.strip().split(None, count)[count:]
+    message = message[0].strip() if message else ''
+    if not message:
+        raise ValueError("Missing message")
+
+    if expression is not None:
+        next_run = CronSchedule(expression).next_after(now, tz)
+        if next_run is None:
+            raise ValueError(f"The cron expression never matches: {expression}")
+        return expression, next_run, message
+    run_at = datetime.fromisoformat(words[0])
+    if run_at.tzinfo is None:
+        run_at = run_at.replace(tzinfo=tz)
+    if run_at.timestamp() <= now:
+        raise ValueError("The time is in the past")
+    return None, run_at.timestamp(), message
+
+
+# Function to get the messages of a coalesced pass: identical texts are sent once,
+# and each different text as a message of its own
+def distinct_messages(texts):
+    return list(dict.fromkeys(texts))
+
+
+# One-off and recurring broadcasts (the `scheduledBroadcasts` collection: text, cron
+# expression or None, next_run timestamp and requester per job). Jobs are read once at
+# startup into a min-heap on next_run; storage is only written when a job is added,
+# removed or run. A single JobQueue job waits for the earliest one, so an idle bot
+# costs one pending timer. When it fires, every job due within `coalesce_window` is
+# passed to `on_due(context, jobs)` together, which sends them in one pass, each
+# distinct text as its own message. Passes respect
+# the broadcast frequency window shared with /broadcast: one that would start inside
+# it waits for it to end, collecting more jobs meanwhile.
+#
+# Only the process given a JobQueue in start() runs jobs; others keep the same jobs
+# through apply_shared() to list them. `on_change(job_id, fields)`, when set, is
+# called for every change made here (fields None for a removal).
+#
+# All methods must be called from the event loop.
+class BroadcastScheduler:
+    def __init__(self, storage, on_due, tz=DEFAULT_TIMEZONE, coalesce_window=DEFAULT_COALESCE_SECONDS,
+                 misfire_grace=DEFAULT_MISFIRE_GRACE_SECONDS, min_interval=0.0):
+        self._storage = storage
+        self._on_due = on_due
+        self.tz = ZoneInfo(tz) if isinstance(tz, str) else tz
+        self._coalesce_window = coalesce_window
+        self._misfire_grace = misfire_grace
+        self._min_interval = min_interval
+        self._jobs = {}  # job_id -> fields
+        self._heap = []  # (next_run, job_id); entries whose job changed since are skipped
+        self._loaded = False
+        self._loading = False
+        self._changed_during_load = {}  # job_id -> fields, changed before or while a load reads storage
+        self._job_queue = None
+        self._timer = None  # (due timestamp, Job)
+        self._not_before = 0.0
+        self.on_change = None
+
+    # Function to read every job from storage. Jobs added, removed or run here and changes
+    # shared by other processes before or during the read may be newer than it, so they
+    # are kept.
+    async def load(self):
+        self._loading = True
+        try:
+            jobs = await run_blocking(self._storage.load_scheduled_broadcasts)
+        except Exception:
+            # Once loaded, the jobs in memory already include every change
+            if self._loaded:
+                self._changed_during_load = {}
+            raise
+        finally:
+            self._loading = False
+        for job_id, fields in self._changed_during_load.items():
+            if fields is None:
+                jobs.pop(job_id, None)
+            else:
+                jobs[job_id] = fields
+        self._jobs = jobs
+        self._heap = [(fields['next_run'], job_id) for job_id, fields in jobs.items()]
+        heapq.heapify(self._heap)
+        self._loaded = True
+        self._changed_during_load = {}
+        logging.info("Loaded %d scheduled broadcasts", len(jobs))
+        self._arm()
+
+    # Function to run the jobs from now on, with timers on `job_queue`
+    def start(self, job_queue):
+        self._job_queue = job_queue
+        self._arm()
+
+    # Function to stop running jobs; the JobQueue drops the pending timer when it stops
+    def stop(self):
+        self._job_queue = None
+        self._timer = None
+
+    # Function to get the jobs as (job_id, fields), the next to run first
+    def jobs(self):
+        return sorted(self._jobs.items(), key=lambda item: item[1]['next_run'])
+
+    # Function to add a job and return its ID
+    async def add(self, text, next_run, cron=None, requester_chat_id=None):
+        job_id = uuid.uuid4().hex[:8]
+        fields = {'text': text, 'cron': cron, 'next_run': next_run, 'requester_chat_id': requester_chat_id,
+                  'created_at': time.time()}
+        await run_blocking(self._storage.save_scheduled_broadcasts, {job_id: fields})
+        self._apply(job_id, fields)
+        return job_id
+
+    # Function to remove a job; False when there is no such job
+    async def remove(self, job_id):
+        if job_id not in self._jobs:
+            return False
+        await run_blocking(self._storage.save_scheduled_broadcasts, {job_id: None})
+        self._apply(job_id, None)
+        return True
+
+    # Function to take a change another process made; it saves the change itself
+    def apply_shared(self, job_id, fields):
+        self._apply(job_id, fields, local=False)
+
+    def _apply(self, job_id, fields, local=True):
+        if self._loading or not self._loaded:
+            self._changed_during_load[job_id] = fields
+        if fields is None:
+            self._jobs.pop(job_id, None)
+        else:
+            self._jobs[job_id] = fields
+            heapq.heappush(self._heap, (fields['next_run'], job_id))
+        if local and self.on_change is not None:
+            self.on_change(job_id, fields)
+        self._arm()
+
+    def _is_current(self, entry):
+        fields = self._jobs.get(entry[1])
+        return fields is not None and fields['next_run'] == entry[0]
+
+    # Function to point the timer at the earliest job, replacing it only when that changed
+    def _arm(self):
+        if self._job_queue is None:
+            return
+        while self._heap and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            self._cancel_timer()
+            return
+        due = max(self._heap[0][0], self._not_before)
+        if self._timer is not None and self._timer[0] == due:
+            return
+        self._cancel_timer()
+        # Lateness is handled in _fire, so APScheduler must not skip a timer that fires late
+        job = self._job_queue.run_once(self._fire, when=max(0.0, due - time.time()), name=TIMER_NAME,
+                                       job_kwargs={'misfire_grace_time': None})
+        self._timer = (due, job)
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer[1].schedule_removal()
+            self._timer = None
+
+    # JobQueue callback: runs every job due now or within the coalescing window
+    async def _fire(self, context):
+        self._timer = None
+        if self._min_interval:
+            try:
+                last = await run_blocking(get_last_broadcast_time, self._storage) / 1000
+            except Exception as e:
+                logging.error("Failed to read the last broadcast time: %s", e)
+                last = 0.0
+            if time.time() < last + self._min_interval:
+                self._not_before = last + self._min_interval
+                self._arm()
+                return
+
+        now = time.time()
+        due, changes = [], {}
+        while self._heap and self._heap[0][0] <= now + self._coalesce_window:
+            entry = heapq.heappop(self._heap)
+            if not self._is_current(entry):
+                continue
+            job_id, fields = entry[1], self._jobs[entry[1]]
+            late = now - fields['next_run']
+            if fields.get('cron'):
+                next_run = CronSchedule(fields['cron']).next_after(max(now, fields['next_run']), self.tz)
+                changes[job_id] = None if next_run is None else {**fields, 'next_run': next_run}
+            else:
+                changes[job_id] = None
+            if fields.get('cron') and late > self._misfire_grace:
+                logging.warning("Skipping scheduled broadcast %s, missed by %.0fs", job_id, late,
+                                extra={'event': 'scheduled_broadcast_skipped', 'job_id': job_id})
+                SCHEDULED_RUNS.inc(outcome='skipped')
+            else:
+                due.append(fields)
+                SCHEDULED_RUNS.inc(outcome='sent')
+
+        # Advanced before sending: a crash mid-pass skips a run rather than sending it twice
+        for job_id, fields in changes.items():
+            self._apply(job_id, fields)
+        if changes:
+            try:
+                await run_blocking(self._storage.save_scheduled_broadcasts, changes)
+            except Exception as e:
+                logging.error("Failed to save %d scheduled broadcasts: %s", len(changes), e)
+        if not due:
+            return
+        await run_blocking(set_last_broadcast_time, self._storage, int(now * 1000))
+        logging.info("Running %d scheduled broadcasts in one pass", len(due),
+                     extra={'event': 'scheduled_broadcasts', 'jobs': len(due)})
+        await self._on_due(context, due)
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from db_executor import run_blocking
+from storage import load_seed, write_seed_file
+
+# How long a catalog loaded without a live listener is trusted before it is reloaded
+DEFAULT_TTL_SECONDS = 300
+
+
+# In-memory copy of the categories/{category}/functions/{function} tree.
+# The catalog is loaded once, kept current by the storage's change listeners
+# (Firestore snapshot listeners) and reloaded on a TTL if a listener drops or the
+# backend has none, so handlers never read storage per tap.
+#
+# With a `snapshot_dir`, every catalog received from storage is also written to
+# `<snapshot_dir>/categories.json` (the functions/categories.json format), and
+# load_snapshot() serves that copy after a restart until storage has been read again.
+#
+# `on_change(categories, functions)`, when set, is called with the whole catalog after
+# every change read from storage, possibly on a listener thread; other processes pass
+# it to apply_shared() instead of reading storage themselves. Those processes are created
+# with `shared`: their catalog never expires and they never start listeners, since it is
+# kept current by apply_shared().
+class CatalogCache:
+    def __init__(self, storage, ttl=DEFAULT_TTL_SECONDS, snapshot_dir=None, shared=False):
+        self._storage = storage
+        self._ttl = ttl
+        self._shared = shared
+        self._snapshot_dir = snapshot_dir
+        self._lock = threading.RLock()
+        self._category_names = []
+        self._functions = {}  # category -> {function: document data}
+        self._refreshed_at = 0.0
+        self._watch = None
+        self._reload_lock = asyncio.Lock()
+        self.version = 0
+        self.on_change = None
+
+    # Function to load the whole catalog with one read per collection
+    def load(self):
+        categories, functions = self._storage.load_catalog()
+        self._replace(categories=categories, functions=functions)
+        logging.info("Catalog loaded: %d categories, %d functions",
+                     len(categories), sum(len(f) for f in functions.values()))
+
+    # Function to load the catalog saved by the last run; returns False when there is none
+    def load_snapshot(self):
+        if not self._snapshot_dir or not os.path.exists(os.path.join(self._snapshot_dir, 'categories.json')):
+            return False
+        seed = load_seed(self._snapshot_dir)
+        self._replace(categories=seed['categories'], functions=seed['functions'], save=False)
+        logging.info("Catalog loaded from snapshot: %d categories", len(seed['categories']))
+        return True
+
+    # Function to subscribe to catalog changes; the first snapshot doubles as a load
+    def start_listeners(self):
+        if self._shared:
+            return
+        self.stop_listeners()
+        self._watch = self._storage.watch_catalog(self._on_categories, self._on_functions)
+        if self._watch is not None:
+            logging.info("Catalog snapshot listeners started")
+
+    def stop_listeners(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
+    def listening(self):
+        return self._watch is not None and self._watch.is_active
+
+    def stale(self):
+        if self._shared:
+            return False
+        return not self.listening() and time.monotonic() - self._refreshed_at >= self._ttl
+
+    # Function to reload when a listener has dropped and the data is older than the TTL.
+    # The reload runs on the Firestore executor and concurrent callers share one reload.
+    async def ensure_fresh(self):
+        if not self.stale():
+            return
+        async with self._reload_lock:
+            if self.stale():
+                logging.warning("Catalog listeners inactive and TTL expired, reloading catalog")
+                await run_blocking(self._reload)
+
+    def _reload(self):
+        self.load()
+        try:
+            self.start_listeners()
+        except Exception as e:
+            logging.error("Failed to restart catalog listeners: %s", e)
+
+    def categories(self):
+        with self._lock:
+            return list(self._category_names)
+
+    def functions(self, category):
+        with self._lock:
+            return list(self._functions.get(category, {}))
+
+    # Function to read the version, categories and function documents in one consistent step
+    def snapshot(self):
+        with self._lock:
+            functions = {category: dict(items) for category, items in self._functions.items()}
+            return self.version, list(self._category_names), functions
+
+    # Function to take a catalog another process read from storage
+    def apply_shared(self, categories, functions):
+        self._replace(categories=categories, functions=functions, save=False)
+
+    # Listener callbacks run on the listener's background thread
+    def _on_categories(self, categories):
+        self._replace(categories=categories)
+
+    def _on_functions(self, functions):
+        self._replace(functions=functions)
+
+    def _replace(self, categories=None, functions=None, save=True):
+        with self._lock:
+            if categories is not None:
+                self._category_names = sorted(categories)
+            if functions is not None:
+                self._functions = {name: dict(sorted(items.items())) for name, items in functions.items()}
+            self._refreshed_at = time.monotonic()
+            self.version += 1
+            if save and self._snapshot_dir:
+                self._save_snapshot()
+            shared = None
+            if save and self.on_change is not None:
+                shared = list(self._category_names), self._functions
+        logging.info("Catalog updated to version %d", self.version)
+        if shared is not None:
+            self.on_change(*shared)
+
+    # Called with the lock held, from the loading thread or a listener thread
+    def _save_snapshot(self):
+        docs = [{'id': category,
+                 'functions': [{'id': function, **data} for function, data in self._functions.get(category, {}).items()]}
+                for category in self._category_names]
+        try:
+            write_seed_file(self._snapshot_dir, 'categories', docs)
+        except OSError as e:
+            logging.error("Failed to save the catalog snapshot: %s", e)
+
@@ -0,0 +1,166 @@
+import bisect
+import hashlib
+import math
+import re
+import threading
+import unicodedata
+
+# Field weights: a hit in the function name counts more than one in the category or response
+NAME_WEIGHT = 3.0
+CATEGORY_WEIGHT = 2.0
+RESPONSE_WEIGHT = 1.0
+# Discount for query words that only match as a prefix or with typos
+PREFIX_FACTOR = 0.9
+FUZZY_FACTOR = 0.7
+# Minimum trigram similarity for a typo match, and how many vocabulary words a query word may expand to
+MIN_SIMILARITY = 0.3
+MAX_EXPANSIONS = 20
+
+_WORD = re.compile(r'\w+')
+
+
+# Function to split text into lowercase words without accents
+def tokenize(text):
+    text = unicodedata.normalize('NFKD', text or '').casefold()
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return _WORD.findall(text)
+
+
+def trigrams(word):
+    padded = f"^{word}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# One searchable function document
+class SearchResult:
+    def __init__(self, result_id, category, function, data):
+        self.id = result_id
+        self.category = category
+        self.function = function
+        self.data = data
+
+
+# Word index over the function names, category names and responses of the catalog,
+# for inline queries. Words map to the documents they occur in (weighted by field),
+# and a trigram index over the vocabulary finds words within a typo or two of a query
+# word. The index follows the catalog version and, on a change, re-indexes only the
+# documents whose content changed, so lookups never touch storage.
+class CatalogSearchIndex:
+    def __init__(self, catalog):
+        self._catalog = catalog
+        self._lock = threading.Lock()
+        self._version = None
+        self._docs = {}  # (category, function) -> (fingerprint, SearchResult, {word: weight})
+        self._postings = {}  # word -> {(category, function): weight}
+        self._trigrams = {}  # trigram -> set of words
+        self._vocabulary = []  # sorted words, for prefix matches
+
+    # Function to find the documents matching a query, best first
+    def search(self, query, limit=20):
+        self._sync()
+        words = tokenize(query)
+        with self._lock:
+            if not words:
+                return [doc[1] for _, doc in sorted(self._docs.items())[:limit]]
+            scores = {}  # key -> [words matched, score]
+            for word in words:
+                for key, score in self._match_word(word).items():
+                    entry = scores.setdefault(key, [0, 0.0])
+                    entry[0] += 1
+                    entry[1] += score
+            ranked = sorted(scores.items(), key=lambda item: (-item[1][0], -item[1][1], item[0]))
+            return [self._docs[key][1] for key, _ in ranked[:limit]]
+
+    # Function to score the documents containing a query word, its completions or near misses
+    def _match_word(self, word):
+        candidates = {}
+        if word in self._postings:
+            candidates[word] = 1.0
+        start = bisect.bisect_left(self._vocabulary, word)
+        for other in self._vocabulary[start:start + MAX_EXPANSIONS]:
+            if not other.startswith(word):
+                break
+            candidates.setdefault(other, PREFIX_FACTOR)
+        if len(word) >= 3 and len(candidates) < MAX_EXPANSIONS:
+            for other, similarity in self._similar_words(word):
+                candidates.setdefault(other, FUZZY_FACTOR * similarity)
+
+        total = len(self._docs)
+        scores = {}
+        for other, factor in candidates.items():
+            postings = self._postings[other]
+            idf = math.log(1 + total / len(postings))
+            for key, weight in postings.items():
+                score = factor * weight * idf
+                if score > scores.get(key, 0.0):
+                    scores[key] = score
+        return scores
+
+    def _similar_words(self, word):
+        grams = trigrams(word)
+        shared = {}
+        for gram in grams:
+            for other in self._trigrams.get(gram, ()):
+                shared[other] = shared.get(other, 0) + 1
+        similar = []
+        for other, count in shared.items():
+            similarity = count / (len(grams) + len(trigrams(other)) - count)
+            if similarity >= MIN_SIMILARITY:
+                similar.append((other, similarity))
+        similar.sort(key=lambda item: -item[1])
+        return similar[:MAX_EXPANSIONS]
+
+    def _sync(self):
+        if self._version == self._catalog.version:
+            return
+        with self._lock:
+            version, categories, functions = self._catalog.snapshot()
+            if self._version == version:
+                return
+            current = {}
+            for category in categories:
+                for function, data in functions.get(category, {}).items():
+                    current[(category, function)] = data
+            for key in [key for key in self._docs if key not in current]:
+                self._remove(key)
+            for key, data in current.items():
+                fingerprint = repr(sorted(data.items()))
+                indexed = self._docs.get(key)
+                if indexed is not None and indexed[0] == fingerprint:
+                    continue
+                if indexed is not None:
+                    self._remove(key)
+                self._add(key, data, fingerprint)
+            self._version = version
+
+    def _add(self, key, data, fingerprint):
+        category, function = key
+        words = {}
+        for text, weight in ((function, NAME_WEIGHT), (category, CATEGORY_WEIGHT),
+                             (data.get('response'), RESPONSE_WEIGHT)):
+            for word in tokenize(text if isinstance(text, str) else None):
+                words[word] = max(words.get(word, 0.0), weight)
+        result_id = hashlib.sha1(f"{category}\0{function}".encode('utf-8')).hexdigest()[:16]
+        self._docs[key] = (fingerprint, SearchResult(result_id, category, function, data), words)
+        for word, weight in words.items():
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = {}
+                bisect.insort(self._vocabulary, word)
+                for gram in trigrams(word):
+                    self._trigrams.setdefault(gram, set()).add(word)
+            postings[key] = weight
+
+    def _remove(self, key):
+        _, _, words = self._docs.pop(key)
+        for word in words:
+            postings = self._postings[word]
+            del postings[key]
+            if postings:
+                continue
+            del self._postings[word]
+            del self._vocabulary[bisect.bisect_left(self._vocabulary, word)]
+            for gram in trigrams(word):
+                self._trigrams[gram].discard(word)
+                if not self._trigrams[gram]:
+                    del self._trigrams[gram]
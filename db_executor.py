@@ -0,0 +1,24 @@
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Upper bound on Firestore calls in flight at once; extra calls wait for a free worker
+FIRESTORE_MAX_WORKERS = int(os.getenv("FIRESTORE_MAX_WORKERS", "8"))
+
+# The firebase_admin client is synchronous (gRPC), so blocking calls are handed to a
+# bounded thread pool instead of running on the bot's event loop
+_executor = ThreadPoolExecutor(max_workers=FIRESTORE_MAX_WORKERS, thread_name_prefix="firestore")
+
+
+# Function to run a blocking Firestore call without stalling the event loop. The call runs
+# in a copy of the caller's context, so per-update metrics see the reads it makes.
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_executor, context.run, functools.partial(func, *args, **kwargs))
+
+
+def shutdown():
+    _executor.shutdown(wait=False, cancel_futures=True)
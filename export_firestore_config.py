@@ -1,15 +1,20 @@
 import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import firestore
+from firestore_jsonl import document_record, open_jsonl
+import argparse
 import csv
+import json
+import queue
+import threading
 
-# Initialize Firebase app (use your production credentials)
-cred = credentials.Certificate("path/to/your/production-firebase-key.json")
-firebase_admin.initialize_app(cred)
+# Documents fetched per page when walking a collection
+PAGE_SIZE = 500
+# Collections and subcollection listings fetched in parallel
+EXPORT_WORKERS = 8
 
-db = firestore.client()
 
-def export_to_csv(filename):
+def export_to_csv(db, filename):
     with open(filename, 'w', newline='') as file:
         writer = csv.writer(file)
         writer.writerow(['collection', 'document', 'field', 'value'])
@@ -32,5 +37,123 @@ def export_to_csv(filename):
 
     print(f"Firestore configuration exported to {filename}")
 
-# Run the export
-export_to_csv('firestore_export.csv')
\ No newline at end of file
+
+# Function to export every collection and subcollection to JSONL, one typed record per
+# document (see firestore_jsonl.document_record). Collections are read page by page with
+# limit/start_after cursors, and a pool of workers pages through sibling collections and
+# lists subcollections concurrently. Subcollections are looked up under every document
+# path from list_documents(), which, unlike a query, includes parents that have no
+# document of their own, such as a categories/{id} holding only functions. Records are written as they arrive and at most a few
+# pages are queued at a time, so memory use does not grow with the size of the database.
+# Returns the number of documents written.
+def export_to_jsonl(db, filename, page_size=PAGE_SIZE, workers=EXPORT_WORKERS):
+    tasks = queue.Queue()
+    # Pages waiting for their subcollections to be listed; a worker that finds the limit
+    # reached lists them itself instead of queueing them
+    queued_pages = threading.BoundedSemaphore(workers * 2)
+    write_lock = threading.Lock()
+    errors = []
+    count = 0
+
+    with open_jsonl(filename, 'w') as file:
+        def write_page(docs):
+            nonlocal count
+            lines = ''.join(json.dumps(document_record(doc), ensure_ascii=False) + '\n' for doc in docs)
+            with write_lock:
+                file.write(lines)
+                count += len(docs)
+
+        def export_collection(collection_ref):
+            query = collection_ref.order_by('__name__').limit(page_size)
+            last_doc = None
+            while True:
+                page = query.start_after(last_doc) if last_doc is not None else query
+                docs = list(page.stream())
+                if not docs:
+                    break
+                write_page(docs)
+                if len(docs) < page_size:
+                    break
+                last_doc = docs[-1]
+
+            doc_refs = []
+            for doc_ref in collection_ref.list_documents(page_size=page_size):
+                doc_refs.append(doc_ref)
+                if len(doc_refs) == page_size:
+                    queue_subcollections(doc_refs)
+                    doc_refs = []
+            if doc_refs:
+                queue_subcollections(doc_refs)
+
+        def queue_subcollections(doc_refs):
+            if queued_pages.acquire(blocking=False):
+                tasks.put((list_subcollections, doc_refs, True))
+            else:
+                list_subcollections(doc_refs)
+
+        def list_subcollections(doc_refs):
+            for doc_ref in doc_refs:
+                for collection_ref in doc_ref.collections():
+                    tasks.put((export_collection, collection_ref, False))
+
+        def worker():
+            while True:
+                task = tasks.get()
+                try:
+                    if task is None:
+                        return
+                    func, ref, holds_page = task
+                    try:
+                        func(ref)
+                    finally:
+                        if holds_page:
+                            queued_pages.release()
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    tasks.task_done()
+
+        for collection_ref in db.collections():
+            tasks.put((export_collection, collection_ref, False))
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        tasks.join()
+        for _ in threads:
+            tasks.put(None)
+
+    if errors:
+        raise errors[0]
+    print(f"Exported {count} documents to {filename}")
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export Firestore data.")
+    parser.add_argument('output', nargs='?', help="output file (default firestore_export.csv or .jsonl)")
+    parser.add_argument('--format', choices=['csv', 'jsonl'], default='csv',
+                        help="csv: top-level fields only; jsonl: every document, including subcollections")
+    parser.add_argument('--gzip', action='store_true', help="gzip the JSONL output")
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    parser.add_argument('--workers', type=int, default=EXPORT_WORKERS)
+    # Use your production credentials
+    parser.add_argument('--key', default="path/to/your/production-firebase-key.json",
+                        help="path to the Firebase service account key")
+    args = parser.parse_args()
+
+    # Initialize Firebase app
+    cred = credentials.Certificate(args.key)
+    firebase_admin.initialize_app(cred)
+    db = firestore.client()
+
+    if args.format == 'csv':
+        export_to_csv(db, args.output or 'firestore_export.csv')
+    else:
+        output = args.output or 'firestore_export.jsonl'
+        if args.gzip and not output.endswith('.gz'):
+            output += '.gz'
+        export_to_jsonl(db, output, page_size=args.page_size, workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import base64
+import datetime
+import gzip
+
+from google.cloud.firestore_v1 import DocumentReference, GeoPoint
+
+# Marker key for Firestore values that have no JSON equivalent
+TYPE_KEY = '__type__'
+
+
+# Function to open a JSONL file for text reading or writing, gzip-compressed when the name ends in .gz
+def open_jsonl(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+# Function to turn a document's fields into JSON-safe values, tagging timestamps,
+# bytes, references and geo points so they survive a round trip
+def encode_value(value):
+    if isinstance(value, dict):
+        return {key: encode_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(item) for item in value]
+    if isinstance(value, datetime.datetime):
+        return {TYPE_KEY: 'timestamp', 'value': value.isoformat()}
+    if isinstance(value, bytes):
+        return {TYPE_KEY: 'bytes', 'value': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, DocumentReference):
+        return {TYPE_KEY: 'reference', 'value': value.path}
+    if isinstance(value, GeoPoint):
+        return {TYPE_KEY: 'geopoint', 'latitude': value.latitude, 'longitude': value.longitude}
+    return value
+
+
+def decode_value(value, db):
+    if isinstance(value, list):
+        return [decode_value(item, db) for item in value]
+    if not isinstance(value, dict):
+        return value
+    kind = value.get(TYPE_KEY)
+    if kind == 'timestamp':
+        return datetime.datetime.fromisoformat(value['value'])
+    if kind == 'bytes':
+        return base64.b64decode(value['value'])
+    if kind == 'reference':
+        return db.document(value['value'])
+    if kind == 'geopoint':
+        return GeoPoint(value['latitude'], value['longitude'])
+    return {key: decode_value(item, db) for key, item in value.items()}
+
+
+# Function to build one export record; `path` is the document path relative to the database root
+def document_record(snapshot):
+    return {
+        'path': snapshot.reference.path,
+        'collection': snapshot.reference.parent.id,
+        'id': snapshot.id,
+        'data': encode_value(snapshot.to_dict() or {}),
+    }
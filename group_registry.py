@@ -0,0 +1,118 @@
+import asyncio
+import logging
+
+import metrics
+from db_executor import run_blocking
+from write_behind import DEFAULT_FLUSH_SECONDS, WriteBehindBuffer
+
+GROUP_WRITES = metrics.REGISTRY.counter(
+    'bot_group_writes_total', 'Group documents written or deleted by write-behind flushes.')
+
+# Name stored for chats without a title, as the Node bot does
+UNNAMED_GROUP = "Unnamed Group"
+
+
+# In-memory index of the groups the bot is in (the `groups` collection: name and
+# is_admin per chat ID), kept current from my_chat_member updates and read directly
+# for broadcast targeting. Changes apply to the index at once and are written to
+# storage in coalesced batches, so a mass add or kick becomes a few batch commits.
+# `on_change(group_id, fields)`, when set, is called for every change made here
+# (fields None for a removal); other processes pass it to apply_shared().
+#
+# All methods must be called from the event loop.
+class GroupRegistry:
+    def __init__(self, storage, flush_interval=DEFAULT_FLUSH_SECONDS):
+        self._storage = storage
+        self._groups = {}  # group_id -> {'name': ..., 'is_admin': ...}
+        self._admin_ids = set()
+        self._loaded = False
+        self._shared_before_load = {}  # group_id -> fields, from apply_shared() until the load
+        self._load_lock = asyncio.Lock()
+        self.on_change = None
+        self._writes = WriteBehindBuffer('groups', storage.save_groups, merge=False,
+                                         flush_interval=flush_interval, on_flush=GROUP_WRITES.inc)
+
+    # Function to read every group from storage. Changes recorded before then are saved
+    # first, and those recorded during the read are newer than it, so they are kept, as
+    # are the changes shared by other processes, which may not be saved yet.
+    async def load(self):
+        await self._writes.flush()
+        groups = {str(group_id): dict(fields) for group_id, fields in
+                  (await run_blocking(self._storage.load_groups)).items()}
+        for group_id, fields in {**self._shared_before_load, **self._writes.pending()}.items():
+            if fields is None:
+                groups.pop(group_id, None)
+            else:
+                groups[group_id] = fields
+        self._groups = groups
+        self._admin_ids = {group_id for group_id, fields in groups.items() if fields.get('is_admin')}
+        self._loaded = True
+        self._shared_before_load = {}
+        logging.info("Group registry loaded: %d groups, %d as admin", len(groups), len(self._admin_ids))
+
+    async def ensure_loaded(self):
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if not self._loaded:
+                await self.load()
+
+    # Function to get the IDs of the groups where the bot is an admin
+    def admin_group_ids(self):
+        return sorted(self._admin_ids)
+
+    def get(self, group_id):
+        fields = self._groups.get(str(group_id))
+        return None if fields is None else dict(fields)
+
+    # Function to record the bot's membership in a chat: added as a member or admin
+    # (is_member), or removed. Only actual changes are queued for storage.
+    def set_membership(self, group_id, title, is_member, is_admin):
+        group_id = str(group_id)
+        fields = {'name': title or UNNAMED_GROUP, 'is_admin': is_admin} if is_member else None
+        self._apply(group_id, fields)
+
+    # Function to follow a chat's title change; unknown chats are ignored
+    def rename(self, group_id, title):
+        group_id = str(group_id)
+        current = self.get(group_id)
+        if current is not None:
+            self._apply(group_id, {**current, 'name': title or UNNAMED_GROUP})
+
+    # Function to move a group to its new ID when it is upgraded to a supergroup
+    def migrate(self, old_id, new_id):
+        current = self.get(old_id)
+        if current is not None:
+            self._apply(str(old_id), None)
+            self._apply(str(new_id), current)
+
+    # Function to take a change another process made; it saves the change itself
+    def apply_shared(self, group_id, fields):
+        if not self._loaded:
+            self._shared_before_load[str(group_id)] = fields
+        self._apply(str(group_id), fields, local=False)
+
+    def _apply(self, group_id, fields, local=True):
+        # Before the load the index is incomplete, so every change is queued
+        if self._loaded and self._groups.get(group_id) == fields:
+            return
+        if fields is None:
+            self._groups.pop(group_id, None)
+            self._admin_ids.discard(group_id)
+        else:
+            self._groups[group_id] = dict(fields)
+            if fields.get('is_admin'):
+                self._admin_ids.add(group_id)
+            else:
+                self._admin_ids.discard(group_id)
+        if local:
+            self._writes.put(group_id, fields)
+            if self.on_change is not None:
+                self.on_change(group_id, fields)
+
+    def start(self):
+        self._writes.start()
+
+    # Function to stop writing in the background after saving every pending change
+    async def stop(self):
+        await self._writes.stop()
@@ -1,41 +1,165 @@
 import firebase_admin
 from firebase_admin import credentials, firestore
+from concurrent.futures import ThreadPoolExecutor
+from firestore_jsonl import decode_value, open_jsonl
+import argparse
 import csv
+import difflib
+import hashlib
+import json
 import logging
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
-# Initialize Firebase
-try:
-    cred = credentials.Certificate("firebase-key.json")
-    firebase_admin.initialize_app(cred)
-    db = firestore.client()
-    logging.info("Firebase initialized successfully.")
-except Exception as e:
-    logging.error(f"Failed to initialize Firebase: {e}")
-    exit(1)
-
-# Function to import CSV data into Firestore
-def import_csv_to_firestore(csv_file):
-    with open(csv_file, mode='r') as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            category = row['category']
-            function = row['function']
-            response = row['response']
-
-            # Set document path
+# Firestore accepts at most 500 writes per batch
+BATCH_SIZE = 500
+# Number of batches committed in parallel
+COMMIT_WORKERS = 8
+
+
+# Function to hash the fields of a function document, stored next to them as content_hash.
+# It covers every field except content_hash itself (response, type, media, parse_mode, ...);
+# sync_content.py uses the same definition.
+def content_hash(fields):
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+# Function to read the current state of every function document with one collection-group query.
+# Documents written before content hashes existed get theirs computed from their fields.
+def fetch_remote_state(db):
+    remote = {}
+    for doc in db.collection_group('functions').stream():
+        category_ref = doc.reference.parent.parent
+        if category_ref is None or category_ref.parent.id != 'categories':
+            continue
+        data = doc.to_dict() or {}
+        fields = {k: v for k, v in data.items() if k != 'content_hash'}
+        remote[(category_ref.id, doc.id)] = (data.get('content_hash') or content_hash(fields), fields)
+    return remote
+
+
+# Function to stream CSV rows as ((category, function), fields) without loading the file
+def read_csv_rows(csv_file):
+    with open(csv_file, mode='r', newline='') as file:
+        for row in csv.DictReader(file):
+            yield (row['category'], row['function']), {'response': row['response']}
+
+
+# Function to print what an import would change
+def print_diff(key, fields, remote_entry):
+    category, function = key
+    if remote_entry is None:
+        print(f"+ {category}/{function}")
+        return
+    print(f"~ {category}/{function}")
+    old = (remote_entry[1].get('response') or '').splitlines()
+    new = (fields.get('response') or '').splitlines()
+    for line in difflib.unified_diff(old, new, 'firestore', 'csv', lineterm='', n=1):
+        print(f"    {line}")
+
+
+# Function to write (document reference, data) pairs in 500-op batches committed
+# concurrently. The pairs are consumed lazily, with a bounded number of batches in memory.
+# With `merge`, fields missing from the data are kept in the stored documents.
+def commit_in_batches(db, writes, workers=COMMIT_WORKERS, merge=False):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        batch, batch_size = db.batch(), 0
+        for doc_ref, data in writes:
+            batch.set(doc_ref, data, merge=merge)
+            batch_size += 1
+            if batch_size == BATCH_SIZE:
+                pending.append(executor.submit(batch.commit))
+                batch, batch_size = db.batch(), 0
+                if len(pending) >= workers * 2:
+                    pending.pop(0).result()
+        if batch_size:
+            pending.append(executor.submit(batch.commit))
+        for future in pending:
+            future.result()
+
+
+# Function to import CSV data into Firestore. Unchanged rows are skipped, changed rows
+# are written in 500-op batches that are committed concurrently. The CSV only carries
+# responses, so they are merged into the documents: a row is unchanged when the
+# document with its response has the stored hash, and media fields (type, media,
+# parse_mode) set by sync_content.py are kept.
+def import_csv_to_firestore(db, csv_file, dry_run=False, workers=COMMIT_WORKERS):
+    remote = fetch_remote_state(db)
+    counts = {'written': 0, 'skipped': 0}
+
+    def changed_rows():
+        for key, fields in read_csv_rows(csv_file):
+            remote_entry = remote.get(key)
+            digest = content_hash({**(remote_entry[1] if remote_entry else {}), **fields})
+            if remote_entry is not None and remote_entry[0] == digest:
+                counts['skipped'] += 1
+                continue
+
+            counts['written'] += 1
+            if dry_run:
+                print_diff(key, fields, remote_entry)
+                continue
+
+            category, function = key
             doc_ref = db.collection('categories').document(category).collection('functions').document(function)
+            yield doc_ref, {**fields, 'content_hash': digest}
+
+    commit_in_batches(db, changed_rows(), workers, merge=True)
+
+    action = "Would write" if dry_run else "Imported"
+    logging.info(f"{action} {counts['written']} documents, {counts['skipped']} unchanged documents skipped.")
+    return counts['written'], counts['skipped']
+
+
+# Function to restore a JSONL export from export_firestore_config.py, streaming the records
+def import_jsonl_to_firestore(db, jsonl_file, dry_run=False, workers=COMMIT_WORKERS):
+    count = 0
+
+    def records():
+        nonlocal count
+        with open_jsonl(jsonl_file, 'r') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                count += 1
+                if dry_run:
+                    print(f"+ {record['path']}")
+                    continue
+                yield db.document(record['path']), decode_value(record['data'], db)
+
+    commit_in_batches(db, records(), workers)
+    logging.info(f"{'Would write' if dry_run else 'Imported'} {count} documents from {jsonl_file}.")
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import catalog rows (category,function,response) or a "
+                                                 "JSONL export (.jsonl, .jsonl.gz) into Firestore.")
+    # Keep the CSV file in the same directory as import_firestore.py
+    parser.add_argument('csv_file', nargs='?', default='collections firebase import.csv')
+    parser.add_argument('--dry-run', action='store_true', help="print the changes without writing them")
+    parser.add_argument('--key', default='firebase-key.json', help="path to the Firebase service account key")
+    parser.add_argument('--workers', type=int, default=COMMIT_WORKERS, help="batches committed in parallel")
+    args = parser.parse_args()
+
+    # Initialize Firebase
+    try:
+        cred = credentials.Certificate(args.key)
+        firebase_admin.initialize_app(cred)
+        db = firestore.client()
+        logging.info("Firebase initialized successfully.")
+    except Exception as e:
+        logging.error(f"Failed to initialize Firebase: {e}")
+        exit(1)
 
-            # Add data to Firestore
-            doc_ref.set({
-                'response': response
-            })
-            logging.info(f'Imported {function} under {category} category.')
+    if args.csv_file.endswith(('.jsonl', '.jsonl.gz')):
+        import_jsonl_to_firestore(db, args.csv_file, dry_run=args.dry_run, workers=args.workers)
+    else:
+        import_csv_to_firestore(db, args.csv_file, dry_run=args.dry_run, workers=args.workers)
 
-# Specify the path to your CSV file
-csv_file_path = 'collections firebase import.csv'  # Ensure this file is in the same directory as import_firestore.py
 
-# Import CSV data
-import_csv_to_firestore(csv_file_path)
+if __name__ == '__main__':
+    main()
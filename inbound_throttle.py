@@ -0,0 +1,131 @@
+import time
+from collections import OrderedDict
+
+import metrics
+
+# Default limits: a user may send a burst of 20 taps and messages and then 4 per second,
+# above the pace of menu browsing; inline queries, sent as the user types, have a budget
+# of their own of 30 and then 5 per second; a group chat, shared by its members, 30 and
+# then 5 per second
+DEFAULT_USER_RATE = 4.0
+DEFAULT_USER_BURST = 20
+DEFAULT_INLINE_RATE = 5.0
+DEFAULT_INLINE_BURST = 30
+DEFAULT_CHAT_RATE = 5.0
+DEFAULT_CHAT_BURST = 30
+# Taps on the same button of the same message within this many seconds count once
+DEFAULT_REPEAT_WINDOW_SECONDS = 1.0
+# Most keys tracked per structure; past it the least recently seen are forgotten
+MAX_TRACKED_KEYS = 100000
+
+THROTTLED_UPDATES = metrics.REGISTRY.counter(
+    'bot_throttled_updates_total', 'Updates dropped by the inbound throttle, by reason and update type.',
+    ['reason', 'type'])
+
+
+# Token buckets per key, holding only the keys seen recently. A bucket left alone
+# for burst / rate seconds is full again, the same as one never created, so it is
+# forgotten. Buckets are kept in last-use order, which makes the expired ones the
+# oldest: each call drops them from the front.
+class TokenBuckets:
+    def __init__(self, rate, burst, max_keys=MAX_TRACKED_KEYS):
+        self._rate = rate
+        self._burst = burst
+        self._max_keys = max_keys
+        self._idle_expiry = burst / rate
+        self._buckets = OrderedDict()  # key -> (tokens, time of last refill)
+
+    def __len__(self):
+        return len(self._buckets)
+
+    # Function to take a token for a key; False when its bucket is empty
+    def take(self, key, now):
+        entry = self._buckets.pop(key, None)
+        tokens = self._burst if entry is None else min(self._burst, entry[0] + (now - entry[1]) * self._rate)
+        allowed = tokens >= 1
+        self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+        self._expire(now)
+        return allowed
+
+    def _expire(self, now):
+        buckets = self._buckets
+        while buckets:
+            key, (_, last) = next(iter(buckets.items()))
+            if now - last < self._idle_expiry and len(buckets) <= self._max_keys:
+                break
+            del buckets[key]
+
+
+# Keys seen within the last `window` seconds, oldest first
+class RecentKeys:
+    def __init__(self, window, max_keys=MAX_TRACKED_KEYS):
+        self._window = window
+        self._max_keys = max_keys
+        self._seen = OrderedDict()  # key -> time first seen
+
+    def __len__(self):
+        return len(self._seen)
+
+    # Function to record a key; True when it was already seen within the window
+    def seen(self, key, now):
+        seen = self._seen
+        while seen:
+            oldest_key, first = next(iter(seen.items()))
+            if now - first < self._window and len(seen) < self._max_keys:
+                break
+            del seen[oldest_key]
+        if key in seen:
+            return True
+        seen[key] = now
+        return False
+
+
+# Inbound rate limiting for the updates users send: button taps, messages and inline
+# queries. Each passes through a bucket for its user and, in groups, one for its chat,
+# and a tap repeating one just made on the same button is collapsed. Inline queries
+# draw from a separate, larger bucket per user, so typing does not use up the budget
+# of taps and messages. Membership and
+# other service updates are never throttled. A rate of 0 turns that limit off.
+#
+# All methods must be called from the event loop.
+class InboundThrottle:
+    def __init__(self, user_rate=DEFAULT_USER_RATE, user_burst=DEFAULT_USER_BURST,
+                 chat_rate=DEFAULT_CHAT_RATE, chat_burst=DEFAULT_CHAT_BURST,
+                 repeat_window=DEFAULT_REPEAT_WINDOW_SECONDS, inline_rate=DEFAULT_INLINE_RATE,
+                 inline_burst=DEFAULT_INLINE_BURST):
+        self._users = TokenBuckets(user_rate, user_burst) if user_rate > 0 else None
+        self._inline = TokenBuckets(inline_rate, inline_burst) if inline_rate > 0 else None
+        self._chats = TokenBuckets(chat_rate, chat_burst) if chat_rate > 0 else None
+        self._repeats = RecentKeys(repeat_window) if repeat_window > 0 else None
+
+    # Function to decide whether an update is handled; returns why it is dropped
+    # ('repeat', 'user' or 'chat'), or None to let it through
+    def check(self, update):
+        if update.callback_query:
+            kind = 'callback'
+        elif update.inline_query:
+            kind = 'inline'
+        elif update.message and update.message.text is not None:
+            kind = 'message'
+        else:
+            return None
+        user = update.effective_user
+        if user is None:
+            return None
+
+        now = time.monotonic()
+        reason = None
+        query = update.callback_query
+        if self._repeats is not None and query is not None and query.message is not None:
+            if self._repeats.seen((user.id, query.message.chat.id, query.message.message_id, query.data), now):
+                reason = 'repeat'
+        users = self._inline if kind == 'inline' else self._users
+        if reason is None and users is not None and not users.take(user.id, now):
+            reason = 'user'
+        chat = update.effective_chat
+        if (reason is None and self._chats is not None and chat is not None and chat.id != user.id
+                and not self._chats.take(chat.id, now)):
+            reason = 'chat'
+        if reason is not None:
+            THROTTLED_UPDATES.inc(reason=reason, type=kind)
+        return reason
@@ -0,0 +1,183 @@
+import atexit
+import datetime
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+import metrics
+
+# Records waiting for the writer thread; when the queue is full new records are dropped
+DEFAULT_QUEUE_SIZE = 10000
+# String fields longer than this are truncated and tagged with a hash of the full value
+DEFAULT_MAX_FIELD_LENGTH = 512
+# Records per second allowed for each event type, with a burst of the same size
+DEFAULT_RATE_LIMIT = 50
+
+LOG_RECORDS_DROPPED = metrics.REGISTRY.counter(
+    'bot_log_records_dropped_total', 'Log records dropped before being written.', ['event', 'reason'])
+
+# Attributes every LogRecord has; anything else came from `extra=` and is written as a field
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+# Function to keep a large value out of the logs while keeping it identifiable: the
+# first characters, the full length and a SHA-256 prefix of the whole value
+def shorten(value, max_length=DEFAULT_MAX_FIELD_LENGTH):
+    if len(value) <= max_length:
+        return value
+    digest = hashlib.sha256(value.encode('utf-8', 'replace')).hexdigest()[:12]
+    return f"{value[:max_length]}... [{len(value)} chars, sha256:{digest}]"
+
+
+# The event type of a record: `extra={'event': ...}` or the logger name
+def event_of(record):
+    return getattr(record, 'event', None) or record.name
+
+
+# One JSON object per line, with the field names Cloud Logging reads from stdout/stderr
+class JsonFormatter(logging.Formatter):
+    def __init__(self, max_field_length=DEFAULT_MAX_FIELD_LENGTH):
+        super().__init__()
+        self._max_field_length = max_field_length
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'severity': record.levelname,
+            'logger': record.name,
+            'message': shorten(record.getMessage(), self._max_field_length),
+        }
+        for key, value in vars(record).items():
+            if key in _RECORD_ATTRIBUTES or key.startswith('_'):
+                continue
+            if not isinstance(value, (bool, int, float, type(None))):
+                value = shorten(value if isinstance(value, str) else str(value), self._max_field_length)
+            entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+# Plain text for running the bot in a terminal, with the same truncation of long messages
+class TextFormatter(logging.Formatter):
+    def __init__(self, max_field_length=DEFAULT_MAX_FIELD_LENGTH):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+        self._max_field_length = max_field_length
+
+    def formatMessage(self, record):
+        record.message = shorten(record.message, self._max_field_length)
+        return super().formatMessage(record)
+
+
+# Filter that samples and rate-limits records per event type before they are queued.
+# Sampling only applies below WARNING; the rate cap applies to every level, so a burst
+# of identical errors cannot flood the log either. Kept records carry their sample rate.
+class SamplingFilter(logging.Filter):
+    def __init__(self, sample_rates=None, rate_limits=None, default_rate_limit=DEFAULT_RATE_LIMIT):
+        super().__init__()
+        self._sample_rates = dict(sample_rates or {})
+        self._rate_limits = dict(rate_limits or {})
+        self._default_rate_limit = default_rate_limit
+        self._lock = threading.Lock()
+        self._buckets = {}  # event -> [tokens, last refill time]
+
+    def filter(self, record):
+        event = event_of(record)
+        sample_rate = self._sample_rates.get(event, 1.0)
+        if sample_rate < 1.0 and record.levelno < logging.WARNING:
+            if random.random() >= sample_rate:
+                LOG_RECORDS_DROPPED.inc(event=event, reason='sampled')
+                return False
+            record.sample_rate = sample_rate
+        if not self._take(event):
+            LOG_RECORDS_DROPPED.inc(event=event, reason='rate_limited')
+            return False
+        return True
+
+    def _take(self, event):
+        rate = self._rate_limits.get(event, self._default_rate_limit)
+        if not rate:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(event)
+            if bucket is None:
+                bucket = self._buckets[event] = [rate, now]
+            bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
+
+
+# QueueHandler that hands records to the writer thread as they are. The default handler
+# formats every record on the calling thread, which is exactly the work being moved off
+# the event loop; dropping the record when the queue is full keeps logging from blocking.
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc(event=event_of(record), reason='queue_full')
+
+
+# Function to parse "event=value,event=value" settings such as LOG_SAMPLE_RATES
+def parse_event_settings(value):
+    settings = {}
+    for part in (value or '').split(','):
+        event, _, setting = part.partition('=')
+        if event.strip() and setting.strip():
+            settings[event.strip()] = float(setting)
+    return settings
+
+
+# Function to route every log record through a bounded queue to a writer thread.
+# Settings default to the LOG_* environment variables. Returns the QueueListener,
+# which is also stopped (flushing the queue) when the process exits.
+def setup_logging(level=None, fmt=None, sample_rates=None, rate_limits=None,
+                  default_rate_limit=None, queue_size=None, max_field_length=None, stream=None):
+    level = level or os.getenv("LOG_LEVEL", "INFO").upper()
+    fmt = fmt or os.getenv("LOG_FORMAT", "json").strip().lower()
+    if sample_rates is None:
+        sample_rates = parse_event_settings(os.getenv("LOG_SAMPLE_RATES"))
+    if rate_limits is None:
+        rate_limits = parse_event_settings(os.getenv("LOG_RATE_LIMITS"))
+    if default_rate_limit is None:
+        default_rate_limit = float(os.getenv("LOG_DEFAULT_RATE_LIMIT", DEFAULT_RATE_LIMIT))
+    queue_size = queue_size or int(os.getenv("LOG_QUEUE_SIZE", DEFAULT_QUEUE_SIZE))
+    max_field_length = max_field_length or int(os.getenv("LOG_MAX_FIELD_LENGTH", DEFAULT_MAX_FIELD_LENGTH))
+
+    formatter_class = TextFormatter if fmt == 'text' else JsonFormatter
+    writer = logging.StreamHandler(stream or sys.stderr)
+    writer.setFormatter(formatter_class(max_field_length))
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=queue_size))
+    queue_handler.addFilter(SamplingFilter(sample_rates, rate_limits, default_rate_limit))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, writer, respect_handler_level=True)
+    listener.start()
+    atexit.register(_stop_listener, listener)
+    return listener
+
+
+# Function to flush and stop the writer thread unless it was already stopped
+def _stop_listener(listener):
+    if listener._thread is not None:
+        listener.stop()
@@ -0,0 +1,135 @@
+import asyncio
+import hashlib
+import logging
+import os
+
+from telegram import InputFile
+from telegram.constants import ParseMode
+from telegram.error import BadRequest
+
+import metrics
+from db_executor import run_blocking
+
+# Catalog entries send their `response` as text unless `type` names one of these media
+# kinds; `media` is then a file under the media directory or an http(s) URL, and
+# `response` becomes the caption
+MEDIA_TYPES = ('photo', 'document', 'video')
+DEFAULT_MEDIA_DIR = "media"
+
+# Accepted values of an entry's `parse_mode` field
+PARSE_MODES = {'html': ParseMode.HTML, 'markdown': ParseMode.MARKDOWN, 'markdownv2': ParseMode.MARKDOWN_V2}
+
+MEDIA_SENDS = metrics.REGISTRY.counter(
+    'bot_media_sends_total', 'Media responses sent, by whether the file was uploaded or reused by file_id.',
+    ['type', 'source'])
+
+
+# Function to get the Telegram parse mode of a catalog entry, None for plain text
+def parse_mode_of(data):
+    return PARSE_MODES.get(str(data.get('parse_mode') or '').lower())
+
+
+# Function to tell whether a catalog entry is sent as media
+def is_media(data):
+    return data.get('type') in MEDIA_TYPES and bool(data.get('media'))
+
+
+# Sends media responses, uploading each file once. The file_id Telegram returns for an
+# upload is kept in memory and in storage (telegramFiles/{content hash}) and reused for
+# every later send of the same content, so a repeat send is a small API call instead of
+# a multi-MB upload. Files are keyed by the SHA-256 of their bytes, recomputed only when
+# the file changes on disk; URLs by the SHA-256 of the URL. Concurrent sends of a file
+# that is not cached yet wait for a single upload.
+class MediaSender:
+    def __init__(self, storage, media_dir=DEFAULT_MEDIA_DIR):
+        self._storage = storage
+        self._media_dir = os.path.realpath(media_dir)
+        self._file_ids = {}  # content hash -> file_id
+        self._digests = {}  # path -> (mtime_ns, size, content hash)
+        self._uploads = {}  # content hash -> future set when its upload finishes
+
+    # Function to load the known file IDs (blocking)
+    def load(self):
+        file_ids = {content_hash: fields['file_id'] for content_hash, fields in self._storage.load_file_ids().items()
+                    if fields.get('file_id')}
+        self._file_ids = {**file_ids, **self._file_ids}
+        logging.info("Loaded %d cached Telegram file IDs", len(file_ids))
+
+    # Function to send a catalog entry's media to a chat and return the sent message
+    async def send(self, bot, chat_id, data):
+        kind, source = data['type'], data['media']
+        caption = data.get('response') or None
+        parse_mode = parse_mode_of(data)
+        path = None if source.startswith(('http://', 'https://')) else self._resolve(source)
+        content_hash = await run_blocking(self._content_hash, source, path)
+
+        while True:
+            file_id = self._file_ids.get(content_hash)
+            if file_id is not None:
+                try:
+                    message = await self._send(bot, kind, chat_id, file_id, caption, parse_mode)
+                    MEDIA_SENDS.inc(type=kind, source='file_id')
+                    return message
+                except BadRequest as e:
+                    if 'file identifier' not in str(e).lower():
+                        raise
+                    logging.warning("Cached file ID for %s was rejected, uploading again: %s", source, e)
+                    if self._file_ids.get(content_hash) == file_id:
+                        del self._file_ids[content_hash]
+            upload = self._uploads.get(content_hash)
+            if upload is None:
+                break
+            await asyncio.shield(upload)
+
+        upload = self._uploads[content_hash] = asyncio.get_running_loop().create_future()
+        try:
+            media = source if path is None else InputFile(await run_blocking(_read, path),
+                                                          filename=os.path.basename(path))
+            message = await self._send(bot, kind, chat_id, media, caption, parse_mode)
+            MEDIA_SENDS.inc(type=kind, source='upload')
+            attachment = message.effective_attachment
+            if isinstance(attachment, (list, tuple)):
+                attachment = attachment[-1]  # the largest photo size
+            self._file_ids[content_hash] = attachment.file_id
+            try:
+                await run_blocking(self._storage.save_file_id, content_hash,
+                                   {'file_id': attachment.file_id, 'type': kind, 'source': source})
+            except Exception as e:
+                logging.error("Failed to save the file ID of %s: %s", source, e)
+            return message
+        finally:
+            # Waiting senders retry: with the new file_id, or with an upload of their own
+            del self._uploads[content_hash]
+            upload.set_result(None)
+
+    @staticmethod
+    async def _send(bot, kind, chat_id, media, caption, parse_mode):
+        method = {'photo': bot.send_photo, 'document': bot.send_document, 'video': bot.send_video}[kind]
+        return await method(chat_id, media, caption=caption, parse_mode=parse_mode)
+
+    # Function to map a catalog `media` value to a file inside the media directory
+    def _resolve(self, source):
+        path = os.path.realpath(os.path.join(self._media_dir, source))
+        if os.path.commonpath([path, self._media_dir]) != self._media_dir:
+            raise ValueError(f"Media path outside {self._media_dir}: {source}")
+        return path
+
+    # Blocking: hashes the file only when its size or modification time changed
+    def _content_hash(self, source, path):
+        if path is None:
+            return hashlib.sha256(f"url:{source}".encode('utf-8')).hexdigest()
+        stat = os.stat(path)
+        known = self._digests.get(path)
+        if known is not None and known[:2] == (stat.st_mtime_ns, stat.st_size):
+            return known[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        self._digests[path] = (stat.st_mtime_ns, stat.st_size, digest.hexdigest())
+        return digest.hexdigest()
+
+
+def _read(path):
+    with open(path, 'rb') as file:
+        return file.read()
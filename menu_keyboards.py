@@ -0,0 +1,107 @@
+import hashlib
+import threading
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# One-byte callback prefixes used to route button presses
+BACK_PREFIX = 'b'
+CATEGORY_PREFIX = 'c'
+FUNCTION_PREFIX = 'f'
+
+# Number of hex digits of a name's SHA-1 used as its entry ID; more are used on a collision
+ENTRY_ID_LENGTH = 8
+
+BACK_BUTTON = InlineKeyboardButton("🔙 Back", callback_data=BACK_PREFIX)
+
+
+# Pre-rendered InlineKeyboardMarkup objects for the main menu and every category
+# submenu, keyed by catalog version, together with the index that resolves the
+# compact callback tokens on their buttons. Everything is rebuilt once per catalog
+# change and shared by every handler; the markups are immutable, so they are safe to reuse.
+#
+# With `popularity` (a usage_stats.UsageStats), buttons are ordered by its score, most
+# popular first, instead of in catalog order, and rebuilt whenever its ranking changes.
+class MenuKeyboards:
+    def __init__(self, catalog, popularity=None):
+        self._catalog = catalog
+        self._popularity = popularity
+        self._lock = threading.Lock()
+        self._built = _Menus(None, [], {})
+
+    def main_menu(self):
+        return self._current().main_menu
+
+    # Function to get a category's submenu by its callback token
+    def submenu(self, token):
+        category = self._current().categories.get(token)
+        return None if category is None else self._current().submenus.get(category)
+
+    # Function to resolve a callback token to a category name, or to a
+    # (category, function, document data) tuple; None for unknown or stale tokens
+    def resolve(self, token):
+        menus = self._current()
+        return menus.categories.get(token) or menus.functions.get(token)
+
+    def _current(self):
+        built = self._built
+        if built.version == self._version(self._catalog.version):
+            return built
+        with self._lock:
+            catalog_version, categories, functions = self._catalog.snapshot()
+            version = self._version(catalog_version)
+            if self._built.version != version:
+                rank = None if self._popularity is None else self._popularity.score
+                self._built = _Menus(version, categories, functions, rank)
+            return self._built
+
+    def _version(self, catalog_version):
+        return catalog_version if self._popularity is None else (catalog_version, self._popularity.version)
+
+
+# One catalog version's keyboards and token index. Tokens are assigned in catalog
+# order whatever the button order, so a reordering never changes them.
+class _Menus:
+    def __init__(self, version, categories, functions, rank=None):
+        self.version = version
+        self.categories = {}  # token -> category
+        self.functions = {}  # token -> (category, function, data)
+        self.submenus = {}  # category -> markup
+        ids = set()
+
+        buttons = []
+        for category in categories:
+            token = CATEGORY_PREFIX + _entry_id(ids, category)
+            self.categories[token] = category
+            buttons.append(InlineKeyboardButton(category, callback_data=token))
+        if rank is not None:
+            buttons.sort(key=lambda button: -rank(self.categories[button.callback_data]))
+        self.main_menu = InlineKeyboardMarkup(_two_columns(buttons)) if buttons else None
+
+        for category, documents in functions.items():
+            if not documents:
+                continue
+            buttons = []
+            for function, data in documents.items():
+                token = FUNCTION_PREFIX + _entry_id(ids, category, function)
+                self.functions[token] = (category, function, data)
+                buttons.append(InlineKeyboardButton(function, callback_data=token))
+            if rank is not None:
+                buttons.sort(key=lambda button: -rank(*self.functions[button.callback_data][:2]))
+            self.submenus[category] = InlineKeyboardMarkup(_two_columns(buttons) + [[BACK_BUTTON]])
+
+
+# Function to derive a short ID from an entry's names. It only depends on the names,
+# so buttons on older menu messages keep working across catalog reloads.
+def _entry_id(taken, *names):
+    digest = hashlib.sha1('\0'.join(names).encode('utf-8')).hexdigest()
+    for length in range(ENTRY_ID_LENGTH, len(digest) + 1):
+        entry_id = digest[:length]
+        if entry_id not in taken:
+            taken.add(entry_id)
+            return entry_id
+    raise ValueError(f"Duplicate catalog entry: {names}")
+
+
+# Function to lay buttons out in rows with 2 buttons each
+def _two_columns(buttons):
+    return [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
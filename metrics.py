@@ -0,0 +1,311 @@
+import bisect
+import contextvars
+import functools
+import logging
+import threading
+import time
+
+from telegram.ext import ApplicationHandlerStop
+from telegram.request import BaseRequest
+
+# Default latency buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Buckets for storage documents read while handling one update
+READ_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+# Metrics are kept in process and rendered in the Prometheus text format.
+# Every metric is safe to update from listener and executor threads.
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        with self._lock:
+            return [f"{self.name}{self._labels(key)} {value}" for key, value in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, **labels):
+        entry = self._values.get(self._key(labels))
+        return entry[2] if entry else 0
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{self._labels(key, [('le', repr(float(bound)))])} {cumulative}")
+                lines.append(f"{self.name}_bucket{self._labels(key, [('le', '+Inf')])} {count}")
+                lines.append(f"{self.name}_sum{self._labels(key)} {total}")
+                lines.append(f"{self.name}_count{self._labels(key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_DURATION = REGISTRY.histogram(
+    'bot_handler_duration_seconds', 'Time spent in each bot handler.', ['handler'])
+HANDLER_ERRORS = REGISTRY.counter(
+    'bot_handler_errors_total', 'Exceptions raised by bot handlers.', ['handler'])
+UPDATE_DURATION = REGISTRY.histogram(
+    'bot_update_duration_seconds', 'Time to process one update through every handler group.')
+UPDATE_DOCUMENT_READS = REGISTRY.histogram(
+    'bot_update_document_reads', 'Storage documents read while processing one update.', buckets=READ_BUCKETS)
+STORAGE_DURATION = REGISTRY.histogram(
+    'bot_storage_call_duration_seconds', 'Latency of storage calls.', ['backend', 'method'])
+STORAGE_ERRORS = REGISTRY.counter(
+    'bot_storage_errors_total', 'Storage calls that raised.', ['backend', 'method'])
+STORAGE_DOCUMENT_READS = REGISTRY.counter(
+    'bot_storage_document_reads_total', 'Storage documents read, including listener snapshots.', ['backend', 'method'])
+TELEGRAM_API_DURATION = REGISTRY.histogram(
+    'telegram_api_request_duration_seconds', 'Latency of Bot API requests, by lane and method.', ['lane', 'method'])
+TELEGRAM_API_RATE_LIMITED = REGISTRY.counter(
+    'telegram_api_rate_limited_total', 'Bot API requests answered with 429 Too Many Requests.', ['lane', 'method'])
+UNAUTHORIZED_REQUESTS = REGISTRY.counter(
+    'bot_unauthorized_requests_total', 'Updates rejected because the user is not in allowedusers.')
+
+# Documents read for the update being processed; a mutable cell so reads made on
+# executor threads (which run in a copy of the context) are still counted
+_update_reads = contextvars.ContextVar('update_reads', default=None)
+
+
+def record_document_reads(count):
+    cell = _update_reads.get()
+    if cell is not None:
+        cell[0] += count
+
+
+# Function to wrap a handler callback with latency and error accounting
+def instrument_handler(name, callback):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_DURATION.observe(time.perf_counter() - started, handler=name)
+    return wrapper
+
+
+# Function to process one update while measuring its duration and document reads.
+# Used by bot.py's Application subclass around Application.process_update.
+async def measure_update(process, update):
+    cell = [0]
+    token = _update_reads.set(cell)
+    started = time.perf_counter()
+    try:
+        return await process(update)
+    finally:
+        UPDATE_DURATION.observe(time.perf_counter() - started)
+        UPDATE_DOCUMENT_READS.observe(cell[0])
+        _update_reads.reset(token)
+
+
+# How many documents a storage call read, given its arguments and result
+_READ_COUNTS = {
+    'load_catalog': lambda result: len(result[0]) + sum(len(items) for items in result[1].values()),
+    'load_allowed_users': len,
+    'is_allowed_user': lambda result: 1,
+    'load_groups': len,
+    'load_user_state': lambda result: 1,
+    'get_bot_state': lambda result: 1,
+    'load_file_ids': len,
+    'load_scheduled_broadcasts': len,
+    'load_usage': lambda result: sum(entry['shards'] for entry in result.values()),
+}
+
+
+# Storage wrapper that times every call and counts the documents it reads
+class InstrumentedStorage:
+    def __init__(self, storage):
+        self._storage = storage
+        self.name = storage.name
+
+    def __getattr__(self, attr):
+        value = getattr(self._storage, attr)
+        if not callable(value) or attr.startswith('_'):
+            return value
+        if attr == 'watch_catalog':
+            return self._watch_catalog
+        if attr == 'watch_allowed_users':
+            return self._watch_allowed_users
+        return self._instrument(attr, value)
+
+    def _instrument(self, method, func):
+        backend = self.name
+        count_reads = _READ_COUNTS.get(method)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                STORAGE_ERRORS.inc(backend=backend, method=method)
+                raise
+            finally:
+                STORAGE_DURATION.observe(time.perf_counter() - started, backend=backend, method=method)
+            if count_reads is not None:
+                reads = count_reads(result)
+                STORAGE_DOCUMENT_READS.inc(reads, backend=backend, method=method)
+                record_document_reads(reads)
+            return result
+        return wrapper
+
+    # Listener snapshots are billed as reads too, so they are counted as they arrive
+    def _watch_catalog(self, on_categories, on_functions):
+        def categories_snapshot(categories):
+            STORAGE_DOCUMENT_READS.inc(len(categories), backend=self.name, method='watch_catalog')
+            on_categories(categories)
+
+        def functions_snapshot(functions):
+            STORAGE_DOCUMENT_READS.inc(sum(len(items) for items in functions.values()),
+                                       backend=self.name, method='watch_catalog')
+            on_functions(functions)
+        return self._storage.watch_catalog(categories_snapshot, functions_snapshot)
+
+    def _watch_allowed_users(self, on_users):
+        def users_snapshot(users):
+            STORAGE_DOCUMENT_READS.inc(len(users), backend=self.name, method='watch_allowed_users')
+            on_users(users)
+        return self._storage.watch_allowed_users(users_snapshot)
+
+
+# Bot API transport wrapper that times each request by API method and counts 429s.
+# `lane` names the connection pool (see telegram_transport.py).
+class InstrumentedRequest(BaseRequest):
+    def __init__(self, request, lane='interactive'):
+        self._request = request
+        self._lane = lane
+
+    @property
+    def read_timeout(self):
+        return self._request.read_timeout
+
+    async def initialize(self):
+        await self._request.initialize()
+
+    async def shutdown(self):
+        await self._request.shutdown()
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await self._request.do_request(url, method, request_data, **kwargs)
+        finally:
+            TELEGRAM_API_DURATION.observe(time.perf_counter() - started, lane=self._lane, method=api_method)
+        if code == 429:
+            TELEGRAM_API_RATE_LIMITED.inc(lane=self._lane, method=api_method)
+        return code, payload
+
+
+# Local HTTP server exposing the registry at /metrics
+class MetricsServer:
+    def __init__(self, host, port, registry=REGISTRY):
+        self._host = host
+        self._port = port
+        self._registry = registry
+        self._runner = None
+
+    async def start(self):
+        # Imported here so aiohttp stays off the bot's import path
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get('/metrics', self._metrics)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self._host, self._port).start()
+        logging.info("Serving metrics on http://%s:%s/metrics", self._host, self._port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _metrics(self, request):
+        from aiohttp import web
+
+        return web.Response(text=self._registry.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
@@ -0,0 +1,552 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+# Backend used by the bot: "firestore" (default), "sqlite" or "memory"
+DEFAULT_BACKEND = "firestore"
+DEFAULT_SQLITE_PATH = "bot_storage.db"
+# Directory with the categories/allowedusers/groups/userstates/botState JSON exports
+# used to seed the local backends
+DEFAULT_SEED_DIR = "functions"
+
+
+# Data access used by the bot: the menu catalog, the allow list, the groups the bot
+# is in, per-user conversation state and shared bot state. Every method is blocking;
+# call them through db_executor.run_blocking from async code.
+#
+# Catalog: categories are a list of names, functions are {category: {function: fields}}.
+# Watch methods return handles with `is_active` and `unsubscribe()`, or None when the
+# backend cannot push changes (callers then fall back to reloading on a TTL).
+class Storage:
+    name = None
+
+    def load_catalog(self):
+        raise NotImplementedError
+
+    def watch_catalog(self, on_categories, on_functions):
+        return None
+
+    def load_allowed_users(self):
+        raise NotImplementedError
+
+    def is_allowed_user(self, user_id):
+        return str(user_id) in self.load_allowed_users()
+
+    def watch_allowed_users(self, on_users):
+        return None
+
+    # Groups are {group_id: {'name': ..., 'is_admin': ...}}
+    def load_groups(self):
+        raise NotImplementedError
+
+    # Function to apply group changes in one batch; a None value deletes the group
+    def save_groups(self, changes):
+        raise NotImplementedError
+
+    def load_user_state(self, user_id):
+        raise NotImplementedError
+
+    # Function to merge user state changes in one batch; a None value deletes the state
+    def save_user_states(self, changes):
+        raise NotImplementedError
+
+    def get_bot_state(self, key):
+        raise NotImplementedError
+
+    def set_bot_state(self, key, fields):
+        raise NotImplementedError
+
+    # Telegram file IDs of uploaded media, {content hash: {'file_id': ..., 'type': ...}}
+    def load_file_ids(self):
+        raise NotImplementedError
+
+    def save_file_id(self, content_hash, fields):
+        raise NotImplementedError
+
+    # Scheduled broadcasts, {job_id: {'text': ..., 'cron': ... or None, 'next_run': ...}}
+    def load_scheduled_broadcasts(self):
+        raise NotImplementedError
+
+    # Function to apply scheduled broadcast changes in one batch; a None value deletes the job
+    def save_scheduled_broadcasts(self, changes):
+        raise NotImplementedError
+
+    # Usage counters of menu entries, kept as several shard documents per entry so
+    # concurrent writers rarely touch the same one. A shard is {'entry': entry ID,
+    # 'kind': 'category' or 'function', 'category': ..., 'function': ... or None,
+    # 'count': taps, 'score': decayed popularity}; load_usage sums the shards per entry
+    # and reports how many there were as 'shards'.
+    def load_usage(self):
+        raise NotImplementedError
+
+    # Function to add {shard document id: shard fields} to the stored counters in one batch
+    def increment_usage(self, increments):
+        raise NotImplementedError
+
+    # Function to open the connection ahead of the first call; backends connect lazily
+    def connect(self):
+        pass
+
+    # Function to describe the connection for /testdb
+    def describe(self):
+        return f"Connected to {self.name} storage."
+
+    def close(self):
+        pass
+
+
+class FirestoreStorage(Storage):
+    name = "firestore"
+
+    def __init__(self, key_path):
+        self._key_path = key_path
+        self._db = None
+        self._connect_lock = threading.Lock()
+
+    # The firebase_admin/gRPC import and client construction take a large share of a cold
+    # start, so they happen on first use (or in connect()) rather than when the bot loads
+    @property
+    def db(self):
+        if self._db is None:
+            self.connect()
+        return self._db
+
+    def connect(self):
+        with self._connect_lock:
+            if self._db is not None:
+                return
+            # Imported here so the local backends run without firebase_admin and credentials
+            import firebase_admin
+            from firebase_admin import credentials, firestore
+
+            firebase_admin.initialize_app(credentials.Certificate(self._key_path))
+            self._db = firestore.client()
+
+    def load_catalog(self):
+        categories = [doc.id for doc in self.db.collection('categories').stream()]
+        return categories, _group_functions(self.db.collection_group('functions').stream())
+
+    # Function to subscribe to catalog changes; each callback gets the full current state
+    def watch_catalog(self, on_categories, on_functions):
+        category_watch = self.db.collection('categories').on_snapshot(
+            lambda docs, changes, read_time: on_categories([doc.id for doc in docs]))
+        function_watch = self.db.collection_group('functions').on_snapshot(
+            lambda docs, changes, read_time: on_functions(_group_functions(docs)))
+        return _WatchGroup(category_watch, function_watch)
+
+    def load_allowed_users(self):
+        return {doc.id for doc in self.db.collection('allowedusers').stream()}
+
+    def is_allowed_user(self, user_id):
+        return self.db.collection('allowedusers').document(str(user_id)).get().exists
+
+    def watch_allowed_users(self, on_users):
+        return self.db.collection('allowedusers').on_snapshot(
+            lambda docs, changes, read_time: on_users({doc.id for doc in docs}))
+
+    def load_groups(self):
+        return {doc.id: doc.to_dict() or {} for doc in self.db.collection('groups').stream()}
+
+    def save_groups(self, changes):
+        self._commit('groups', changes, merge=False)
+
+    def load_user_state(self, user_id):
+        doc = self.db.collection('userstates').document(str(user_id)).get()
+        return doc.to_dict() if doc.exists else None
+
+    def save_user_states(self, changes):
+        self._commit('userstates', changes, merge=True)
+
+    def get_bot_state(self, key):
+        doc = self.db.collection('botState').document(key).get()
+        return doc.to_dict() if doc.exists else None
+
+    def set_bot_state(self, key, fields):
+        self.db.collection('botState').document(key).set(fields)
+
+    def load_file_ids(self):
+        return {doc.id: doc.to_dict() or {} for doc in self.db.collection('telegramFiles').stream()}
+
+    def save_file_id(self, content_hash, fields):
+        self.db.collection('telegramFiles').document(content_hash).set(fields)
+
+    def load_scheduled_broadcasts(self):
+        return {doc.id: doc.to_dict() or {} for doc in self.db.collection('scheduledBroadcasts').stream()}
+
+    def save_scheduled_broadcasts(self, changes):
+        self._commit('scheduledBroadcasts', changes, merge=False)
+
+    def load_usage(self):
+        return _sum_usage(doc.to_dict() or {} for doc in self.db.collection('usageStats').stream())
+
+    # Counters are added server-side with Increment, so writers never read them first
+    def increment_usage(self, increments):
+        from firebase_admin import firestore
+
+        self._commit('usageStats', {
+            doc_id: {**fields, 'count': firestore.Increment(fields['count']),
+                     'score': firestore.Increment(fields['score'])}
+            for doc_id, fields in increments.items()}, merge=True)
+
+    def describe(self):
+        collection_names = [collection.id for collection in self.db.collections()]
+        return f"Connected to Firestore! Collections: {', '.join(collection_names)}"
+
+    # Function to write {document id: fields or None} in batches of at most 500 writes
+    def _commit(self, collection, changes, merge):
+        items = list(changes.items())
+        for start in range(0, len(items), 500):
+            batch = self.db.batch()
+            for doc_id, fields in items[start:start + 500]:
+                doc_ref = self.db.collection(collection).document(str(doc_id))
+                if fields is None:
+                    batch.delete(doc_ref)
+                else:
+                    batch.set(doc_ref, fields, merge=merge)
+            batch.commit()
+
+
+# Both catalog listeners behind one handle
+class _WatchGroup:
+    def __init__(self, *watches):
+        self._watches = watches
+
+    @property
+    def is_active(self):
+        return all(watch.is_active for watch in self._watches)
+
+    def unsubscribe(self):
+        for watch in self._watches:
+            watch.unsubscribe()
+
+
+# Function to group `functions` documents by category, ignoring other collections
+# that happen to be called `functions`
+def _group_functions(docs):
+    functions = {}
+    for doc in docs:
+        category_ref = doc.reference.parent.parent
+        if category_ref is None or category_ref.parent.id != 'categories':
+            continue
+        functions.setdefault(category_ref.id, {})[doc.id] = doc.to_dict() or {}
+    return functions
+
+
+# Function to add up usage shard documents into {entry ID: totals}
+def _sum_usage(shards):
+    totals = {}
+    for fields in shards:
+        entry = totals.get(fields.get('entry'))
+        if entry is None:
+            totals[fields.get('entry')] = {**fields, 'shards': 1}
+        else:
+            entry['shards'] += 1
+            entry['count'] = entry.get('count', 0) + fields.get('count', 0)
+            entry['score'] = entry.get('score', 0.0) + fields.get('score', 0.0)
+    return totals
+
+
+# Everything in process memory, seeded from the JSON exports. Nothing survives a restart.
+class MemoryStorage(Storage):
+    name = "memory"
+
+    def __init__(self, seed_dir=None):
+        self._lock = threading.Lock()
+        seed = load_seed(seed_dir) if seed_dir else {}
+        self._categories = seed.get('categories', [])
+        self._functions = seed.get('functions', {})
+        self._allowed_users = seed.get('allowedusers', set())
+        self._groups = seed.get('groups', {})
+        self._user_states = seed.get('userstates', {})
+        self._bot_state = seed.get('botState', {})
+        self._file_ids = seed.get('telegramFiles', {})
+        self._scheduled_broadcasts = seed.get('scheduledBroadcasts', {})
+        self._usage = {}
+
+    def load_catalog(self):
+        with self._lock:
+            return list(self._categories), {name: dict(items) for name, items in self._functions.items()}
+
+    def load_allowed_users(self):
+        with self._lock:
+            return set(self._allowed_users)
+
+    def load_groups(self):
+        with self._lock:
+            return {group_id: dict(fields) for group_id, fields in self._groups.items()}
+
+    def save_groups(self, changes):
+        with self._lock:
+            for group_id, fields in changes.items():
+                if fields is None:
+                    self._groups.pop(str(group_id), None)
+                else:
+                    self._groups[str(group_id)] = dict(fields)
+
+    def load_user_state(self, user_id):
+        with self._lock:
+            state = self._user_states.get(str(user_id))
+            return None if state is None else dict(state)
+
+    def save_user_states(self, changes):
+        with self._lock:
+            for user_id, fields in changes.items():
+                if fields is None:
+                    self._user_states.pop(str(user_id), None)
+                else:
+                    self._user_states.setdefault(str(user_id), {}).update(fields)
+
+    def get_bot_state(self, key):
+        with self._lock:
+            state = self._bot_state.get(key)
+            return None if state is None else dict(state)
+
+    def set_bot_state(self, key, fields):
+        with self._lock:
+            self._bot_state[key] = dict(fields)
+
+    def load_file_ids(self):
+        with self._lock:
+            return {content_hash: dict(fields) for content_hash, fields in self._file_ids.items()}
+
+    def save_file_id(self, content_hash, fields):
+        with self._lock:
+            self._file_ids[content_hash] = dict(fields)
+
+    def load_scheduled_broadcasts(self):
+        with self._lock:
+            return {job_id: dict(fields) for job_id, fields in self._scheduled_broadcasts.items()}
+
+    def save_scheduled_broadcasts(self, changes):
+        with self._lock:
+            for job_id, fields in changes.items():
+                if fields is None:
+                    self._scheduled_broadcasts.pop(job_id, None)
+                else:
+                    self._scheduled_broadcasts[job_id] = dict(fields)
+
+    def load_usage(self):
+        with self._lock:
+            return _sum_usage(self._usage.values())
+
+    def increment_usage(self, increments):
+        with self._lock:
+            for doc_id, fields in increments.items():
+                shard = self._usage.get(doc_id)
+                if shard is None:
+                    self._usage[doc_id] = dict(fields)
+                else:
+                    shard['count'] += fields['count']
+                    shard['score'] += fields['score']
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS categories (name TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS functions (
+    category TEXT NOT NULL,
+    name TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (category, name)
+);
+CREATE TABLE IF NOT EXISTS allowed_users (user_id TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS groups (group_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS user_states (user_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS bot_state (key TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS file_ids (content_hash TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS scheduled_broadcasts (job_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS usage (
+    shard TEXT PRIMARY KEY,
+    entry TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    category TEXT NOT NULL,
+    function TEXT,
+    count INTEGER NOT NULL,
+    score REAL NOT NULL
+);
+"""
+
+
+# Local SQLite database (WAL) with the same layout as the Firestore collections.
+# A new database is seeded from the JSON exports.
+class SqliteStorage(Storage):
+    name = "sqlite"
+
+    def __init__(self, path, seed_dir=None):
+        self._path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SQLITE_SCHEMA)
+        if seed_dir and self._conn.execute("SELECT COUNT(*) FROM categories").fetchone()[0] == 0:
+            self._seed(load_seed(seed_dir))
+
+    def _seed(self, seed):
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT INTO categories VALUES (?)", [(name,) for name in seed.get('categories', [])])
+            self._conn.executemany("INSERT INTO functions VALUES (?, ?, ?)", [
+                (category, name, json.dumps(fields))
+                for category, items in seed.get('functions', {}).items() for name, fields in items.items()])
+            self._conn.executemany("INSERT INTO allowed_users VALUES (?)",
+                                   [(user_id,) for user_id in seed.get('allowedusers', set())])
+            self._conn.executemany("INSERT INTO groups VALUES (?, ?)",
+                                   [(k, json.dumps(v)) for k, v in seed.get('groups', {}).items()])
+            self._conn.executemany("INSERT INTO user_states VALUES (?, ?)",
+                                   [(k, json.dumps(v)) for k, v in seed.get('userstates', {}).items()])
+            self._conn.executemany("INSERT INTO bot_state VALUES (?, ?)",
+                                   [(k, json.dumps(v)) for k, v in seed.get('botState', {}).items()])
+        logging.info("Seeded %s from the JSON exports", self._path)
+
+    def load_catalog(self):
+        with self._lock:
+            categories = [row[0] for row in self._conn.execute("SELECT name FROM categories ORDER BY name")]
+            functions = {}
+            for category, name, data in self._conn.execute(
+                    "SELECT category, name, data FROM functions ORDER BY category, name"):
+                functions.setdefault(category, {})[name] = json.loads(data)
+        return categories, functions
+
+    def load_allowed_users(self):
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT user_id FROM allowed_users")}
+
+    def is_allowed_user(self, user_id):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM allowed_users WHERE user_id = ?",
+                                      (str(user_id),)).fetchone() is not None
+
+    def load_groups(self):
+        with self._lock:
+            return {group_id: json.loads(data) for group_id, data in self._conn.execute("SELECT group_id, data FROM groups")}
+
+    def save_groups(self, changes):
+        with self._lock, self._conn:
+            for group_id, fields in changes.items():
+                if fields is None:
+                    self._conn.execute("DELETE FROM groups WHERE group_id = ?", (str(group_id),))
+                else:
+                    self._conn.execute("INSERT OR REPLACE INTO groups VALUES (?, ?)", (str(group_id), json.dumps(fields)))
+
+    def load_user_state(self, user_id):
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM user_states WHERE user_id = ?", (str(user_id),)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def save_user_states(self, changes):
+        with self._lock, self._conn:
+            for user_id, fields in changes.items():
+                if fields is None:
+                    self._conn.execute("DELETE FROM user_states WHERE user_id = ?", (str(user_id),))
+                    continue
+                row = self._conn.execute("SELECT data FROM user_states WHERE user_id = ?", (str(user_id),)).fetchone()
+                state = json.loads(row[0]) if row else {}
+                state.update(fields)
+                self._conn.execute("INSERT OR REPLACE INTO user_states VALUES (?, ?)", (str(user_id), json.dumps(state)))
+
+    def get_bot_state(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM bot_state WHERE key = ?", (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set_bot_state(self, key, fields):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO bot_state VALUES (?, ?)", (key, json.dumps(fields)))
+
+    def load_file_ids(self):
+        with self._lock:
+            return {content_hash: json.loads(data)
+                    for content_hash, data in self._conn.execute("SELECT content_hash, data FROM file_ids")}
+
+    def save_file_id(self, content_hash, fields):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO file_ids VALUES (?, ?)", (content_hash, json.dumps(fields)))
+
+    def load_scheduled_broadcasts(self):
+        with self._lock:
+            return {job_id: json.loads(data)
+                    for job_id, data in self._conn.execute("SELECT job_id, data FROM scheduled_broadcasts")}
+
+    def save_scheduled_broadcasts(self, changes):
+        with self._lock, self._conn:
+            for job_id, fields in changes.items():
+                if fields is None:
+                    self._conn.execute("DELETE FROM scheduled_broadcasts WHERE job_id = ?", (job_id,))
+                else:
+                    self._conn.execute("INSERT OR REPLACE INTO scheduled_broadcasts VALUES (?, ?)",
+                                       (job_id, json.dumps(fields)))
+
+    def load_usage(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT entry, kind, category, function, SUM(count), SUM(score), "
+                                      "COUNT(*) FROM usage GROUP BY entry").fetchall()
+        return {entry: {'entry': entry, 'kind': kind, 'category': category, 'function': function,
+                        'count': count, 'score': score, 'shards': shards}
+                for entry, kind, category, function, count, score, shards in rows}
+
+    def increment_usage(self, increments):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (shard) DO UPDATE "
+                "SET count = count + excluded.count, score = score + excluded.score",
+                [(doc_id, fields['entry'], fields['kind'], fields['category'], fields.get('function'),
+                  fields['count'], fields['score']) for doc_id, fields in increments.items()])
+
+    def describe(self):
+        return f"Connected to SQLite storage at {self._path}."
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Function to read the JSON exports in `seed_dir` (the files in functions/) into the
+# shapes used by the local backends. Missing files are skipped.
+def load_seed(seed_dir):
+    def read(name):
+        path = os.path.join(seed_dir, f"{name}.json")
+        if not os.path.exists(path):
+            return []
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)
+
+    def without_id(doc):
+        return {k: v for k, v in doc.items() if k != 'id'}
+
+    categories = read('categories')
+    return {
+        'categories': sorted(category['id'] for category in categories),
+        'functions': {category['id']: {function['id']: without_id(function)
+                                       for function in sorted(category.get('functions', []), key=lambda f: f['id'])}
+                      for category in categories},
+        'allowedusers': {user['id'] for user in read('allowedusers')},
+        'groups': {group['id']: without_id(group) for group in read('groups')},
+        'userstates': {state['id']: without_id(state) for state in read('userstates')},
+        'botState': {state['id']: without_id(state) for state in read('botState')},
+    }
+
+
+# Function to write documents to `<seed_dir>/<name>.json` in the format load_seed reads.
+# The file is replaced atomically, so a crash never leaves a half-written export.
+def write_seed_file(seed_dir, name, docs):
+    os.makedirs(seed_dir, exist_ok=True)
+    path = os.path.join(seed_dir, f"{name}.json")
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(docs, file, indent=2, ensure_ascii=False, default=str)
+        file.write('\n')
+    os.replace(temp_path, path)
+
+
+# Function to open the backend selected by BOT_STORAGE
+def open_storage(backend=None):
+    backend = (backend or os.getenv("BOT_STORAGE", DEFAULT_BACKEND)).strip().lower()
+    seed_dir = os.getenv("BOT_STORAGE_SEED_DIR", DEFAULT_SEED_DIR)
+    if backend == "firestore":
+        return FirestoreStorage(os.getenv("FIREBASE_KEY_PATH"))
+    if backend == "sqlite":
+        return SqliteStorage(os.getenv("BOT_STORAGE_PATH", DEFAULT_SQLITE_PATH), seed_dir)
+    if backend == "memory":
+        return MemoryStorage(seed_dir)
+    raise ValueError(f"Unknown BOT_STORAGE backend: {backend}")
@@ -0,0 +1,157 @@
+import firebase_admin
+from firebase_admin import credentials, firestore
+from import_firestore import BATCH_SIZE, content_hash
+import argparse
+import json
+import logging
+import os
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+
+DEFAULT_CATALOG_PATH = 'functions/categories.json'
+# Hashes of the documents as of the last sync, used as the base of the three-way diff
+DEFAULT_BASE_PATH = 'content_sync_base.json'
+
+
+# Function to turn a catalog file in the functions/categories.json shape into
+# {document path: fields}, covering category and function documents
+def load_catalog_file(path):
+    with open(path, encoding='utf-8') as file:
+        categories = json.load(file)
+    documents = {}
+    for category in categories:
+        category_path = f"categories/{category['id']}"
+        documents[category_path] = {k: v for k, v in category.items() if k not in ('id', 'functions')}
+        for function in category.get('functions', []):
+            fields = {k: v for k, v in function.items() if k not in ('id', 'content_hash')}
+            documents[f"{category_path}/functions/{function['id']}"] = fields
+    return documents
+
+
+# Function to read the same {document path: fields} map from Firestore: one
+# collection-group query for every function document plus the category documents
+def fetch_remote_documents(db):
+    documents = {}
+    for doc in db.collection('categories').stream():
+        documents[f"categories/{doc.id}"] = doc.to_dict() or {}
+    for doc in db.collection_group('functions').stream():
+        category_ref = doc.reference.parent.parent
+        if category_ref is None or category_ref.parent.id != 'categories':
+            continue
+        fields = {k: v for k, v in (doc.to_dict() or {}).items() if k != 'content_hash'}
+        documents[f"categories/{category_ref.id}/functions/{doc.id}"] = fields
+    return documents
+
+
+def load_base(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def save_base(path, hashes):
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(hashes, file, indent=2, sort_keys=True, ensure_ascii=False)
+
+
+# Function to compute the three-way diff between the catalog file (local), Firestore
+# (remote) and the state of the last sync (base). Returns the writes to apply as
+# {path: fields or None for a delete}, the paths changed remotely since the last sync
+# that are kept as they are, and the paths changed on both sides (conflicts).
+# Without a base (first sync), the remote state is used as the base.
+def three_way_diff(local, remote, base, force=False):
+    local_hashes = {path: content_hash(fields) for path, fields in local.items()}
+    remote_hashes = {path: content_hash(fields) for path, fields in remote.items()}
+    if base is None:
+        base = remote_hashes
+
+    writes, kept_remote, conflicts = {}, [], []
+    for path in sorted(set(local_hashes) | set(remote_hashes) | set(base)):
+        local_hash, remote_hash, base_hash = local_hashes.get(path), remote_hashes.get(path), base.get(path)
+        if local_hash == remote_hash or local_hash == base_hash:
+            if local_hash != remote_hash:
+                kept_remote.append(path)
+            continue
+        if remote_hash != base_hash and not force:
+            conflicts.append(path)
+            continue
+        writes[path] = local.get(path)
+    return writes, kept_remote, conflicts
+
+
+# Function to apply the writes with as few batch commits as possible (one unless
+# more than 500 documents changed). Function documents get their content_hash.
+def apply_writes(db, writes):
+    items = list(writes.items())
+    for start in range(0, len(items), BATCH_SIZE):
+        batch = db.batch()
+        for path, fields in items[start:start + BATCH_SIZE]:
+            doc_ref = db.document(path)
+            if fields is None:
+                batch.delete(doc_ref)
+            elif '/functions/' in path:
+                batch.set(doc_ref, {**fields, 'content_hash': content_hash(fields)})
+            else:
+                batch.set(doc_ref, fields)
+        batch.commit()
+
+
+def sync(db, catalog_path, base_path, dry_run=False, force=False):
+    local = load_catalog_file(catalog_path)
+    remote = fetch_remote_documents(db)
+    base = load_base(base_path)
+    writes, kept_remote, conflicts = three_way_diff(local, remote, base, force=force)
+
+    for path, fields in writes.items():
+        action = '-' if fields is None else ('+' if path not in remote else '~')
+        print(f"{action} {path}")
+    for path in kept_remote:
+        print(f"= {path} (changed in Firestore since the last sync, kept)")
+    for path in conflicts:
+        print(f"! {path} (changed in both the catalog file and Firestore, skipped; use --force to overwrite)")
+
+    if dry_run:
+        logging.info(f"Dry run: {len(writes)} documents would be written.")
+        return writes
+
+    if writes:
+        apply_writes(db, writes)
+    # The new base is what Firestore holds after the sync
+    synced = {path: content_hash(fields) for path, fields in remote.items()}
+    for path, fields in writes.items():
+        if fields is None:
+            synced.pop(path, None)
+        else:
+            synced[path] = content_hash(fields)
+    save_base(base_path, synced)
+    logging.info(f"Synced {len(writes)} documents, {len(conflicts)} conflicts skipped.")
+    return writes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync a catalog file (functions/categories.json shape) to Firestore.")
+    parser.add_argument('catalog', nargs='?', default=DEFAULT_CATALOG_PATH)
+    parser.add_argument('--base', default=DEFAULT_BASE_PATH, help="state of the last sync, used for the three-way diff")
+    parser.add_argument('--dry-run', action='store_true', help="print the changes without writing them")
+    parser.add_argument('--force', action='store_true', help="overwrite documents that also changed in Firestore")
+    parser.add_argument('--key', default=os.getenv('FIREBASE_KEY_PATH', 'firebase-key.json'),
+                        help="path to the Firebase service account key")
+    args = parser.parse_args()
+
+    # Initialize Firebase
+    try:
+        cred = credentials.Certificate(args.key)
+        firebase_admin.initialize_app(cred)
+        db = firestore.client()
+        logging.info("Firebase initialized successfully.")
+    except Exception as e:
+        logging.error(f"Failed to initialize Firebase: {e}")
+        exit(1)
+
+    sync(db, args.catalog, args.base, dry_run=args.dry_run, force=args.force)
+
+
+if __name__ == '__main__':
+    main()
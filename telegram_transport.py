@@ -0,0 +1,75 @@
+import os
+
+import httpx
+from telegram.request import HTTPXRequest
+
+# Bot API traffic goes over two connection pools ("lanes"): interactive replies to users
+# (answers, edits, menus) and bulk sends (broadcasts), so a broadcast holding every bulk
+# connection never delays a menu tap. Each lane is configured by TELEGRAM_<setting> and
+# TELEGRAM_BULK_<setting> respectively.
+INTERACTIVE_PREFIX = "TELEGRAM"
+BULK_PREFIX = "TELEGRAM_BULK"
+
+INTERACTIVE_DEFAULTS = {
+    'pool_size': 256,  # python-telegram-bot's default
+    'read_timeout': 5.0,
+    'write_timeout': 5.0,
+    'pool_timeout': 1.0,  # a reply that cannot get a connection quickly is better failed
+}
+BULK_DEFAULTS = {
+    'pool_size': 32,  # a little above broadcast.MAX_CONCURRENT_SENDS
+    'read_timeout': 10.0,
+    'write_timeout': 10.0,
+    'pool_timeout': 30.0,  # bulk sends queue for a connection instead of failing
+}
+
+
+# Connection pool settings of one lane
+class TransportSettings:
+    def __init__(self, pool_size, keepalive_connections=None, keepalive_seconds=30.0, http2=False,
+                 connect_timeout=5.0, read_timeout=5.0, write_timeout=5.0, pool_timeout=1.0):
+        self.pool_size = pool_size
+        # httpx keeps only 20 idle connections by default, so bursts above that would
+        # reconnect (and redo TLS) every time; by default every connection is kept
+        self.keepalive_connections = pool_size if keepalive_connections is None else keepalive_connections
+        self.keepalive_seconds = keepalive_seconds
+        self.http2 = http2
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.pool_timeout = pool_timeout
+
+    # Function to read a lane's settings from <prefix>_POOL_SIZE, <prefix>_KEEPALIVE,
+    # <prefix>_KEEPALIVE_SECONDS, <prefix>_HTTP2 and <prefix>_CONNECT_TIMEOUT,
+    # _READ_TIMEOUT, _WRITE_TIMEOUT and _POOL_TIMEOUT, falling back to `defaults`
+    @classmethod
+    def from_env(cls, prefix, defaults):
+        def setting(name, convert, default=None):
+            value = os.getenv(f"{prefix}_{name.upper()}")
+            return convert(value) if value not in (None, "") else defaults.get(name, default)
+
+        settings = cls(
+            pool_size=setting('pool_size', int),
+            keepalive_connections=setting('keepalive', int),
+            http2=setting('http2', lambda value: value.strip().lower() in ("true", "yes", "on", "1"), False),
+        )
+        for name in ('keepalive_seconds', 'connect_timeout', 'read_timeout', 'write_timeout', 'pool_timeout'):
+            value = setting(name, float)
+            if value is not None:
+                setattr(settings, name, value)
+        return settings
+
+    # Function to build the python-telegram-bot transport with these settings.
+    # HTTP/2 needs the httpx[http2] extra (`pip install "python-telegram-bot[http2]"`).
+    def build(self):
+        return HTTPXRequest(
+            connection_pool_size=self.pool_size,
+            connect_timeout=self.connect_timeout,
+            read_timeout=self.read_timeout,
+            write_timeout=self.write_timeout,
+            pool_timeout=self.pool_timeout,
+            http_version="2" if self.http2 else "1.1",
+            httpx_kwargs={'limits': httpx.Limits(max_connections=self.pool_size,
+                                                 max_keepalive_connections=self.keepalive_connections,
+                                                 keepalive_expiry=self.keepalive_seconds)},
+        )
@@ -0,0 +1,148 @@
+import asyncio
+import hashlib
+import logging
+import random
+import time
+
+import metrics
+from db_executor import run_blocking
+
+# How often the counters collected in memory are added to storage
+DEFAULT_FLUSH_SECONDS = 60.0
+# Shard documents per entry; concurrent flushes from several processes pick one at random
+DEFAULT_COUNTER_SHARDS = 4
+# A tap counts half as much towards popularity after this many days
+DEFAULT_HALF_LIFE_DAYS = 7.0
+# How often popularity-ordered menus pick up the taps counted by other processes
+DEFAULT_RELOAD_SECONDS = 1800.0
+
+# Scores are exponentially decayed tap counts kept summable with plain increments: time
+# is cut into eras of ERA_HALF_LIVES half-lives from SCORE_EPOCH (2024-01-01 UTC), and a
+# tap adds 2 ** (half-lives since its era began) to that era's score. A weight thus stays
+# below 2 ** ERA_HALF_LIVES. Scores of different eras are compared after scaling by
+# 2 ** (ERA_HALF_LIVES * era), done relative to the newest era so it cannot overflow.
+SCORE_EPOCH = 1704067200.0
+ERA_HALF_LIVES = 32
+
+USAGE_EVENTS = metrics.REGISTRY.counter(
+    'bot_usage_events_total', 'Menu taps counted for usage statistics, by kind of entry.', ['kind'])
+
+
+# Usage statistics of the menu: taps on categories and functions are counted in memory
+# and added to storage every `flush_interval` seconds in one batch of increments, one
+# shard document per entry tapped, instead of a write per tap. With `reload_interval`,
+# the stored totals are read back periodically and `score` ranks entries by recent
+# popularity; `version` changes whenever the ranking may have.
+#
+# All methods must be called from the event loop.
+class UsageStats:
+    def __init__(self, storage, flush_interval=DEFAULT_FLUSH_SECONDS, shards=DEFAULT_COUNTER_SHARDS,
+                 half_life_days=DEFAULT_HALF_LIFE_DAYS, reload_interval=None):
+        self._storage = storage
+        self._flush_interval = flush_interval
+        self._shards = max(1, shards)
+        if half_life_days <= 0:
+            raise ValueError(f"The usage half-life must be positive, got {half_life_days} days")
+        self._half_life = half_life_days * 86400
+        self._reload_interval = reload_interval
+        self._pending = {}  # (category, function or None, era) -> [count, score]
+        self._scores = {}  # (category, function or None) -> score at the last load, in the newest era's scale
+        self._task = None
+        self.version = 0
+
+    # Function to count a tap on a category (function None) or on one of its functions.
+    # Called from handlers, so it never raises: a tap that cannot be counted is only logged.
+    def record(self, category, function=None):
+        try:
+            half_lives = (time.time() - SCORE_EPOCH) / self._half_life
+            era = int(half_lives // ERA_HALF_LIVES)
+            weight = 2.0 ** (half_lives - era * ERA_HALF_LIVES)
+            key = (category, function, era)
+            counter = self._pending.get(key)
+            if counter is None:
+                self._pending[key] = [1, weight]
+            else:
+                counter[0] += 1
+                counter[1] += weight
+            USAGE_EVENTS.inc(kind='category' if function is None else 'function')
+        except Exception as e:
+            logging.error("Failed to count a tap on %s/%s: %s", category, function, e)
+
+    # Function to get an entry's popularity score; only comparisons between scores are meaningful
+    def score(self, category, function=None):
+        return self._scores.get((category, function), 0.0)
+
+    # Function to read the stored totals of every process into the ranking
+    async def load(self):
+        totals = await run_blocking(self._storage.load_usage)
+        newest = max((_era_of(entry) for entry in totals), default=0)
+        scores = {}
+        for entry, fields in totals.items():
+            key = (fields['category'], fields.get('function'))
+            # Scores of eras long past scale to 0.0; the exponent is never positive
+            scale = 2.0 ** (ERA_HALF_LIVES * (_era_of(entry) - newest))
+            scores[key] = scores.get(key, 0.0) + fields.get('score', 0.0) * scale
+        self._scores = scores
+        self.version += 1
+        logging.info("Loaded usage statistics of %d menu entries", len(totals))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    # Function to stop the background task after writing the pending counters
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    # Function to add the pending counters to storage in one batch; on failure they are
+    # kept for the next flush
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        increments = {}
+        for (category, function, era), (count, score) in batch.items():
+            names = (category,) if function is None else (category, function)
+            entry = hashlib.sha1('\0'.join(names).encode('utf-8')).hexdigest()[:16]
+            # Each era is counted separately, under its own entry key
+            entry = entry if era == 0 else f"{entry}@{era}"
+            increments[f"{entry}-{random.randrange(self._shards)}"] = {
+                'entry': entry, 'kind': 'category' if function is None else 'function',
+                'category': category, 'function': function, 'count': count, 'score': score}
+        try:
+            await run_blocking(self._storage.increment_usage, increments)
+        except asyncio.CancelledError:
+            # Unlike the write-behind buffers, an increment repeated counts twice, and the
+            # batch may still be written by the storage thread: it is not requeued
+            raise
+        except Exception as e:
+            logging.error("Failed to save usage counters of %d menu entries: %s", len(batch), e)
+            for key, (count, score) in batch.items():
+                counter = self._pending.setdefault(key, [0, 0.0])
+                counter[0] += count
+                counter[1] += score
+
+    async def _run(self):
+        next_reload = None if self._reload_interval is None else time.monotonic() + self._reload_interval
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            await self.flush()
+            if next_reload is not None and time.monotonic() >= next_reload:
+                next_reload = time.monotonic() + self._reload_interval
+                try:
+                    await self.load()
+                except Exception as e:
+                    logging.error("Failed to reload usage statistics: %s", e)
+
+
+# Function to get the era of a usage entry key, `<entry id>@<era>` (era 0 has no suffix)
+def _era_of(entry):
+    _, _, era = entry.partition('@')
+    return int(era) if era else 0
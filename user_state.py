@@ -0,0 +1,98 @@
+import asyncio
+import itertools
+import time
+from collections import OrderedDict
+
+import metrics
+from db_executor import run_blocking
+from write_behind import DEFAULT_FLUSH_SECONDS, WriteBehindBuffer
+
+# Idle time after which a user's state is dropped from memory (it stays in storage)
+DEFAULT_STATE_TTL_SECONDS = 3600
+
+STATE_LOOKUPS = metrics.REGISTRY.counter(
+    'bot_user_state_lookups_total', 'Conversation state lookups, by whether they were served from memory.',
+    ['result'])
+STATE_WRITES = metrics.REGISTRY.counter(
+    'bot_user_state_writes_total', 'User state documents written by write-behind flushes.')
+
+
+# Per-user conversation state (the `userstates` collection) kept in memory.
+# Reads are served from memory and loaded from storage on the first miss after a
+# restart or eviction; concurrent misses for one user share a single read. Changes
+# apply in memory at once and are merged into storage by a background task, so a
+# burst of changes for one user becomes one write and many users share a batch.
+# Changes made less than one flush interval before a crash are lost.
+#
+# All methods must be called from the event loop.
+class UserStateStore:
+    def __init__(self, storage, ttl=DEFAULT_STATE_TTL_SECONDS, flush_interval=DEFAULT_FLUSH_SECONDS):
+        self._storage = storage
+        self._ttl = ttl
+        self._states = OrderedDict()  # user_id -> [state, last access, loaded from storage], oldest first
+        self._loading = {}  # user_id -> future of the storage read in progress
+        self._writes = WriteBehindBuffer('user states', storage.save_user_states, merge=True,
+                                         flush_interval=flush_interval, on_flush=STATE_WRITES.inc)
+
+    # Function to get a copy of a user's state, {} when there is none
+    async def get(self, user_id):
+        user_id = str(user_id)
+        entry = self._states.get(user_id)
+        if entry is not None and entry[2]:
+            STATE_LOOKUPS.inc(result='hit')
+            self._touch(user_id, entry)
+            return dict(entry[0])
+
+        STATE_LOOKUPS.inc(result='miss')
+        future = self._loading.get(user_id)
+        if future is None:
+            future = self._loading[user_id] = asyncio.ensure_future(self._load(user_id))
+        await asyncio.shield(future)
+        return dict(self._states[user_id][0])
+
+    # Function to change some fields of a user's state
+    def update(self, user_id, **fields):
+        user_id = str(user_id)
+        entry = self._states.get(user_id)
+        if entry is None:
+            # Not loaded yet: the fields are kept and merged over the stored state on the next get()
+            entry = self._states[user_id] = [{}, 0.0, False]
+        entry[0].update(fields)
+        self._touch(user_id, entry)
+        self._writes.put(user_id, fields)
+
+    def start(self):
+        self._writes.start()
+
+    # Function to stop writing in the background after saving every pending change
+    async def stop(self):
+        await self._writes.stop()
+
+    async def flush(self):
+        await self._writes.flush()
+
+    async def _load(self, user_id):
+        try:
+            stored = await run_blocking(self._storage.load_user_state, user_id) or {}
+        finally:
+            del self._loading[user_id]
+        entry = self._states.get(user_id)
+        if entry is None:
+            entry = self._states[user_id] = [{}, 0.0, False]
+        # Changes made while the read was in flight win over what was stored
+        entry[0] = {**stored, **entry[0]}
+        entry[2] = True
+        self._touch(user_id, entry)
+
+    # Function to mark a state as used and drop the states idle for longer than the TTL.
+    # States are kept in access order, so only the expired ones at the front are visited;
+    # unsaved ones stay until a later call finds them saved.
+    def _touch(self, user_id, entry):
+        now = time.monotonic()
+        entry[1] = now
+        self._states.move_to_end(user_id)
+        cutoff = now - self._ttl
+        expired = [other_id for other_id, other in itertools.islice(self._states.items(), 8)
+                   if other[1] <= cutoff and other_id not in self._writes and other_id not in self._loading]
+        for other_id in expired:
+            del self._states[other_id]
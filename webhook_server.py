@@ -0,0 +1,135 @@
+import asyncio
+import contextlib
+import hmac
+import logging
+import signal
+from collections import OrderedDict
+
+from telegram import Update
+
+# Header Telegram sends with every webhook request when a secret token is set
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+DEFAULT_DEDUP_SIZE = 10000
+
+
+# Bounded LRU of recently seen update_ids, used to drop updates Telegram re-sends
+class UpdateDeduplicator:
+    def __init__(self, max_size=DEFAULT_DEDUP_SIZE):
+        self._max_size = max_size
+        self._seen = OrderedDict()
+
+    # Function to check whether an update_id was already accepted
+    def seen(self, update_id):
+        if update_id in self._seen:
+            self._seen.move_to_end(update_id)
+            return True
+        return False
+
+    # Function to record an accepted update_id
+    def add(self, update_id):
+        self._seen[update_id] = None
+        if len(self._seen) > self._max_size:
+            self._seen.popitem(last=False)
+
+
+# Function to build the aiohttp app that feeds webhook updates into the Application.
+# Updates are queued and acknowledged immediately, so Telegram never waits for a handler.
+# An update_id counts as seen only once its update is parsed and queued, so a request
+# rejected with an error can be retried by Telegram.
+def create_webhook_app(application, path, secret_token=None, dedup_size=DEFAULT_DEDUP_SIZE):
+    # Imported here so polling mode does not pay for aiohttp at startup
+    from aiohttp import web
+
+    deduplicator = UpdateDeduplicator(dedup_size)
+
+    async def receive_update(request):
+        if secret_token and not hmac.compare_digest(request.headers.get(SECRET_TOKEN_HEADER, ""), secret_token):
+            logging.warning("Rejected webhook request with a missing or invalid secret token",
+                            extra={'event': 'webhook_rejected'})
+            return web.Response(status=403)
+
+        try:
+            data = await request.json()
+            update_id = data["update_id"]
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400, text="Invalid update")
+
+        if deduplicator.seen(update_id):
+            logging.info("Dropped duplicate update %s", update_id, extra={'event': 'webhook_duplicate'})
+            return web.Response()
+
+        try:
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            logging.warning("Rejected malformed update %s: %s", update_id, e, extra={'event': 'webhook_invalid'})
+            return web.Response(status=400, text="Invalid update")
+
+        # Recorded before the first await, so a concurrent retry is still dropped
+        deduplicator.add(update_id)
+        await application.update_queue.put(update)
+        return web.Response()
+
+    async def health(request):
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_post(path, receive_update)
+    app.router.add_get("/healthz", health)
+    return app
+
+
+# Function to wait for SIGINT or SIGTERM
+async def wait_for_stop_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+
+# Context manager that runs the Application without its Updater, for processes that
+# feed update_queue themselves. The lifecycle (post_init, post_shutdown) mirrors run_polling.
+@contextlib.asynccontextmanager
+async def running_application(application):
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        yield application
+    finally:
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+# Function to run the Application behind the embedded webhook server until SIGINT/SIGTERM
+async def run_webhook(application, host, port, path, url=None, secret_token=None,
+                      dedup_size=DEFAULT_DEDUP_SIZE):
+    from aiohttp import web
+
+    async with running_application(application):
+        if url:
+            await application.bot.set_webhook(url=url, secret_token=secret_token,
+                                              allowed_updates=Update.ALL_TYPES)
+            logging.info("Webhook registered at %s", url)
+        if not secret_token:
+            logging.warning("WEBHOOK_SECRET is not set; webhook requests are not authenticated")
+
+        runner = web.AppRunner(create_webhook_app(application, path, secret_token, dedup_size))
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, host, port).start()
+            logging.info("Serving webhook on http://%s:%s%s", host, port, path)
+            await wait_for_stop_signal()
+        finally:
+            await runner.cleanup()
+
+
+# Function to start webhook mode from synchronous code, like application.run_polling()
+def serve_webhook(application, **kwargs):
+    asyncio.run(run_webhook(application, **kwargs))
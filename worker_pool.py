@@ -0,0 +1,362 @@
+import asyncio
+import hmac
+import json
+import logging
+import os
+import signal
+import time
+import zlib
+from collections import deque
+from urllib.parse import urlsplit
+
+from telegram import Update
+
+import metrics
+from webhook_server import running_application, wait_for_stop_signal
+
+# Where the dispatcher's broker listens: a Unix socket for workers on the same machine,
+# or tcp://host:port when workers run on other hosts too
+DEFAULT_BROKER_URL = "unix://bot_broker.sock"
+# Updates kept for a worker that is down or not connected yet; older ones are dropped past this
+DEFAULT_BACKLOG = 10000
+# Changes to shared in-memory data (catalog, allow list, groups) are fanned out on this topic
+SYNC_TOPIC = "sync"
+# Sync messages are replayed to workers connecting within this many seconds, longer than
+# the write-behind interval, so a worker that loads its data just before a change is saved
+# still learns of it
+SYNC_REPLAY_SECONDS = 10.0
+# Longest message on the wire; a whole catalog is sent as one message
+MAX_MESSAGE_BYTES = 16 * 1024 * 1024
+RECONNECT_DELAY_SECONDS = 0.5
+MAX_RECONNECT_DELAY_SECONDS = 30.0
+RESTART_DELAY_SECONDS = 1.0
+STOP_TIMEOUT_SECONDS = 10.0
+
+DISPATCHED_UPDATES = metrics.REGISTRY.counter(
+    'bot_dispatched_updates_total', 'Updates forwarded by the dispatcher, by worker shard.', ['shard'])
+BROKER_DROPPED = metrics.REGISTRY.counter(
+    'bot_broker_dropped_total', 'Messages dropped because a worker backlog was full, by topic.', ['topic'])
+
+
+def update_topic(shard):
+    return f"updates.{shard}"
+
+
+# Function to pick the worker for an update. Updates are keyed by chat, so one chat's
+# updates always reach the same worker in order; updates without a chat (inline queries)
+# by user, which is also the ID of the user's private chat.
+def shard_of(update, shard_count):
+    chat = update.effective_chat
+    user = update.effective_user
+    key = chat.id if chat is not None else user.id if user is not None else 0
+    return zlib.crc32(str(key).encode('ascii')) % shard_count
+
+
+def _encode(message):
+    return (json.dumps(message, separators=(',', ':'), ensure_ascii=False, default=str) + '\n').encode('utf-8')
+
+
+async def _open_connection(url):
+    parts = urlsplit(url)
+    if parts.scheme == 'unix':
+        return await asyncio.open_unix_connection(parts.netloc + parts.path, limit=MAX_MESSAGE_BYTES)
+    return await asyncio.open_connection(parts.hostname, parts.port, limit=MAX_MESSAGE_BYTES)
+
+
+# One connection to the broker, with the messages waiting to be written to it
+class _Peer:
+    def __init__(self, writer):
+        self.writer = writer
+        self.queue = deque()  # (topic, encoded message)
+        self._wakeup = asyncio.Event()
+
+    def send(self, topic, line):
+        self.queue.append((topic, line))
+        self._wakeup.set()
+
+    async def run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.queue:
+                _, line = self.queue.popleft()
+                self.writer.write(line)
+                await self.writer.drain()
+
+
+# Minimal publish/subscribe broker run by the dispatcher, standing in for a hosted one.
+# Messages are JSON lines: {"op": "sub", "topics": [...]}, {"op": "pub", "topic": ...,
+# "data": ...}, and {"op": "auth", "token": ...} first when a token is set. A message is
+# delivered to every other subscriber of its topic, except on retained topics (one per
+# worker shard): these go to their first subscriber only, so a second worker on a shard
+# is a standby, and are kept while the topic has no subscriber. The recent messages of
+# replayed topics are sent again to each new subscriber.
+#
+# All methods must be called from the event loop.
+class Broker:
+    def __init__(self, url=DEFAULT_BROKER_URL, token=None, backlog=DEFAULT_BACKLOG):
+        self._url = url
+        self._token = token
+        self._backlog = backlog
+        self._subscribers = {}  # topic -> [_Peer], in subscription order
+        self._backlogs = {}  # retained topic -> deque of encoded messages
+        self._histories = {}  # replayed topic -> (seconds, deque of (time, encoded message))
+        self._connections = {}  # _Peer -> task serving it
+        self._server = None
+
+    # Function to keep a topic's messages until someone subscribes
+    def retain(self, topic):
+        self._backlogs.setdefault(topic, deque())
+
+    # Function to send a topic's messages of the last `seconds` to every new subscriber
+    def replay(self, topic, seconds):
+        self._histories.setdefault(topic, (seconds, deque()))
+
+    async def start(self):
+        parts = urlsplit(self._url)
+        if parts.scheme == 'unix':
+            path = parts.netloc + parts.path
+            if os.path.exists(path):
+                os.unlink(path)  # left behind by a previous run
+            self._server = await asyncio.start_unix_server(self._serve, path, limit=MAX_MESSAGE_BYTES)
+        else:
+            self._server = await asyncio.start_server(self._serve, parts.hostname, parts.port,
+                                                      limit=MAX_MESSAGE_BYTES)
+        logging.info("Broker listening on %s", self._url)
+
+    async def stop(self):
+        if self._server is None:
+            return
+        self._server.close()
+        for peer in self._connections:
+            peer.writer.close()
+        await asyncio.gather(*self._connections.values(), return_exceptions=True)
+        await self._server.wait_closed()
+        self._server = None
+        parts = urlsplit(self._url)
+        if parts.scheme == 'unix' and os.path.exists(parts.netloc + parts.path):
+            os.unlink(parts.netloc + parts.path)
+
+    def publish(self, topic, data):
+        self._deliver(topic, _encode({'topic': topic, 'data': data}))
+
+    def _deliver(self, topic, line, sender=None):
+        peers = [peer for peer in self._subscribers.get(topic, ()) if peer is not sender]
+        if topic in self._histories:
+            self._recent(topic).append((time.monotonic(), line))
+        backlog = self._backlogs.get(topic)
+        if backlog is None:
+            for peer in peers:
+                peer.send(topic, line)
+        elif peers:
+            peers[0].send(topic, line)
+        else:
+            if len(backlog) >= self._backlog:
+                backlog.popleft()
+                BROKER_DROPPED.inc(topic=topic)
+            backlog.append(line)
+
+    async def _serve(self, reader, writer):
+        peer = _Peer(writer)
+        self._connections[peer] = asyncio.current_task()
+        sender = asyncio.create_task(peer.run())
+        authenticated = not self._token
+        try:
+            async for raw in reader:
+                message = json.loads(raw)
+                op = message.get('op')
+                if not authenticated:
+                    if op != 'auth' or not hmac.compare_digest(str(message.get('token', '')), self._token):
+                        logging.warning("Rejected broker connection with a missing or invalid token",
+                                        extra={'event': 'broker_rejected'})
+                        return
+                    authenticated = True
+                elif op == 'sub':
+                    for topic in message['topics']:
+                        self._subscribe(topic, peer)
+                elif op == 'pub':
+                    self._deliver(message['topic'], _encode({'topic': message['topic'], 'data': message['data']}),
+                                  sender=peer)
+        except (ConnectionError, ValueError, KeyError, TypeError) as e:
+            logging.warning("Broker connection failed: %s", e, extra={'event': 'broker_error'})
+        finally:
+            sender.cancel()
+            del self._connections[peer]
+            for peers in self._subscribers.values():
+                if peer in peers:
+                    peers.remove(peer)
+            # Updates not written yet go to the shard's standby worker or back to its backlog
+            for topic, line in peer.queue:
+                if topic in self._backlogs:
+                    self._deliver(topic, line)
+            writer.close()
+
+    def _subscribe(self, topic, peer):
+        peers = self._subscribers.setdefault(topic, [])
+        peers.append(peer)
+        backlog = self._backlogs.get(topic)
+        if backlog and peers[0] is peer:
+            logging.info("Delivering %d queued messages on %s", len(backlog), topic)
+            while backlog:
+                peer.send(topic, backlog.popleft())
+        if topic in self._histories:
+            for _, line in self._recent(topic):
+                peer.send(topic, line)
+
+    # Function to drop a replayed topic's messages older than its window
+    def _recent(self, topic):
+        seconds, history = self._histories[topic]
+        cutoff = time.monotonic() - seconds
+        while history and history[0][0] < cutoff:
+            history.popleft()
+        return history
+
+
+# Connection from a worker to the broker, re-established when it drops. Incoming
+# messages are passed to `on_message(topic, data)` one at a time, in order.
+class BrokerClient:
+    def __init__(self, url, topics, on_message, token=None):
+        self._url = url
+        self._topics = list(topics)
+        self._on_message = on_message
+        self._token = token
+        self._loop = asyncio.get_running_loop()
+        self._outgoing = deque()
+        self._wakeup = asyncio.Event()
+
+    # Function to send a message to the other subscribers of a topic; safe from any thread
+    def publish(self, topic, data):
+        line = _encode({'op': 'pub', 'topic': topic, 'data': data})
+        self._loop.call_soon_threadsafe(self._enqueue, line)
+
+    def _enqueue(self, line):
+        self._outgoing.append(line)
+        self._wakeup.set()
+
+    async def run(self):
+        delay = RECONNECT_DELAY_SECONDS
+        while True:
+            try:
+                reader, writer = await _open_connection(self._url)
+            except OSError as e:
+                logging.warning("Cannot reach the broker at %s, retrying in %.1fs: %s", self._url, delay, e,
+                                extra={'event': 'broker_unreachable'})
+            else:
+                if self._token:
+                    writer.write(_encode({'op': 'auth', 'token': self._token}))
+                writer.write(_encode({'op': 'sub', 'topics': self._topics}))
+                sender = asyncio.create_task(self._send(writer))
+                try:
+                    async for raw in reader:
+                        # Back off again from the start only once the connection has worked
+                        delay = RECONNECT_DELAY_SECONDS
+                        message = json.loads(raw)
+                        await self._on_message(message['topic'], message['data'])
+                except (ConnectionError, ValueError) as e:
+                    logging.warning("Broker connection failed: %s", e, extra={'event': 'broker_error'})
+                finally:
+                    sender.cancel()
+                    writer.close()
+                logging.warning("Disconnected from the broker, reconnecting in %.1fs", delay,
+                                extra={'event': 'broker_disconnected'})
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY_SECONDS)
+
+    async def _send(self, writer):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._outgoing:
+                writer.write(self._outgoing.popleft())
+                await writer.drain()
+
+
+# Front process of the multi-worker mode. Its Application receives updates (polling or
+# webhook) and forward() sends each one to the worker owning its chat through the
+# broker; worker processes for `local_shards` are started with `command` and restarted
+# when they exit. Workers on other hosts connect to the broker over TCP.
+class Dispatcher:
+    def __init__(self, broker, shard_count, local_shards, command, worker_env):
+        self._broker = broker
+        self._shard_count = shard_count
+        self._local_shards = list(local_shards)
+        self._command = list(command)
+        self._worker_env = worker_env  # function of the shard number -> extra environment
+        self._processes = {}  # shard -> running process
+        self._supervisors = []
+        self._stopping = False
+        for shard in range(shard_count):
+            broker.retain(update_topic(shard))
+        broker.replay(SYNC_TOPIC, SYNC_REPLAY_SECONDS)
+
+    # Handler for every update the Application receives
+    async def forward(self, update, context):
+        shard = shard_of(update, self._shard_count)
+        self._broker.publish(update_topic(shard), update.to_dict())
+        DISPATCHED_UPDATES.inc(shard=shard)
+
+    async def start(self):
+        await self._broker.start()
+        self._supervisors = [asyncio.create_task(self._supervise(shard)) for shard in self._local_shards]
+
+    # Function to stop the workers, letting them finish their queued updates, then the broker
+    async def stop(self):
+        self._stopping = True
+        for process in self._processes.values():
+            if process.returncode is None:
+                process.send_signal(signal.SIGTERM)
+        if self._supervisors:
+            _, pending = await asyncio.wait(self._supervisors, timeout=STOP_TIMEOUT_SECONDS)
+            for shard, process in self._processes.items():
+                if process.returncode is None:
+                    logging.warning("Worker %d did not stop in time, killing it", shard)
+                    process.kill()
+            await asyncio.gather(*pending, return_exceptions=True)
+        await self._broker.stop()
+
+    async def _supervise(self, shard):
+        while not self._stopping:
+            process = await asyncio.create_subprocess_exec(*self._command,
+                                                           env={**os.environ, **self._worker_env(shard)})
+            self._processes[shard] = process
+            logging.info("Started worker %d (pid %d)", shard, process.pid,
+                         extra={'event': 'worker_started', 'shard': shard})
+            returncode = await process.wait()
+            if self._stopping:
+                return
+            logging.error("Worker %d exited with code %s, restarting", shard, returncode,
+                          extra={'event': 'worker_exited', 'shard': shard})
+            await asyncio.sleep(RESTART_DELAY_SECONDS)
+
+
+# Function to run the Application of a worker process until SIGINT/SIGTERM, handling the
+# updates of one shard from the broker. `on_sync(data)` applies changes other workers
+# published on SYNC_TOPIC; `on_connect(client)` runs once the client exists, so the caller
+# can publish through it. The worker subscribes before the Application starts, so no
+# change published while it loads its data is missed.
+async def run_worker(application, shard, broker_url=DEFAULT_BROKER_URL, token=None, on_sync=None,
+                     on_connect=None):
+    async def on_message(topic, data):
+        if topic == SYNC_TOPIC:
+            if on_sync is not None:
+                on_sync(data)
+        else:
+            await application.update_queue.put(Update.de_json(data, application.bot))
+
+    client = BrokerClient(broker_url, [update_topic(shard), SYNC_TOPIC], on_message, token)
+    if on_connect is not None:
+        on_connect(client)
+    receiver = asyncio.create_task(client.run())
+    try:
+        async with running_application(application):
+            try:
+                await wait_for_stop_signal()
+            finally:
+                # Stop taking updates; those already queued are handled before the Application stops
+                receiver.cancel()
+    finally:
+        receiver.cancel()
+        try:
+            await receiver
+        except asyncio.CancelledError:
+            pass
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+
+from db_executor import run_blocking
+
+# How often pending changes are written to storage
+DEFAULT_FLUSH_SECONDS = 2.0
+# Pending documents that trigger a flush before the interval is up
+FLUSH_BATCH_SIZE = 500
+
+
+# Changes waiting to be written to one collection, coalesced per document and saved
+# in one batch by a background task. `save` is a blocking storage method taking
+# {document id: fields or None}, such as Storage.save_groups. With `merge`, the
+# fields changed for a document accumulate (save merges them into the document);
+# without it, the latest fields replace the whole document. None deletes it.
+#
+# All methods must be called from the event loop.
+class WriteBehindBuffer:
+    def __init__(self, name, save, merge, flush_interval=DEFAULT_FLUSH_SECONDS, on_flush=None):
+        self._name = name
+        self._save = save
+        self._merge = merge
+        self._flush_interval = flush_interval
+        self._on_flush = on_flush
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __contains__(self, doc_id):
+        return doc_id in self._pending
+
+    def pending(self):
+        return dict(self._pending)
+
+    def put(self, doc_id, fields):
+        if self._merge and fields is not None and self._pending.get(doc_id) is not None:
+            self._pending[doc_id] = {**self._pending[doc_id], **fields}
+        else:
+            self._pending[doc_id] = None if fields is None else dict(fields)
+        if len(self._pending) >= FLUSH_BATCH_SIZE:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    # Function to stop the background task after writing every pending change
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    # Function to write the pending changes in one batch; on failure they are kept for the next flush
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        try:
+            await run_blocking(self._save, batch)
+        except asyncio.CancelledError:
+            # The same changes written twice give the same result, so stop() can repeat this batch
+            self._requeue(batch)
+            raise
+        except Exception as e:
+            logging.error("Failed to save %d %s: %s", len(batch), self._name, e)
+            self._requeue(batch)
+            return
+        if self._on_flush is not None:
+            self._on_flush(len(batch))
+
+    # Function to put a failed batch back under the changes made since it was taken
+    def _requeue(self, batch):
+        for doc_id, fields in batch.items():
+            newer = self._pending.get(doc_id, fields)
+            if self._merge and fields is not None and doc_id in self._pending and newer is not None:
+                newer = {**fields, **newer}
+            self._pending[doc_id] = newer
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()